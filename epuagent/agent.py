@@ -1,26 +1,45 @@
 # Copyright 2013 University of Chicago
 
-import gevent.monkey ; gevent.monkey.patch_all()
-
 import uuid
 import logging
 
-import dashi.bootstrap as bootstrap
-from dashi.util import LoopingCall 
+import gevent
+import gevent.event
 
-from epuagent.supervisor import Supervisor
+from epuagent.supervisor import Supervisor, SupervisorGroup, \
+        DEFAULT_POOL_SIZE, DEFAULT_ENDPOINT_TIMEOUT, DEFAULT_CALL_TIMEOUT, \
+        DEFAULT_FAILURE_THRESHOLD, DEFAULT_RESET_SECONDS
 from epuagent.core import EPUAgentCore
+from epuagent.delta import DeltaEncoder, carry_once_fields
+from epuagent.procstats import ProcessSampler, DEFAULT_WINDOW, \
+        DEFAULT_FD_INTERVAL, DEFAULT_BUDGET
+from epuagent.vitals import NodeVitals, DEFAULT_MOUNTS
+from epuagent.schedule import AdaptivePeriod, FixedRateScheduler, \
+        BeatSpacing, DEFAULT_BACKOFF, DEFAULT_MIN_SPACING
+from epuagent.codec import get_codec, BinaryCodec, DEFAULT_COMPRESS_THRESHOLD
+from epuagent.stats import Stats, NO_STATS
+from epuagent.outbox import Outbox, DEFAULT_OUTBOX_SIZE
+from epuagent.status import StatusServer, parse_address
+from epuagent.blobs import BlobDeduper
+from epuagent.budget import PayloadBudget
+from epuagent.checkpoint import Checkpoint, DEFAULT_CHECKPOINT_INTERVAL
+from epuagent.blockio import make_io, HubMonitor, DEFAULT_IO_THREADS, \
+        DEFAULT_IO_TIMEOUT
 from epuagent.util import get_config_paths
 
-logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
+DEFAULT_KEYFRAME_INTERVAL = 20
+
 class EPUAgent(object):
     """Elastic Process Unit (EPU) Agent. Monitors vitals in running VMs.
     """
 
     def __init__(self, *args, **kwargs):
 
+        # dashi pulls in kombu and friends; only load it for a real agent
+        import dashi.bootstrap as bootstrap
+
         configs = ["epuagent"]
         config_files = get_config_paths(configs)
         self.CFG = bootstrap.configure(config_files)
@@ -40,6 +59,31 @@ class EPUAgent(object):
         period = kwargs.get('period_seconds')
         self.period = float(period or self.CFG.epuagent.period_seconds)
 
+        # the period stretches up to max_period_seconds while state is
+        # unchanged, and snaps back to period_seconds on any change
+        max_period = self._option(kwargs, 'max_period_seconds')
+        if max_period is not None:
+            max_period = float(max_period)
+        backoff = float(self._option(kwargs, 'period_backoff', DEFAULT_BACKOFF))
+        self.schedule = AdaptivePeriod(self.period, max_period, backoff)
+        self._reschedule = gevent.event.Event()
+
+        # beats run at a fixed rate, phase shifted by node_id so agents
+        # started together don't beat in lockstep
+        jitter = float(self._option(kwargs, 'heartbeat_jitter', 0.0))
+        self.scheduler = FixedRateScheduler(self.node_id, jitter=jitter)
+
+        # process transitions heartbeat right away, at most once per
+        # min_heartbeat_spacing seconds. Heartbeat requests are answered
+        # with the last sampled state while it is under heartbeat_max_age
+        # seconds old.
+        min_spacing = float(self._option(kwargs, 'min_heartbeat_spacing',
+                                         DEFAULT_MIN_SPACING))
+        max_age = float(self._option(kwargs, 'heartbeat_max_age',
+                                     self.period / 2))
+        self.spacing = BeatSpacing(min_spacing, max_age)
+        self._pending_beat = None
+
         # for testing, allow for not starting heartbeat automatically
         self.start_beat = kwargs.get('start_heartbeat', True)
 
@@ -47,26 +91,191 @@ class EPUAgent(object):
 
         sock = kwargs.get('supervisor_socket')
         sock = sock or self.CFG.epuagent.get('supervisor_socket')
-        if sock:
+
+        # several supervisord instances may be listed instead, each either
+        # a socket URL or a dict with 'name' and 'url'
+        socks = self._option(kwargs, 'supervisor_sockets')
+        if socks:
+            supervisors = []
+            for sock in socks:
+                if isinstance(sock, dict):
+                    name, sock = sock.get('name'), sock['url']
+                else:
+                    name = None
+                log.debug("monitoring a process supervisor at: %s", sock)
+                supervisors.append((name or sock,
+                                    self._make_supervisor(sock, kwargs)))
+            pool_size = int(self._option(kwargs, 'supervisor_pool_size',
+                                         DEFAULT_POOL_SIZE))
+            timeout = float(self._option(kwargs, 'supervisor_timeout_seconds',
+                                         DEFAULT_ENDPOINT_TIMEOUT))
+            self.supervisor = SupervisorGroup(supervisors,
+                                              pool_size=pool_size,
+                                              timeout=timeout)
+        elif sock:
             log.debug("monitoring a process supervisor at: %s", sock)
-            self.supervisor = Supervisor(sock)
+            self.supervisor = self._make_supervisor(sock, kwargs)
         else:
             log.debug("not monitoring process supervisor")
             self.supervisor = None
 
-        self.core = EPUAgentCore(self.node_id, supervisor=self.supervisor)
+        # per-phase timing of the heartbeat loop, available through the
+        # get_stats op and optionally in every heartbeat
+        self.stats = NO_STATS
+        if self._option(kwargs, 'agent_stats', False):
+            self.stats = Stats()
+        self.heartbeat_stats = bool(self._option(kwargs, 'heartbeat_stats',
+                                                 False))
+
+        # disk and /proc reads run in a bounded thread pool, each with a
+        # timeout, so a slow disk can't stall heartbeats or dashi
+        io_threads = int(self._option(kwargs, 'io_threads',
+                                      DEFAULT_IO_THREADS))
+        io_timeout = float(self._option(kwargs, 'io_timeout_seconds',
+                                        DEFAULT_IO_TIMEOUT))
+        self.io = make_io(io_threads, io_timeout)
+
+        # with agent_stats on, also measure how long the hub is blocked
+        self.hub_monitor = None
+        if self.stats.enabled:
+            self.hub_monitor = HubMonitor(self.stats)
+
+        core_kwargs = {'stats': self.stats, 'io': self.io}
+        fail_cache_size = self._option(kwargs, 'fail_cache_size')
+        if fail_cache_size:
+            core_kwargs['fail_cache_size'] = int(fail_cache_size)
+        stderr_max_bytes = self._option(kwargs, 'stderr_max_bytes')
+        if stderr_max_bytes:
+            core_kwargs['stderr_max_bytes'] = int(stderr_max_bytes)
+        stderr_max_lines = self._option(kwargs, 'stderr_max_lines')
+        if stderr_max_lines:
+            core_kwargs['stderr_max_lines'] = int(stderr_max_lines)
+        core_kwargs['stderr_use_mmap'] = bool(
+                self._option(kwargs, 'stderr_use_mmap', False))
+        # tail stderr logs through supervisord, batched with the query
+        core_kwargs['stderr_rpc'] = bool(
+                self._option(kwargs, 'stderr_rpc', False))
+
+        # when process state events are forwarded by epu-agent-listener,
+        # supervisord only needs to be polled occasionally
+        reconcile_seconds = self._option(kwargs, 'reconcile_seconds')
+        if reconcile_seconds:
+            core_kwargs['reconcile_seconds'] = float(reconcile_seconds)
+
+        if self._option(kwargs, 'process_stats', False):
+            window = int(self._option(kwargs, 'process_stats_window',
+                                      DEFAULT_WINDOW))
+            fd_interval = int(self._option(kwargs, 'process_fd_interval',
+                                           DEFAULT_FD_INTERVAL))
+            budget = float(self._option(kwargs, 'process_sample_budget',
+                                        DEFAULT_BUDGET))
+            core_kwargs['process_sampler'] = ProcessSampler(window,
+                    fd_interval=fd_interval, budget=budget)
+
+        if self._option(kwargs, 'node_vitals', False):
+            mounts = self._option(kwargs, 'vitals_mounts', DEFAULT_MOUNTS)
+            core_kwargs['vitals'] = NodeVitals(mounts)
+
+        self.core = EPUAgentCore(self.node_id, supervisor=self.supervisor,
+                                 **core_kwargs)
+
+        # with delta heartbeats, only changes are sent between keyframes
+        keyframe_interval = 1
+        if self._option(kwargs, 'heartbeat_delta', False):
+            keyframe_interval = int(self._option(kwargs, 'keyframe_interval',
+                                                 DEFAULT_KEYFRAME_INTERVAL))
+        self.encoder = DeltaEncoder(keyframe_interval)
+
+        # reported failures and the heartbeat sequence survive restarts,
+        # so failures aren't reported again with their stderr. Failure
+        # changes are saved at most every checkpoint_interval seconds.
+        self.checkpoint = None
+        checkpoint_path = self._option(kwargs, 'checkpoint_path')
+        if checkpoint_path:
+            interval = float(self._option(kwargs, 'checkpoint_interval',
+                                          DEFAULT_CHECKPOINT_INTERVAL))
+            self.checkpoint = Checkpoint(checkpoint_path,
+                                         min_interval=interval)
+            records, sequence = self.checkpoint.load()
+            self.core.fail_cache.load(records)
+            self.encoder.sequence = sequence
+
+        codec_name = self._option(kwargs, 'heartbeat_codec')
+        codec_kwargs = {}
+        if codec_name == BinaryCodec.name:
+            codec_kwargs['compress_threshold'] = int(self._option(kwargs,
+                    'compress_threshold', DEFAULT_COMPRESS_THRESHOLD))
+        self.codec = get_codec(codec_name, **codec_kwargs)
+
+        # identical stderr tails of failed processes are sent once per
+        # heartbeat, and not at all once the receiver acknowledges them
+        self.deduper = None
+        if self._option(kwargs, 'heartbeat_dedupe', False):
+            self.deduper = BlobDeduper()
+
+        # heartbeats over max_heartbeat_bytes are trimmed, least important
+        # parts first, and say what was left out
+        self.budget = None
+        max_heartbeat_bytes = self._option(kwargs, 'max_heartbeat_bytes')
+        if max_heartbeat_bytes:
+            self.budget = PayloadBudget(int(max_heartbeat_bytes))
+
+        outbox_size = int(self._option(kwargs, 'outbox_size',
+                                       DEFAULT_OUTBOX_SIZE))
+        self.outbox = Outbox(outbox_size, merge=carry_once_fields)
+
+        # local tools can read the latest state from a unix socket path or
+        # a loopback host:port instead of querying supervisord themselves
+        self.status = None
+        status_address = self._option(kwargs, 'status_address')
+        if status_address:
+            self.status = StatusServer(parse_address(status_address),
+                                       get_stats=self.get_stats)
 
         self.dashi = bootstrap.dashi_connect(self.topic, self.CFG, amqp_uri)
 
+    def _option(self, kwargs, name, default=None):
+        """Looks up an option from constructor kwargs, then config
+        """
+        value = kwargs.get(name)
+        if value is None:
+            value = self.CFG.epuagent.get(name, default)
+        return value
+
+    def _make_supervisor(self, sock, kwargs):
+        timeout = float(self._option(kwargs, 'supervisor_call_timeout',
+                                     DEFAULT_CALL_TIMEOUT))
+        failure_threshold = int(self._option(kwargs,
+                'supervisor_failure_threshold', DEFAULT_FAILURE_THRESHOLD))
+        reset_seconds = float(self._option(kwargs, 'supervisor_reset_seconds',
+                                           DEFAULT_RESET_SECONDS))
+        return Supervisor(sock, timeout=timeout,
+                          failure_threshold=failure_threshold,
+                          reset_seconds=reset_seconds)
+
     def start(self):
         log.info('EPUAgent starting')
 
-        self.dashi.handle(self.heartbeat)
+        self.dashi.handle(self.request_heartbeat, 'heartbeat')
+        self.dashi.handle(self.request_keyframe)
+        self.dashi.handle(self.process_event)
+        self.dashi.handle(self.get_stats)
+        self.dashi.handle(self.ack_blobs)
 
-        self.loop = LoopingCall(self._loop)
+        # heartbeats are published from their own greenlet so a slow
+        # broker doesn't hold up sampling
+        self.publisher = gevent.spawn(self.outbox.run, self._publish)
+
+        if self.status:
+            self.status.start()
+        if self.hub_monitor:
+            self.hub_monitor.start()
+
+        self.loop = None
         if self.start_beat:
-            log.debug('Starting heartbeat loop - %s second interval', self.period)
-            self.loop.start(self.period)
+            log.debug('Starting heartbeat loop - %s to %s second interval',
+                      self.schedule.min_period, self.schedule.max_period)
+            self.loop = gevent.spawn(self._run_loop)
 
         try:
             self.dashi.consume()
@@ -75,20 +284,168 @@ class EPUAgent(object):
         else:
             log.info("Exiting normally.")
 
+        if self.checkpoint:
+            self.checkpoint.flush(self.core.fail_cache,
+                                  self.encoder.sequence)
+
+
+    def _run_loop(self):
+        scheduler = self.scheduler
+        self._loop()
+        deadline = scheduler.next(self.schedule.interval)
+        while True:
+            remaining = scheduler.remaining(deadline)
+            if remaining > 0:
+                self._reschedule.wait(remaining)
+
+            # a heartbeat that shortens the interval wakes us up to wait
+            # for the new interval's deadline instead
+            if self._reschedule.is_set():
+                self._reschedule.clear()
+                deadline = scheduler.next(self.schedule.interval)
+                continue
+            if scheduler.remaining(deadline) > 0:
+                continue
+
+            scheduler.fired()
+            self._loop()
+            deadline = scheduler.next(self.schedule.interval)
 
     def _loop(self):
         return self.heartbeat()
 
     def heartbeat(self):
+        """Samples node state and queues it for publishing
+        """
+        stats = self.stats
         try:
-            state = self.core.get_state()
-            self.dashi.fire(self.heartbeat_dest, self.heartbeat_op,
-                    heartbeat=state)
+            with stats.timer('sample'):
+                with stats.timer('get_state'):
+                    state = self.core.get_state()
+
+                last_interval = self.schedule.interval
+                state['period'] = self.schedule.update(state)
+                if state['period'] < last_interval:
+                    self._reschedule.set()
+
+            # _publish adds to the state it is given, so keep a copy
+            self.spacing.sampled(dict(state), self.core.transitions)
+            if self.status:
+                self.status.update(state)
+            self.outbox.put(state)
         except Exception, e:
-            # unhandled exceptions will terminate the LoopingCall
+            stats.incr('heartbeat_errors')
+            # unhandled exceptions would terminate the heartbeat loop
             log.error('Error heartbeating: %s', e, exc_info=True)
 
+    def _publish(self, state):
+        stats = self.stats
+        if self.heartbeat_stats:
+            state['agent_stats'] = self.get_stats()
+
+        with stats.timer('encode'):
+            if self.deduper:
+                state = self.deduper.dedupe(state)
+            if self.budget:
+                state = self.budget.apply(state)
+            msg = self.codec.encode(self.encoder.encode(state))
+        with stats.timer('publish'):
+            self.dashi.fire(self.heartbeat_dest, self.heartbeat_op,
+                    heartbeat=msg)
+        stats.incr('heartbeats')
+
+        if self.checkpoint:
+            with stats.timer('checkpoint'):
+                self.checkpoint.update(self.core.fail_cache,
+                                       self.encoder.sequence, self.io)
+
+    def get_stats(self):
+        """Returns heartbeat loop timings and counters, or None if
+        agent_stats is disabled
+        """
+        snapshot = self.stats.snapshot()
+        if snapshot is None:
+            return None
+        snapshot['codec'] = self.codec.get_stats()
+        snapshot['outbox'] = self.outbox.get_stats()
+        snapshot['fail_cache'] = self.core.fail_cache.get_stats()
+        snapshot['scheduler'] = self.scheduler.get_stats()
+        snapshot['transitions'] = self.core.transitions
+        io_stats = self.io.get_stats()
+        if io_stats:
+            snapshot['io'] = io_stats
+        if self.hub_monitor:
+            snapshot['hub'] = self.hub_monitor.get_stats()
+        if self.status:
+            snapshot['status'] = self.status.get_server_stats()
+        if self.deduper:
+            snapshot['blobs'] = self.deduper.get_stats()
+        if self.budget:
+            snapshot['budget'] = self.budget.get_stats()
+        if self.checkpoint:
+            snapshot['checkpoint'] = self.checkpoint.get_stats()
+        get_supervisor_stats = getattr(self.supervisor, 'get_stats', None)
+        if get_supervisor_stats:
+            snapshot['supervisor'] = get_supervisor_stats()
+        return snapshot
+
+    def request_keyframe(self):
+        """Makes the next heartbeat carry the full state
+        """
+        self.encoder.request_keyframe()
+
+    def ack_blobs(self, digests):
+        """Records that the heartbeat receiver already has these stderr
+        blobs, so they are no longer sent
+        """
+        if self.deduper:
+            self.deduper.ack(digests)
+
+    def process_event(self, eventname, payload):
+        """Applies a supervisord process state event forwarded by
+        epu-agent-listener. Heartbeats right away on failure or recovery.
+        """
+        if self.core.apply_event(eventname, payload):
+            self.heartbeat_soon()
+
+    def heartbeat_soon(self):
+        """Heartbeats now, or as soon as min_heartbeat_spacing allows
+
+        Calls made while a delayed heartbeat is pending share it.
+        """
+        if self._pending_beat is not None:
+            self.stats.incr('coalesced_heartbeats')
+            return
+        self.stats.incr('immediate_heartbeats')
+        wait = self.spacing.wait_time()
+        if wait > 0:
+            self._pending_beat = gevent.spawn_later(wait, self._delayed_beat)
+        else:
+            self.spacing.beat()
+            self.heartbeat()
+
+    def _delayed_beat(self):
+        self._pending_beat = None
+        self.spacing.beat()
+        self.heartbeat()
+
+    def request_heartbeat(self):
+        """Handles the heartbeat op: sends the last sampled state if it is
+        recent enough, otherwise samples a fresh one
+        """
+        state = self.spacing.recent_state(self.core.transitions)
+        if state is None:
+            self.heartbeat()
+            return
+        self.stats.incr('cached_heartbeats')
+        self.outbox.put(dict(state))
+
 def main():
+    # done here rather than at import so that importing epuagent modules
+    # for tooling or tests leaves the interpreter alone
+    import gevent.monkey ; gevent.monkey.patch_all()
+    logging.basicConfig(level=logging.DEBUG)
+
     epuagent = EPUAgent()
     epuagent.start()
 
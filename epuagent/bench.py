@@ -0,0 +1,334 @@
+# Copyright 2013 University of Chicago
+
+"""Benchmarks for the EPU Agent hot paths
+
+Runs offline against synthetic supervisors and temp files:
+
+    python -m epuagent.bench [--quick] [--json results.json]
+                             [--compare old.json]
+
+For each case it reports ops/sec, latency percentiles and the number of
+gc-tracked objects still alive after a full collection, per op. That
+shows leaks and caches that grow with use; it is not an allocation
+count, which Python 2 has no cheap way to measure. The garbage
+collector is off while a case runs. --json writes the results for
+comparing runs later with --compare.
+
+Cases with a latency budget fail when their p99 exceeds it, and the
+run exits with status 1.
+"""
+
+import os
+import gc
+import sys
+import json
+import time
+import uuid
+import socket
+import logging
+import optparse
+import tempfile
+from timeit import default_timer as timer
+
+from epuagent.core import EPUAgentCore, _get_file
+from epuagent.codec import get_codec
+from epuagent.procstats import ProcessSampler
+from epuagent.supervisor import Supervisor, ProcessStates
+from epuagent.fakesupervisord import FakeSupervisord
+
+log = logging.getLogger(__name__)
+
+PROCESS_COUNTS = (10, 100, 1000, 10000)
+FAILURE_RATIOS = (0.0, 0.1, 1.0)
+LOG_SIZE = 64 * 1024 * 1024
+
+DEFAULT_MIN_SECONDS = 1.0
+DEFAULT_MAX_ITERATIONS = 100000
+
+# seconds one tick of the process sampler may take with 1000 processes
+PROCESS_SAMPLER_BUDGET = 0.001
+
+
+class BenchSupervisor(object):
+    """Supervisor stand-in returning a fixed synthetic process table
+    """
+
+    def __init__(self, count, failure_ratio=0.0, stderr_logfile=None):
+        self.processes = []
+        nfailed = int(count * failure_ratio)
+        for i in xrange(count):
+            failed = i < nfailed
+            proc = {'name': 'proc%d' % i, 'group': 'proc%d' % i,
+                    'pid': 0 if failed else 1000 + i,
+                    'state': ProcessStates.FATAL if failed
+                             else ProcessStates.RUNNING,
+                    'statename': 'FATAL' if failed else 'RUNNING',
+                    'exitstatus': 1 if failed else 0,
+                    'stop': 1360000000 if failed else 0,
+                    'spawnerr': '', 'description': ''}
+            if stderr_logfile:
+                proc['stderr_logfile'] = stderr_logfile
+            self.processes.append(proc)
+
+    def query(self):
+        return [dict(proc) for proc in self.processes]
+
+
+class Result(object):
+    def __init__(self, name, latencies, retained, budget=None):
+        latencies = sorted(latencies)
+        n = len(latencies)
+        total = sum(latencies)
+        self.name = name
+        self.iterations = n
+        self.ops_per_sec = n / total if total else None
+        self.p50 = _percentile(latencies, 50)
+        self.p90 = _percentile(latencies, 90)
+        self.p99 = _percentile(latencies, 99)
+        self.max = latencies[-1]
+        self.retained_objects = float(retained) / n
+        self.budget = budget
+        self.over_budget = budget is not None and self.p99 > budget
+
+    def to_dict(self):
+        return {'name': self.name, 'iterations': self.iterations,
+                'ops_per_sec': self.ops_per_sec, 'p50': self.p50,
+                'p90': self.p90, 'p99': self.p99, 'max': self.max,
+                'retained_objects': self.retained_objects,
+                'budget': self.budget, 'over_budget': self.over_budget}
+
+
+def measure(name, func, setup=None, min_seconds=DEFAULT_MIN_SECONDS,
+            max_iterations=DEFAULT_MAX_ITERATIONS, budget=None):
+    """Calls func repeatedly for at least min_seconds
+
+    setup, if given, is called untimed before each call. budget, if given,
+    is the most seconds a call may take at p99.
+    """
+    if setup:
+        setup()
+    func()
+
+    latencies = []
+    gc.collect()
+    before = len(gc.get_objects())
+    gc.disable()
+    try:
+        deadline = timer() + min_seconds
+        while len(latencies) < max_iterations:
+            if setup:
+                setup()
+            start = timer()
+            func()
+            latencies.append(timer() - start)
+            if timer() > deadline:
+                break
+    finally:
+        gc.enable()
+    gc.collect()
+    retained = len(gc.get_objects()) - before
+    return Result(name, latencies, retained, budget)
+
+
+def bench_get_state(min_seconds, counts=PROCESS_COUNTS,
+                    ratios=FAILURE_RATIOS):
+    for count in counts:
+        for ratio in ratios:
+            core = EPUAgentCore("bench", BenchSupervisor(count, ratio))
+            yield measure("get_state[procs=%d,failed=%s]" % (count, ratio),
+                          core.get_state, min_seconds=min_seconds)
+
+def bench_one_process_failure(min_seconds):
+    core = EPUAgentCore("bench")
+    proc = BenchSupervisor(1, 1.0).processes[0]
+    yield measure("one_process_failure[cache_hit]",
+                  lambda: core._one_process_failure(proc),
+                  min_seconds=min_seconds)
+    yield measure("one_process_failure[cache_miss]",
+                  lambda: core._one_process_failure(proc),
+                  setup=core.fail_cache.clear, min_seconds=min_seconds)
+
+def bench_get_file(min_seconds, size=LOG_SIZE):
+    path = _write_log(size)
+    try:
+        for use_mmap in (False, True):
+            yield measure("get_file[size=%d,mmap=%s]" % (size, use_mmap),
+                          lambda: _get_file(path, use_mmap=use_mmap),
+                          min_seconds=min_seconds)
+    finally:
+        os.unlink(path)
+
+def bench_process_sampler(min_seconds, count=1000):
+    """Samples count processes from /proc each tick; all are this one,
+    under different names, so the reads are real
+    """
+    if not os.path.exists("/proc/%d/stat" % os.getpid()):
+        log.warn("no /proc filesystem, skipping process sampler benchmark")
+        return
+    procs = [{'name': 'proc%d' % i, 'pid': os.getpid()}
+             for i in xrange(count)]
+    sampler = ProcessSampler()
+    yield measure("process_sampler[procs=%d]" % count,
+                  lambda: sampler.sample(procs), min_seconds=min_seconds,
+                  budget=PROCESS_SAMPLER_BUDGET)
+
+def bench_heartbeat(min_seconds, count=1000, ratio=0.1):
+    """Encodes and publishes heartbeats over dashi's memory transport
+    """
+    try:
+        import dashi.bootstrap as bootstrap
+    except ImportError:
+        log.warn("dashi not available, skipping heartbeat benchmark")
+        return
+
+    core = EPUAgentCore("bench", BenchSupervisor(count, ratio))
+    dest = "bench-subscriber-%s" % uuid.uuid4()
+    conn = bootstrap.dashi_connect("bench-agent-%s" % uuid.uuid4(),
+                                   amqp_uri="memory://bench")
+    state = core.get_state()
+    for codec_name in ("dict", "binary"):
+        codec = get_codec(codec_name)
+        def beat():
+            conn.fire(dest, "heartbeat", heartbeat=codec.encode(state))
+        yield measure("heartbeat[procs=%d,failed=%s,codec=%s]" %
+                      (count, ratio, codec_name), beat,
+                      min_seconds=min_seconds)
+
+def bench_supervisord(min_seconds, counts=(100, 5000), latencies=(0.0, 0.2),
+                      churn_rate=0.01):
+    """Drives Supervisor and EPUAgentCore against a fake supervisord
+    over its unix socket, with and without RPC latency, then with churn
+    and stderr tailed through supervisord
+    """
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, "supervisor.sock")
+    try:
+        for count in counts:
+            for latency in latencies:
+                for result in _bench_supervisord(path, count, latency,
+                                                 churn_rate, min_seconds):
+                    yield result
+    finally:
+        os.rmdir(tmpdir)
+
+def _bench_supervisord(path, count, latency, churn_rate, min_seconds):
+    server = FakeSupervisord(path, count=count, latency=latency, seed=1)
+    server.start()
+    sup = Supervisor(server.url, timeout=30)
+    try:
+        yield measure("supervisord_query[procs=%d,latency=%s]" %
+                      (count, latency), sup.query, min_seconds=min_seconds)
+
+        server.churn_rate = churn_rate
+        core = EPUAgentCore("bench", sup, stderr_rpc=True)
+        yield measure("supervisord_get_state[procs=%d,latency=%s,churn=%s]"
+                      % (count, latency, churn_rate), core.get_state,
+                      min_seconds=min_seconds)
+    finally:
+        sup.close()
+        server.stop()
+
+def run(quick=False, previous=None):
+    """Runs all benchmarks and prints the results
+
+    previous maps result names to results of an earlier run, to print
+    the change in ops/sec.
+    """
+    previous = previous or {}
+    if quick:
+        min_seconds = 0.05
+        cases = [bench_get_state(min_seconds, counts=(10, 1000)),
+                 bench_one_process_failure(min_seconds),
+                 bench_get_file(min_seconds, size=1024 * 1024),
+                 bench_process_sampler(min_seconds, count=100),
+                 bench_heartbeat(min_seconds, count=100),
+                 bench_supervisord(min_seconds, counts=(100,),
+                                   latencies=(0.0,))]
+    else:
+        min_seconds = DEFAULT_MIN_SECONDS
+        cases = [bench_get_state(min_seconds),
+                 bench_one_process_failure(min_seconds),
+                 bench_get_file(min_seconds),
+                 bench_process_sampler(min_seconds),
+                 bench_heartbeat(min_seconds),
+                 bench_supervisord(min_seconds)]
+
+    results = []
+    for case in cases:
+        for result in case:
+            _print_result(result, previous.get(result.name))
+            results.append(result)
+    return results
+
+
+def _write_log(size):
+    fd, path = tempfile.mkstemp()
+    f = os.fdopen(fd, 'w')
+    try:
+        line = "Traceback (most recent call last): something went wrong\n"
+        chunk = line * (65536 // len(line))
+        written = 0
+        while written < size:
+            f.write(chunk[:size - written])
+            written += len(chunk)
+    finally:
+        f.close()
+    return path
+
+def _percentile(ordered, pct):
+    index = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+def _print_result(result, previous=None):
+    line = ("%-52s %12.1f ops/s  p50 %9.1fus  p99 %9.1fus  max %9.1fus"
+            "  %8.1f retained/op" % (result.name, result.ops_per_sec or 0,
+            result.p50 * 1e6, result.p99 * 1e6, result.max * 1e6,
+            result.retained_objects))
+    if previous and previous.get('ops_per_sec') and result.ops_per_sec:
+        line += "  %+6.1f%%" % (100.0 * (result.ops_per_sec /
+                                         previous['ops_per_sec'] - 1))
+    if result.over_budget:
+        line += "  OVER BUDGET (%.1fus)" % (result.budget * 1e6)
+    print line
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--quick", action="store_true", default=False,
+                      help="small inputs and short runs, for a smoke test")
+    parser.add_option("--json", metavar="PATH",
+                      help="write results as JSON to PATH")
+    parser.add_option("--compare", metavar="PATH",
+                      help="compare ops/sec with results from an earlier run")
+    options, args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARN)
+
+    previous = None
+    if options.compare:
+        f = open(options.compare)
+        try:
+            previous = json.load(f)
+        finally:
+            f.close()
+        previous = dict((r['name'], r) for r in previous['results'])
+
+    results = run(quick=options.quick, previous=previous)
+
+    if options.json:
+        output = {'timestamp': time.time(), 'host': socket.gethostname(),
+                  'python': sys.version.split()[0],
+                  'results': [result.to_dict() for result in results]}
+        f = open(options.json, 'w')
+        try:
+            json.dump(output, f, indent=2)
+        finally:
+            f.close()
+
+    over = [result.name for result in results if result.over_budget]
+    if over:
+        print >>sys.stderr, "over budget: %s" % ", ".join(over)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
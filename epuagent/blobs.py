@@ -0,0 +1,116 @@
+# Copyright 2013 University of Chicago
+
+"""Content-addressed deduplication of failure details
+
+When many processes fail the same way, their stderr tails are identical.
+BlobDeduper replaces each failed process's 'stderr' with a
+'stderr_digest' and sends each distinct text once, in the heartbeat's
+'blobs' dict keyed by digest. Receivers keep the blobs they have seen,
+rebuild 'stderr' with restore_blobs(), and may acknowledge digests
+through the agent's ack_blobs op so those texts aren't sent again.
+"""
+
+import hashlib
+import logging
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_KNOWN = 1024
+
+
+class BlobDeduper(object):
+    """Moves stderr text out of failed process records into blobs
+
+    Remembers up to max_known acknowledged digests, least recently used
+    first.
+    """
+
+    def __init__(self, max_known=DEFAULT_MAX_KNOWN):
+        self.max_known = max_known
+        self._known = OrderedDict()
+
+        self.blobs_sent = 0
+        self.blobs_deduped = 0
+        self.bytes_saved = 0
+
+    def ack(self, digests):
+        """Records that the receiver has these blobs
+        """
+        known = self._known
+        for digest in digests:
+            known.pop(digest, None)
+            known[digest] = True
+        while len(known) > self.max_known:
+            known.popitem(last=False)
+
+    def dedupe(self, state):
+        """Returns a copy of state with stderr texts replaced by digests
+        """
+        failed = state.get('failed_processes')
+        if not failed or not any(proc.get('stderr') for proc in failed):
+            return state
+
+        known = self._known
+        blobs = {}
+        procs = []
+        for proc in failed:
+            data = proc.get('stderr')
+            if not data:
+                procs.append(proc)
+                continue
+
+            digest = blob_digest(data)
+            proc = dict(proc)
+            del proc['stderr']
+            proc['stderr_digest'] = digest
+            procs.append(proc)
+
+            if digest in blobs or digest in known:
+                self.blobs_deduped += 1
+                self.bytes_saved += len(data)
+                if digest in known:
+                    # keep recently used digests from being evicted
+                    del known[digest]
+                    known[digest] = True
+            else:
+                blobs[digest] = data
+                self.blobs_sent += 1
+
+        state = dict(state)
+        state['failed_processes'] = procs
+        if blobs:
+            state['blobs'] = blobs
+        return state
+
+    def get_stats(self):
+        return {'known': len(self._known), 'blobs_sent': self.blobs_sent,
+                'blobs_deduped': self.blobs_deduped,
+                'bytes_saved': self.bytes_saved}
+
+
+def blob_digest(data):
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+def restore_blobs(state, store):
+    """Fills in 'stderr' of failed processes from their digests
+
+    Blobs carried by state are added to store, a dict-like of blobs by
+    digest kept by the receiver. Returns the digests that were added, for
+    acknowledging with the agent's ack_blobs op. Processes whose blob is
+    not in store get a stderr of None.
+    """
+    blobs = state.pop('blobs', None) or {}
+    added = [digest for digest in blobs if digest not in store]
+    store.update(blobs)
+
+    for proc in state.get('failed_processes') or ():
+        digest = proc.get('stderr_digest')
+        if digest is not None and 'stderr' not in proc:
+            proc['stderr'] = store.get(digest)
+            if proc['stderr'] is None:
+                log.debug("Missing stderr blob %s for %s", digest,
+                          proc.get('name'))
+    return added
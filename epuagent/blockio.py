@@ -0,0 +1,125 @@
+# Copyright 2013 University of Chicago
+
+"""Keeping blocking disk I/O off the gevent hub
+
+File reads are ordinary blocking syscalls, even with monkey patching, so
+a slow disk or NFS mount stalls every greenlet: heartbeats and dashi
+consumption included. ThreadedIO runs such calls in a bounded pool of
+real threads with a timeout. HubMonitor measures how long the hub is
+blocked anyway.
+"""
+
+import logging
+
+import gevent
+from gevent.threadpool import ThreadPool
+
+from epuagent.schedule import monotonic
+
+log = logging.getLogger(__name__)
+
+DEFAULT_IO_THREADS = 4
+DEFAULT_IO_TIMEOUT = 5.0
+
+DEFAULT_HUB_INTERVAL = 0.1
+
+
+class IOTimeout(EnvironmentError):
+    """Raised when blocking I/O doesn't finish in time
+    """
+
+
+class InlineIO(object):
+    """Runs blocking calls directly, for use outside the agent
+    """
+
+    def call(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def get_stats(self):
+        return None
+
+
+class ThreadedIO(object):
+    """Runs blocking calls in a pool of size threads
+
+    A call that takes more than timeout seconds, including any wait for a
+    free thread, raises IOTimeout. The thread itself can't be stopped and
+    carries on until the syscall returns, so at most size calls can be
+    stuck at once.
+    """
+
+    def __init__(self, size=DEFAULT_IO_THREADS, timeout=DEFAULT_IO_TIMEOUT):
+        self.pool = ThreadPool(size)
+        self.timeout = timeout
+
+        self.call_count = 0
+        self.timeouts = 0
+
+    def call(self, func, *args, **kwargs):
+        self.call_count += 1
+        timeout = gevent.Timeout(self.timeout)
+        timeout.start()
+        try:
+            return self.pool.spawn(func, *args, **kwargs).get()
+        except gevent.Timeout, t:
+            if t is not timeout:
+                raise
+            self.timeouts += 1
+            raise IOTimeout("%s took more than %s seconds" %
+                            (getattr(func, '__name__', func), self.timeout))
+        finally:
+            timeout.cancel()
+
+    def get_stats(self):
+        return {'call_count': self.call_count, 'timeouts': self.timeouts,
+                'threads': self.pool.size}
+
+
+def make_io(threads=DEFAULT_IO_THREADS, timeout=DEFAULT_IO_TIMEOUT):
+    """Returns ThreadedIO, or InlineIO if threads is 0
+    """
+    if not threads:
+        return InlineIO()
+    return ThreadedIO(threads, timeout)
+
+INLINE_IO = InlineIO()
+
+
+class HubMonitor(object):
+    """Measures hub blocking by how late a greenlet wakes from sleeping
+    interval seconds
+
+    Each wakeup's delay is added to the 'hub_blocked' histogram of stats.
+    """
+
+    def __init__(self, stats, interval=DEFAULT_HUB_INTERVAL):
+        self.stats = stats
+        self.interval = interval
+        self.greenlet = None
+
+        self.max_blocked_seconds = 0.0
+
+    def start(self):
+        self.greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
+
+    def _run(self):
+        interval = self.interval
+        while True:
+            start = monotonic()
+            gevent.sleep(interval)
+            self.record(monotonic() - start - interval)
+
+    def record(self, blocked):
+        blocked = max(0.0, blocked)
+        self.stats.add('hub_blocked', blocked)
+        if blocked > self.max_blocked_seconds:
+            self.max_blocked_seconds = blocked
+
+    def get_stats(self):
+        return {'max_blocked_seconds': self.max_blocked_seconds}
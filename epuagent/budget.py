@@ -0,0 +1,157 @@
+# Copyright 2013 University of Chicago
+
+"""Heartbeat size budget
+
+Keeps heartbeats under a size limit, such as a broker's frame size, by
+dropping the least important parts first:
+
+1. bulky measurements (agent_stats, process_stats)
+2. error text (stderr tails and stderr blobs), oldest failures first;
+   the last one cut may be shortened instead of dropped
+3. failed process records, oldest failures first
+
+The summary fields are always kept. What was left out is reported in
+the heartbeat's 'omitted' field, and processes whose error text was
+dropped have stderr_omitted set.
+
+Sizes are estimated from the state rather than measured by encoding it,
+so the check is cheap enough for every beat. The estimate is close to
+the size of the JSON encoding and above that of the binary codec.
+"""
+
+import logging
+
+log = logging.getLogger(__name__)
+
+MEASUREMENT_FIELDS = ('agent_stats', 'process_stats')
+
+
+class PayloadBudget(object):
+    """Trims heartbeat states to at most max_bytes
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.trimmed = 0
+
+    def apply(self, state):
+        """Returns state, or a trimmed copy if it is over budget
+        """
+        size = estimate_size(state)
+        excess = size - self.max_bytes
+        if excess <= 0:
+            return state
+
+        self.trimmed += 1
+        state = dict(state)
+        omitted = {'size': size}
+
+        fields = []
+        for key in MEASUREMENT_FIELDS:
+            if excess <= 0:
+                break
+            if key in state:
+                excess -= estimate_size(state.pop(key)) + len(key) + 6
+                fields.append(key)
+        if fields:
+            omitted['fields'] = fields
+
+        procs = state.get('failed_processes')
+        if procs and excess > 0:
+            procs = state['failed_processes'] = [dict(proc) for proc in procs]
+            excess = self._trim_errors(state, procs, excess, omitted)
+        if procs and excess > 0:
+            excess = self._trim_processes(state, procs, excess, omitted)
+
+        if excess > 0:
+            log.warn("Heartbeat is still %d bytes over its %d byte budget "
+                     "after trimming", excess, self.max_bytes)
+        state['omitted'] = omitted
+        return state
+
+    def _trim_errors(self, state, procs, excess, omitted):
+        blobs = state.get('blobs')
+        if blobs:
+            blobs = state['blobs'] = dict(blobs)
+
+        # each piece of error text, by the age of the newest failure using it
+        pieces = []
+        blob_ages = {}
+        for proc in procs:
+            age = proc.get('error_time') or 0
+            if proc.get('stderr'):
+                pieces.append((age, proc, None))
+            digest = proc.get('stderr_digest')
+            if blobs and digest in blobs:
+                blob_ages[digest] = max(age, blob_ages.get(digest, 0))
+        pieces.extend((age, None, digest)
+                      for digest, age in blob_ages.iteritems())
+        pieces.sort(key=lambda piece: piece[0])
+
+        count = 0
+        for age, proc, digest in pieces:
+            if excess <= 0:
+                break
+            count += 1
+            if proc is None:
+                excess -= estimate_size(blobs.pop(digest)) + len(digest) + 6
+                for p in procs:
+                    if p.get('stderr_digest') == digest:
+                        p['stderr_omitted'] = True
+                continue
+
+            text = proc['stderr']
+            size = estimate_size(text) - _NONE_SIZE
+            if size > excess:
+                # keep the end of the newest text that still fits; each
+                # character counts at least one byte
+                proc['stderr'] = text[excess:]
+                proc['stderr_truncated'] = True
+                excess = 0
+            else:
+                proc['stderr'] = None
+                proc['stderr_omitted'] = True
+                excess -= size
+
+        if blobs is not None and not blobs:
+            del state['blobs']
+        if count:
+            omitted['stderr'] = count
+        return excess
+
+    def _trim_processes(self, state, procs, excess, omitted):
+        procs.sort(key=lambda proc: proc.get('error_time') or 0)
+        count = 0
+        while procs and excess > 0:
+            excess -= estimate_size(procs.pop(0)) + 2
+            count += 1
+        omitted['failed_processes'] = count
+        return excess
+
+    def get_stats(self):
+        return {'max_bytes': self.max_bytes, 'trimmed': self.trimmed}
+
+
+def estimate_size(value):
+    """Estimates the encoded size of a heartbeat value in bytes
+
+    Counts JSON's quotes, separators and common escapes.
+    """
+    if isinstance(value, basestring):
+        return (len(value) + 2 + value.count('\n') + value.count('"') +
+                value.count('\\'))
+    if isinstance(value, dict):
+        size = 2
+        for key, item in value.iteritems():
+            size += len(key) + 6 + estimate_size(item)
+        return size
+    if isinstance(value, (list, tuple)):
+        size = 2
+        for item in value:
+            size += estimate_size(item) + 2
+        return size
+    if value is None or isinstance(value, bool):
+        return _NONE_SIZE
+    return 24
+
+_NONE_SIZE = 5
@@ -0,0 +1,156 @@
+# Copyright 2013 University of Chicago
+
+"""On-disk checkpoint of reported failures
+
+Lets a restarted agent remember which process failures it already
+reported, so it doesn't resend their stderr, and carry on its heartbeat
+sequence numbers where it left off.
+"""
+
+import os
+import json
+import logging
+import tempfile
+
+from epuagent.core import FailureRecord
+from epuagent.blockio import INLINE_IO
+from epuagent.schedule import monotonic
+
+log = logging.getLogger(__name__)
+
+CHECKPOINT_VERSION = 1
+
+# sequence numbers are reserved in blocks, so the checkpoint only has to
+# be written once per block rather than on every heartbeat
+DEFAULT_SEQUENCE_BLOCK = 1000
+
+# failure cache changes are saved at most this often
+DEFAULT_CHECKPOINT_INTERVAL = 30.0
+
+
+class Checkpoint(object):
+    """A failure cache and heartbeat sequence number saved to path
+
+    The file is replaced atomically, by writing a temporary file in the
+    same directory and renaming it over the old one. The whole cache is
+    written each time, so changes to it are saved at most once every
+    min_interval seconds, and by flush() on shutdown. Failures recorded
+    since the last save are reported again, stderr and all, if the agent
+    dies before the next one.
+
+    The saved sequence number is the end of a reserved block of sequence
+    numbers, and the file is written as soon as the block runs out, so
+    sequence numbers never go backwards across restarts.
+    """
+
+    def __init__(self, path, sequence_block=DEFAULT_SEQUENCE_BLOCK,
+                 min_interval=DEFAULT_CHECKPOINT_INTERVAL, clock=monotonic):
+        self.path = path
+        self.sequence_block = sequence_block
+        self.min_interval = min_interval
+        self.clock = clock
+
+        self.save_count = 0
+        self._saved_changes = None
+        self._saved_at = None
+        self._reserved = 0
+
+    def load(self):
+        """Returns (records, sequence) from the checkpoint
+
+        A missing or unreadable checkpoint gives ([], 0).
+        """
+        try:
+            f = open(self.path)
+        except IOError, e:
+            log.debug("No failure checkpoint at %s: %s", self.path, e)
+            return [], 0
+        try:
+            try:
+                data = json.load(f)
+                if data.get('version') != CHECKPOINT_VERSION:
+                    raise ValueError("unknown version %r" %
+                                     data.get('version'))
+                records = [FailureRecord(**record)
+                           for record in data['failures']]
+                sequence = int(data['sequence'])
+            except (ValueError, KeyError, TypeError), e:
+                log.warn("Ignoring bad failure checkpoint %s: %s",
+                         self.path, e)
+                return [], 0
+        finally:
+            f.close()
+
+        self._reserved = sequence
+        log.debug("Loaded %d failure(s) and sequence %d from %s",
+                  len(records), sequence, self.path)
+        return records, sequence
+
+    def update(self, fail_cache, sequence, io=INLINE_IO):
+        """Saves the checkpoint if the reserved sequence numbers ran out,
+        or if the failure cache changed and min_interval has passed
+
+        Returns True if it was written. Errors are logged, not raised.
+        """
+        if sequence < self._reserved:
+            if fail_cache.changes == self._saved_changes:
+                return False
+            if (self._saved_at is not None and
+                    self.clock() - self._saved_at < self.min_interval):
+                return False
+        return self.flush(fail_cache, sequence, io)
+
+    def flush(self, fail_cache, sequence, io=INLINE_IO):
+        """Saves the checkpoint if anything it holds has changed
+
+        Returns True if it was written. Errors are logged, not raised.
+        """
+        if (fail_cache.changes == self._saved_changes and
+                sequence < self._reserved):
+            return False
+        try:
+            self.save(fail_cache, sequence, io)
+        except EnvironmentError, e:
+            log.error("Failed to write failure checkpoint %s: %s",
+                      self.path, e)
+            return False
+        return True
+
+    def save(self, fail_cache, sequence, io=INLINE_IO):
+        """Writes the checkpoint
+
+        The cache is read here, and only the file is written through io.
+        """
+        reserved = sequence + self.sequence_block
+        data = {'version': CHECKPOINT_VERSION, 'sequence': reserved,
+                'failures': [record.to_dict()
+                             for record in fail_cache.records()]}
+        io.call(self._write, data)
+
+        self._saved_changes = fail_cache.changes
+        self._saved_at = self.clock()
+        self._reserved = reserved
+        self.save_count += 1
+
+    def _write(self, data):
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.checkpoint')
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            os.rename(tmp_path, self.path)
+        except:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def get_stats(self):
+        return {'save_count': self.save_count,
+                'reserved_sequence': self._reserved}
@@ -0,0 +1,266 @@
+# Copyright 2013 University of Chicago
+
+"""Heartbeat codecs
+
+A codec turns the heartbeat state dict into the value sent to dashi.
+DictCodec sends the dict as is. BinaryCodec packs it into a compact
+tagged binary format: well-known field names become small integers and
+the result is zlib compressed when it is large. decode() accepts both,
+so receivers can handle old and new agents side by side.
+"""
+
+import time
+import zlib
+import base64
+import struct
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_COMPRESS_THRESHOLD = 1024
+
+BINARY_CODEC = "binary"
+BINARY_VERSION = 1
+
+# Field names that are encoded as integer tags. A name's tag is its index
+# in this list plus one. Names may be appended without bumping
+# BINARY_VERSION, since decoders keep fields with tags they don't know
+# under the integer tag. Removing or reordering names needs a new
+# version.
+FIELDS = [
+    'node_id', 'timestamp', 'state', 'error', 'failed_processes',
+    'name', 'statename', 'exitcode', 'stop_timestamp', 'error_time',
+    'stderr', 'stderr_size', 'stderr_truncated', 'sequence', 'keyframe',
+    'changed', 'removed', 'processes_changed', 'processes_removed',
+    'period', 'supervisors', 'supervisor', 'process_count',
+    'process_stats', 'pid', 'cpu', 'cpu_avg', 'rss', 'rss_avg', 'fds',
+    'threads', 'vitals', 'load', 'mem_total', 'mem_available',
+    'swap_used', 'net_rx_rate', 'net_tx_rate', 'disks', 'total', 'free',
+    'blobs', 'stderr_digest', 'omitted', 'stderr_omitted',
+]
+_TAGS = dict((name, i + 1) for i, name in enumerate(FIELDS))
+
+# value types
+_NONE, _TRUE, _FALSE, _INT, _FLOAT, _BYTES, _UNICODE, _LIST, _DICT = range(9)
+
+# header flags
+_COMPRESSED = 0x01
+
+_DOUBLE = struct.Struct('>d')
+_HEADER = struct.Struct('>BB')
+
+
+class CodecError(Exception):
+    def __str__(self):
+        s = self.__doc__ or self.__class__.__name__
+        if self[0]:
+            s = '%s: %s' % (s, self[0])
+        return s
+
+
+class _Codec(object):
+    """Tracks the size and encode time of the last heartbeat
+    """
+
+    def __init__(self):
+        self.encode_count = 0
+        self.last_size = None
+        self.last_encode_seconds = None
+
+    def encode(self, state):
+        start = time.time()
+        encoded, size = self._encode(state)
+        self.last_encode_seconds = time.time() - start
+        self.last_size = size
+        self.encode_count += 1
+        return encoded
+
+    def get_stats(self):
+        return {'encode_count': self.encode_count,
+                'last_size': self.last_size,
+                'last_encode_seconds': self.last_encode_seconds}
+
+
+class DictCodec(_Codec):
+    """Sends heartbeats as plain dicts
+
+    The reported size is an estimate, as the real size depends on the
+    dashi serializer.
+    """
+    name = "dict"
+
+    def _encode(self, state):
+        return state, len(repr(state))
+
+
+class BinaryCodec(_Codec):
+    """Sends heartbeats as compact tagged binary, base64 wrapped so it
+    survives any dashi serializer
+    """
+    name = BINARY_CODEC
+
+    def __init__(self, compress_threshold=DEFAULT_COMPRESS_THRESHOLD):
+        _Codec.__init__(self)
+        self.compress_threshold = compress_threshold
+
+    def _encode(self, state):
+        data = pack(state, self.compress_threshold)
+        return {'codec': BINARY_CODEC, 'data': base64.b64encode(data)}, len(data)
+
+
+def get_codec(name, **kwargs):
+    if not name or name == DictCodec.name:
+        return DictCodec()
+    if name == BinaryCodec.name:
+        return BinaryCodec(**kwargs)
+    raise CodecError("unknown heartbeat codec %r" % name)
+
+def decode(heartbeat):
+    """Returns the state dict from a heartbeat sent with any codec
+    """
+    if heartbeat.get('codec') == BINARY_CODEC:
+        return unpack(base64.b64decode(heartbeat['data']))
+    return heartbeat
+
+
+def pack(value, compress_threshold=None):
+    chunks = []
+    _pack(value, chunks)
+    data = ''.join(chunks)
+
+    flags = 0
+    if compress_threshold is not None and len(data) > compress_threshold:
+        data = zlib.compress(data)
+        flags |= _COMPRESSED
+    return _HEADER.pack(BINARY_VERSION, flags) + data
+
+def unpack(data):
+    try:
+        version, flags = _HEADER.unpack_from(data)
+    except struct.error, e:
+        raise CodecError("bad header: %s" % e)
+    if version != BINARY_VERSION:
+        raise CodecError("unsupported binary heartbeat version %s" % version)
+
+    data = data[_HEADER.size:]
+    if flags & _COMPRESSED:
+        try:
+            data = zlib.decompress(data)
+        except zlib.error, e:
+            raise CodecError("bad compressed data: %s" % e)
+    try:
+        value, offset = _unpack(data, 0)
+    except (IndexError, struct.error), e:
+        raise CodecError("truncated heartbeat: %s" % e)
+    return value
+
+
+def _pack(value, chunks):
+    append = chunks.append
+    if value is None:
+        append(chr(_NONE))
+    elif value is True:
+        append(chr(_TRUE))
+    elif value is False:
+        append(chr(_FALSE))
+    elif isinstance(value, (int, long)):
+        append(chr(_INT))
+        append(_varint(value << 1 if value >= 0 else (-value << 1) - 1))
+    elif isinstance(value, float):
+        append(chr(_FLOAT))
+        append(_DOUBLE.pack(value))
+    elif isinstance(value, str):
+        append(chr(_BYTES))
+        append(_varint(len(value)))
+        append(value)
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+        append(chr(_UNICODE))
+        append(_varint(len(value)))
+        append(value)
+    elif isinstance(value, (list, tuple)):
+        append(chr(_LIST))
+        append(_varint(len(value)))
+        for item in value:
+            _pack(item, chunks)
+    elif isinstance(value, dict):
+        append(chr(_DICT))
+        append(_varint(len(value)))
+        for key, item in value.iteritems():
+            tag = _TAGS.get(key)
+            if tag is None:
+                append(_varint(1))
+                _pack(key, chunks)
+            else:
+                append(_varint(tag << 1))
+            _pack(item, chunks)
+    else:
+        raise CodecError("can't encode %r" % (value,))
+
+def _unpack(data, offset):
+    kind = ord(data[offset])
+    offset += 1
+    if kind == _NONE:
+        return None, offset
+    if kind == _TRUE:
+        return True, offset
+    if kind == _FALSE:
+        return False, offset
+    if kind == _INT:
+        n, offset = _read_varint(data, offset)
+        return (n >> 1) if not n & 1 else -((n + 1) >> 1), offset
+    if kind == _FLOAT:
+        return _DOUBLE.unpack_from(data, offset)[0], offset + _DOUBLE.size
+    if kind in (_BYTES, _UNICODE):
+        length, offset = _read_varint(data, offset)
+        value = data[offset:offset + length]
+        if len(value) != length:
+            raise CodecError("truncated string")
+        if kind == _UNICODE:
+            value = value.decode('utf-8')
+        return value, offset + length
+    if kind == _LIST:
+        length, offset = _read_varint(data, offset)
+        items = []
+        for i in xrange(length):
+            item, offset = _unpack(data, offset)
+            items.append(item)
+        return items, offset
+    if kind == _DICT:
+        length, offset = _read_varint(data, offset)
+        items = {}
+        for i in xrange(length):
+            key, offset = _read_varint(data, offset)
+            if key == 1:
+                key, offset = _unpack(data, offset)
+            else:
+                tag = key >> 1
+                if key & 1 or not tag:
+                    raise CodecError("bad field key %d" % key)
+                if tag <= len(FIELDS):
+                    key = FIELDS[tag - 1]
+                else:
+                    # from a newer agent
+                    key = tag
+            items[key], offset = _unpack(data, offset)
+        return items, offset
+    raise CodecError("unknown value type %d" % kind)
+
+def _varint(n):
+    out = []
+    while n > 0x7f:
+        out.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    out.append(chr(n))
+    return ''.join(out)
+
+def _read_varint(data, offset):
+    n = 0
+    shift = 0
+    while True:
+        b = ord(data[offset])
+        offset += 1
+        n |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return n, offset
+        shift += 7
@@ -1,27 +1,92 @@
 # Copyright 2013 University of Chicago
 
+import os
 import time
+import mmap
 import logging
+from collections import OrderedDict
 
-from epuagent.supervisor import RUNNING_STATES, SupervisorError
+from epuagent.stats import NO_STATS
+from epuagent.blockio import INLINE_IO
+from epuagent.supervisor import ProcessStates, RUNNING_STATES, \
+        STOPPED_STATES, SupervisorError, namespec
 
 log = logging.getLogger(__name__)
 
+# only the end of a failed process's stderr log is sent in the heartbeat
+DEFAULT_STDERR_MAX_BYTES = 16384
+
+DEFAULT_FAIL_CACHE_SIZE = 10000
+
 class EPUAgentCore(object):
     """Core state detection of EPU Agent
     """
-    def __init__(self, node_id, supervisor=None):
+    def __init__(self, node_id, supervisor=None,
+                 stderr_max_bytes=DEFAULT_STDERR_MAX_BYTES,
+                 stderr_max_lines=None, stderr_use_mmap=False,
+                 reconcile_seconds=None, process_sampler=None, vitals=None,
+                 stats=None, fail_cache_size=DEFAULT_FAIL_CACHE_SIZE,
+                 stderr_rpc=False, io=None):
         self.node_id = node_id
         self.supervisor = supervisor
 
+        self.stderr_max_bytes = stderr_max_bytes
+        self.stderr_max_lines = stderr_max_lines
+        self.stderr_use_mmap = stderr_use_mmap
+
+        # With stderr_rpc, stderr logs are tailed through supervisord
+        # rather than read from disk, so they needn't be readable by the
+        # agent. Processes already known to have failed (from the last
+        # query or from events) are tailed in the same multicall as the
+        # query; others are tailed together in one more call.
+        self.stderr_rpc = stderr_rpc
+        self._tails = None
+        self._pending_tails = None
+
         # We only want to send log information at first sign of failure.
         # After that we just send basic information declaring that the
         # process is still dead. Cache it here.
-        self.fail_cache = {}
+        self.fail_cache = FailureCache(fail_cache_size)
+
+        # When process state events are fed in with apply_event(), the
+        # process table is kept up to date between polls and supervisord
+        # is only queried every reconcile_seconds. Otherwise it is queried
+        # on every call to get_state().
+        self.reconcile_seconds = reconcile_seconds
+        self.process_table = None
+        self._process_index = None
+        self._table_time = None
+
+        # processes moving into or out of RUNNING_STATES, whether seen in
+        # a query or an event. The agent heartbeats early on these.
+        self.transitions = 0
+        self.last_transition_time = None
+        self._failed_names = None
+
+        # optional ProcessSampler, fed the process list after each query
+        self.process_sampler = process_sampler
+        self._last_procs = None
+
+        # optional NodeVitals, collected on every call to get_state()
+        self.vitals = vitals
+
+        # timing of the supervisord query, failure diffing (which includes
+        # stderr reads) and stderr reads
+        self.stats = stats or NO_STATS
+
+        # runs stderr reads and /proc sampling, which may block on disk;
+        # the agent passes a ThreadedIO to keep them off the gevent hub
+        self.io = io or INLINE_IO
 
     def get_state(self):
         state = self._base_state()
 
+        if self.vitals:
+            try:
+                state['vitals'] = self.io.call(self.vitals.collect)
+            except EnvironmentError, e:
+                log.warn("Failed to collect node vitals: %s", e)
+
         if not self.supervisor:
             return state
 
@@ -30,6 +95,18 @@ class EPUAgentCore(object):
             state.update(sup_errors)
         else:
             state['state'] = 'OK'
+
+        # a SupervisorGroup reports on each of its supervisord instances
+        sup_status = getattr(self.supervisor, 'status', None)
+        if sup_status:
+            state['supervisors'] = sup_status
+
+        if self.process_sampler and self._last_procs:
+            try:
+                state['process_stats'] = self.io.call(
+                        self.process_sampler.sample, self._last_procs)
+            except EnvironmentError, e:
+                log.warn("Failed to sample processes: %s", e)
         return state
 
     def _base_state(self):
@@ -45,29 +122,161 @@ class EPUAgentCore(object):
                 ret = {'state' : 'PROCESS_ERROR', 'failed_processes' : failed}
             else:
                 ret = None
+
+            # some, but not all, of a SupervisorGroup failed to answer
+            group_errors = getattr(self.supervisor, 'errors', None)
+            if group_errors:
+                ret = ret or {}
+                ret['state'] = 'MONITOR_ERROR'
+                ret['error'] = "; ".join("%s: %s" % item
+                                         for item in sorted(group_errors.items()))
             return ret
 
         except SupervisorError, e:
+            self.stats.incr('supervisor_errors')
+            self._last_procs = None
             log.error("Error querying supervisord: %s", e)
             ret = {'state' : 'MONITOR_ERROR', 'error' : str(e)}
+
+            # report failures from the last process table we did get
+            last_procs = getattr(self.supervisor, 'last_processes', None)
+            if last_procs is not None:
+                failed = self._diff_processes(last_procs)
+                if failed:
+                    ret['failed_processes'] = failed
+                ret['stale_since'] = self.supervisor.last_query_time
             return ret
 
+    def _query_processes(self):
+        now = time.time()
+        if (self.reconcile_seconds is None or self._table_time is None or
+                now - self._table_time >= self.reconcile_seconds):
+            with self.stats.timer('supervisor_query'):
+                procs = self._query_supervisor()
+            if self.reconcile_seconds is not None:
+                self.process_table = procs
+                self._process_index = dict((proc['name'], proc)
+                                           for proc in procs)
+                self._table_time = now
+            return procs
+        return self.process_table
+
+    def _query_supervisor(self):
+        self._tails = None
+        if self.stderr_rpc:
+            names = self._expected_failures()
+            query_with_tails = getattr(self.supervisor, 'query_with_tails',
+                                       None)
+            if names and query_with_tails:
+                procs, self._tails = query_with_tails(names,
+                                                      self.stderr_max_bytes)
+                return procs
+        return self.supervisor.query()
+
+    def _expected_failures(self):
+        """Returns namespecs of processes that are not running in the last
+        known process table and whose failure hasn't been reported yet
+        """
+        procs = self.process_table
+        if procs is None:
+            procs = self._last_procs
+        if not procs:
+            return None
+        return [namespec(proc) for proc in procs
+                if proc['state'] not in RUNNING_STATES and
+                proc['name'] not in self.fail_cache]
+
+    def apply_event(self, eventname, payload):
+        """Updates the process table from a supervisord PROCESS_STATE event
+
+        payload is the dict of tokens from the event body. Returns True
+        if the event moved a process into or out of RUNNING_STATES, or if
+        the process is not known yet.
+        """
+        if not eventname.startswith('PROCESS_STATE_'):
+            return False
+        statename = eventname[len('PROCESS_STATE_'):]
+        state = getattr(ProcessStates, statename, None)
+        if state is None:
+            return False
+
+        # a SupervisorGroup names processes after their supervisord
+        name = payload.get('processname')
+        event_process_name = getattr(self.supervisor, 'event_process_name',
+                                     None)
+        if event_process_name is not None:
+            name = event_process_name(payload)
+
+        proc = None
+        if self._process_index is not None and name is not None:
+            proc = self._process_index.get(name)
+        if proc is None:
+            self._table_time = None
+            self._transition(1)
+            return True
+
+        was_running = proc['state'] in RUNNING_STATES
+        proc['state'] = state
+        proc['statename'] = statename
+        if payload.get('pid'):
+            proc['pid'] = int(payload['pid'])
+
+        if state in STOPPED_STATES:
+            # the event doesn't carry exit status or spawn error, so get
+            # those from supervisord on the next query
+            self._table_time = None
+
+        if was_running == (state in RUNNING_STATES):
+            return False
+
+        # recorded here so the next query doesn't count it again
+        if self._failed_names is not None:
+            if was_running:
+                self._failed_names.add(proc['name'])
+            else:
+                self._failed_names.discard(proc['name'])
+        self._transition(1)
+        return True
+
+    def _transition(self, count):
+        self.transitions += count
+        self.last_transition_time = time.time()
+
     def _failed_processes(self):
-        procs = self.supervisor.query()
+        procs = self._query_processes()
+        self._last_procs = procs
+        return self._diff_processes(procs)
 
+    def _diff_processes(self, procs):
         failed = None
-        for proc in procs:
-            state = proc['state']
-            if state not in RUNNING_STATES:
-                proc_fail = self._one_process_failure(proc)
-                if failed is None:
-                    failed = [proc_fail]
+        self._pending_tails = None
+        with self.stats.timer('failure_diff'):
+            for proc in procs:
+                state = proc['state']
+                if state not in RUNNING_STATES:
+                    proc_fail = self._one_process_failure(proc)
+                    if failed is None:
+                        failed = [proc_fail]
+                    else:
+                        failed.append(proc_fail)
+
                 else:
-                    failed.append(proc_fail)
+                    # remove from failure list if present
+                    self.fail_cache.pop(proc['name'])
 
-            else:
-                # remove from failure list if present
-                self.fail_cache.pop(proc['name'], None)
+            # forget processes that are gone from supervisord
+            failed_names = set(f['name'] for f in failed or ())
+            if len(self.fail_cache) > len(failed_names):
+                self.fail_cache.prune(failed_names)
+
+            if self._pending_tails:
+                self._tail_pending()
+
+            if self._failed_names is not None:
+                changed = len(failed_names ^ self._failed_names)
+                if changed:
+                    self._transition(changed)
+            self._failed_names = failed_names
 
         nprocs = len(procs)
         log.debug("%d of %d supervised process(es) OK",
@@ -79,41 +288,214 @@ class EPUAgentCore(object):
         name = proc['name']
         prev = self.fail_cache.get(name)
 
-        if (prev and prev.get('state') == proc.get('state') and
-            prev.get('exitcode') == proc.get('exitstatus') and
-            prev.get('stop_timestamp') == proc.get('stop')):
-            return dict(prev)
+        if (prev and prev.state == proc.get('state') and
+            prev.exitcode == proc.get('exitstatus') and
+            prev.stop_timestamp == (proc.get('stop') or None)):
+            return prev.to_dict()
 
-        failure = {'name': proc.get('name'), 'state': proc.get('state'),
-                   'statename': proc.get('statename'),
-                   'exitcode': proc.get('exitstatus'),
-                   'stop_timestamp': proc.get('stop') or None,
-                   'error': proc.get('spawnerr'),
-                   'error_time' : time.time()}
+        record = FailureRecord(name, proc.get('state'), proc.get('statename'),
+                               proc.get('exitstatus'), proc.get('stop') or None,
+                               proc.get('spawnerr'), time.time())
 
         # store in cache then make a copy and add detailed error info
         # only want that the first time
 
-        self.fail_cache[name] = failure
-        failure = dict(failure)
+        self.fail_cache.put(record)
+        failure = record.to_dict()
+
+        if self.stderr_rpc and hasattr(self.supervisor, 'tail_stderr'):
+            spec = namespec(proc)
+            if self._tails and spec in self._tails:
+                self._set_stderr(failure, self._trim(self._tails[spec]))
+            elif self._pending_tails is None:
+                self._pending_tails = [(spec, failure)]
+            else:
+                self._pending_tails.append((spec, failure))
+            return failure
 
         stderr_path = proc.get('stderr_logfile')
         if stderr_path:
-            failure['stderr'] = _get_file(stderr_path)
+            with self.stats.timer('stderr_read'):
+                try:
+                    tail = self.io.call(_get_file, stderr_path,
+                                        self.stderr_max_bytes,
+                                        max_lines=self.stderr_max_lines,
+                                        use_mmap=self.stderr_use_mmap)
+                except EnvironmentError, e:
+                    log.warn("Failed to read %s: %s", stderr_path, e)
+                    tail = None
+            self._set_stderr(failure, tail)
 
         return failure
 
+    def _tail_pending(self):
+        """Tails the stderr logs of failures not covered by the query
+        """
+        pending = self._pending_tails
+        self._pending_tails = None
+        names = [spec for spec, failure in pending]
+        try:
+            with self.stats.timer('stderr_read'):
+                tails = self.supervisor.tail_stderr(names,
+                                                    self.stderr_max_bytes)
+        except SupervisorError, e:
+            log.warn("Failed to tail stderr logs: %s", e)
+            tails = {}
+        for spec, failure in pending:
+            self._set_stderr(failure, self._trim(tails.get(spec)))
+
+    def _trim(self, tail):
+        if tail is None or self.stderr_max_lines is None:
+            return tail
+        data, size, truncated = tail
+        data, trimmed = _tail_lines(data, self.stderr_max_lines)
+        return data, size, truncated or trimmed
+
+    def _set_stderr(self, failure, tail):
+        if tail is None:
+            failure['stderr'] = None
+        else:
+            failure['stderr'], failure['stderr_size'], \
+                    failure['stderr_truncated'] = tail
+
+
+class FailureRecord(object):
+    """What was last reported about a failed process
+    """
+    __slots__ = ('name', 'state', 'statename', 'exitcode', 'stop_timestamp',
+                 'error', 'error_time')
+
+    def __init__(self, name, state, statename, exitcode, stop_timestamp,
+                 error, error_time):
+        self.name = name
+        self.state = state
+        self.statename = statename
+        self.exitcode = exitcode
+        self.stop_timestamp = stop_timestamp
+        self.error = error
+        self.error_time = error_time
+
+    def to_dict(self):
+        return {'name': self.name, 'state': self.state,
+                'statename': self.statename, 'exitcode': self.exitcode,
+                'stop_timestamp': self.stop_timestamp, 'error': self.error,
+                'error_time': self.error_time}
+
+
+class FailureCache(object):
+    """FailureRecords by process name, least recently used first
+
+    Holds at most max_size records; the least recently used are evicted
+    beyond that. changes counts modifications, for checkpointing.
+    """
+
+    def __init__(self, max_size=DEFAULT_FAIL_CACHE_SIZE):
+        self.max_size = max_size
+        self.evictions = 0
+        self.changes = 0
+        self._records = OrderedDict()
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, name):
+        return name in self._records
+
+    def get(self, name):
+        record = self._records.pop(name, None)
+        if record is not None:
+            self._records[name] = record
+        return record
 
-def _get_file(path):
+    def put(self, record):
+        records = self._records
+        records.pop(record.name, None)
+        records[record.name] = record
+        self.changes += 1
+        while len(records) > self.max_size:
+            records.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, name):
+        record = self._records.pop(name, None)
+        if record is not None:
+            self.changes += 1
+        return record
+
+    def prune(self, keep):
+        """Removes all records whose names are not in keep
+        """
+        for name in self._records.keys():
+            if name not in keep:
+                del self._records[name]
+                self.changes += 1
+
+    def clear(self):
+        self._records.clear()
+        self.changes += 1
+
+    def records(self):
+        """Returns all records, least recently used first
+        """
+        return self._records.values()
+
+    def load(self, records):
+        for record in records:
+            self.put(record)
+
+    def get_stats(self):
+        return {'size': len(self._records), 'max_size': self.max_size,
+                'evictions': self.evictions}
+
+
+def _get_file(path, max_bytes=DEFAULT_STDERR_MAX_BYTES, max_lines=None,
+              use_mmap=False):
+    """Reads the end of a file in constant memory
+
+    Returns a (data, total_size, truncated) tuple, or None if the file
+    could not be read. At most max_bytes (and max_lines, if given) from
+    the end of the file are returned.
+    """
     if not path:
         return None
     f = None
     try:
-        f = open(path)
-        return f.read()
-    except IOError, e:
+        f = open(path, 'rb')
+        size = os.fstat(f.fileno()).st_size
+        start = max(0, size - max_bytes)
+
+        if use_mmap and size:
+            # map only the tail, from the page boundary before start, so
+            # huge logs don't need their size in address space
+            offset = start - start % mmap.ALLOCATIONGRANULARITY
+            m = mmap.mmap(f.fileno(), size - offset, access=mmap.ACCESS_READ,
+                          offset=offset)
+            try:
+                data = m[start - offset:]
+            finally:
+                m.close()
+        else:
+            f.seek(start)
+            data = f.read(size - start)
+
+        truncated = start > 0
+        if max_lines is not None:
+            data, trimmed = _tail_lines(data, max_lines)
+            truncated = truncated or trimmed
+
+        return data, size, truncated
+
+    except EnvironmentError, e:
         log.warn('Failed to read file: %s: %s', path, e)
         return None
     finally:
         if f:
             f.close()
+
+def _tail_lines(data, max_lines):
+    """Returns the last max_lines lines of data, and whether any were cut
+    """
+    lines = data.splitlines(True)
+    if len(lines) > max_lines:
+        return ''.join(lines[len(lines) - max_lines:]), True
+    return data, False
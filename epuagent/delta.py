@@ -0,0 +1,190 @@
+# Copyright 2013 University of Chicago
+
+"""Delta encoding of heartbeat state
+
+Every heartbeat message carries a sequence number. A keyframe message
+holds the complete state, as returned by EPUAgentCore.get_state(). Other
+messages hold only the top-level fields and failed processes that changed
+since the previous message. A receiver uses DeltaDecoder to rebuild the
+complete state and asks for a new keyframe when it misses a message.
+"""
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# fields sent in every message, changed or not
+ALWAYS_FIELDS = ('node_id', 'timestamp')
+
+# fields of a failed process record that are only sent once, at first
+# sign of failure. They are ignored when comparing records.
+ONCE_FIELDS = ('stderr', 'stderr_size', 'stderr_truncated', 'stderr_digest',
+               'stderr_omitted')
+
+
+class DeltaEncoder(object):
+    """Turns a series of full states into keyframes and deltas
+
+    A keyframe is sent every keyframe_interval messages, or on the next
+    message after request_keyframe() is called. A keyframe_interval of 1
+    disables delta encoding.
+    """
+
+    def __init__(self, keyframe_interval=1, sequence=0):
+        if keyframe_interval < 1:
+            raise ValueError("keyframe_interval must be at least 1")
+        self.keyframe_interval = keyframe_interval
+        self.sequence = sequence
+
+        self._last_fields = None
+        self._last_procs = None
+        self._since_keyframe = 0
+        self._keyframe_requested = True
+
+    def request_keyframe(self):
+        self._keyframe_requested = True
+
+    def encode(self, state):
+        """Returns the message to send for a full state
+        """
+        self.sequence += 1
+
+        fields, procs = _split(state)
+        keyframe = (self._keyframe_requested or
+                    self._since_keyframe + 1 >= self.keyframe_interval)
+
+        if keyframe:
+            msg = dict(state)
+            msg['keyframe'] = True
+            self._keyframe_requested = False
+            self._since_keyframe = 0
+        else:
+            msg = self._delta(fields, procs)
+            self._since_keyframe += 1
+
+        msg['sequence'] = self.sequence
+
+        self._last_fields = fields
+        self._last_procs = dict((name, _strip(proc))
+                                for name, proc in procs.iteritems())
+        return msg
+
+    def _delta(self, fields, procs):
+        msg = {'keyframe': False}
+        for key in ALWAYS_FIELDS:
+            if key in fields:
+                msg[key] = fields[key]
+
+        last_fields = self._last_fields
+        changed = dict((key, value) for key, value in fields.iteritems()
+                       if key not in ALWAYS_FIELDS and
+                       (key not in last_fields or last_fields[key] != value))
+        removed = [key for key in last_fields if key not in fields]
+        if changed:
+            msg['changed'] = changed
+        if removed:
+            msg['removed'] = removed
+
+        last_procs = self._last_procs
+        procs_changed = [proc for name, proc in procs.iteritems()
+                         if last_procs.get(name) != _strip(proc)]
+        procs_removed = [name for name in last_procs if name not in procs]
+        if procs_changed:
+            msg['processes_changed'] = procs_changed
+        if procs_removed:
+            msg['processes_removed'] = procs_removed
+        return msg
+
+
+class DeltaDecoder(object):
+    """Rebuilds full states from the messages of one DeltaEncoder
+
+    apply() returns None when a message can't be applied because one was
+    missed. The sender should then be asked for a keyframe.
+    """
+
+    def __init__(self):
+        self.sequence = None
+        self._fields = None
+        self._procs = None
+
+    def apply(self, msg):
+        sequence = msg.get('sequence')
+        if msg.get('keyframe'):
+            fields, procs = _split(msg)
+            fields.pop('keyframe', None)
+            fields.pop('sequence', None)
+            self._fields = fields
+            self._procs = procs
+            self.sequence = sequence
+            return self.state()
+
+        if self.sequence is None or sequence != self.sequence + 1:
+            log.debug("Missed heartbeat delta: have %s, got %s",
+                      self.sequence, sequence)
+            self.sequence = None
+            return None
+
+        for key in ALWAYS_FIELDS:
+            if key in msg:
+                self._fields[key] = msg[key]
+        self._fields.update(msg.get('changed', {}))
+        for key in msg.get('removed', ()):
+            self._fields.pop(key, None)
+
+        for proc in msg.get('processes_changed', ()):
+            self._procs[proc['name']] = proc
+        for name in msg.get('processes_removed', ()):
+            self._procs.pop(name, None)
+
+        self.sequence = sequence
+        return self.state()
+
+    def state(self):
+        if self._fields is None:
+            return None
+        state = dict(self._fields)
+        if self._procs:
+            state['failed_processes'] = self._procs.values()
+        return state
+
+
+def carry_once_fields(dropped, state):
+    """Returns state with the once-only fields of failed processes in a
+    dropped state that was never sent copied in
+
+    Only the same failure, by name and error_time, gets them, and only
+    when state doesn't carry them itself.
+    """
+    carried = {}
+    for proc in dropped.get('failed_processes') or ():
+        fields = dict((key, proc[key]) for key in ONCE_FIELDS if key in proc)
+        if fields:
+            carried[proc['name'], proc.get('error_time')] = fields
+    if not carried:
+        return state
+
+    procs = None
+    for i, proc in enumerate(state.get('failed_processes') or ()):
+        fields = carried.get((proc['name'], proc.get('error_time')))
+        if not fields or any(key in proc for key in ONCE_FIELDS):
+            continue
+        if procs is None:
+            state = dict(state)
+            procs = state['failed_processes'] = list(state['failed_processes'])
+        procs[i] = dict(proc, **fields)
+    return state
+
+
+def _split(state):
+    fields = dict(state)
+    procs = {}
+    for proc in fields.pop('failed_processes', None) or ():
+        procs[proc['name']] = proc
+    return fields, procs
+
+def _strip(proc):
+    if not any(key in proc for key in ONCE_FIELDS):
+        return proc
+    return dict((key, value) for key, value in proc.iteritems()
+                if key not in ONCE_FIELDS)
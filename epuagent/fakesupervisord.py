@@ -0,0 +1,286 @@
+# Copyright 2013 University of Chicago
+
+"""Stand-in supervisord XML-RPC server for offline load testing
+
+Serves the parts of the supervisord API the agent uses on a unix socket:
+getAllProcessInfo, shutdown, tailProcessStderrLog,
+tailProcessStdoutLog, readProcessStderrLog and system.multicall. The
+process table can be scripted, and latency, faults and state churn can
+be injected:
+
+    server = FakeSupervisord(path, count=5000, latency=0.2)
+    server.start()
+    sup = Supervisor("unix://" + path)
+    ...
+    server.stop()
+
+The throughput and latency scenarios in epuagent.bench drive the agent's
+Supervisor and EPUAgentCore against it.
+"""
+
+import os
+import time
+import random
+import socket
+import logging
+import threading
+import xmlrpclib
+import SocketServer
+import SimpleXMLRPCServer
+
+from epuagent.supervisor import ProcessStates
+
+log = logging.getLogger(__name__)
+
+DEFAULT_STDERR_BYTES = 4096
+
+# supervisord fault codes
+SHUTDOWN_STATE = 6
+BAD_NAME = 10
+FAILED = 30
+NO_FILE = 70
+
+_STATENAMES = dict((value, name) for name, value
+                   in vars(ProcessStates).items() if not name.startswith('_'))
+
+
+class UnixXMLRPCServer(SocketServer.ThreadingMixIn,
+                       SimpleXMLRPCServer.SimpleXMLRPCServer):
+    """Threaded XML-RPC server on a unix socket, keeping connections
+    open between requests like supervisord does
+    """
+    address_family = socket.AF_UNIX
+    daemon_threads = True
+
+    def __init__(self, path):
+        SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(self, path,
+                requestHandler=_RequestHandler, logRequests=False)
+        self.requests = []
+
+    def process_request(self, request, client_address):
+        self.requests.append(request)
+        SocketServer.ThreadingMixIn.process_request(self, request,
+                client_address)
+
+    def close_requests(self):
+        """Drops open client connections, as a restart would
+        """
+        for request in self.requests:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class _RequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = False
+
+    def address_string(self):
+        return self.server.server_address
+
+
+class FakeSupervisord(object):
+    """A scripted supervisord
+
+    The process table starts with count RUNNING processes, or is given as
+    processes, a list of dicts with at least 'name' and 'state'. If
+    script is given, a list of such tables, each getAllProcessInfo call
+    serves the next one and the last one is repeated.
+
+    Every call is delayed by latency seconds. getAllProcessInfo fails with
+    a FAILED fault with probability fault_rate, and before answering it
+    flips each process between RUNNING and FATAL with probability
+    churn_rate. Each process's stderr log holds stderr_bytes of text.
+    """
+
+    def __init__(self, path, count=0, processes=None, script=None,
+                 latency=0.0, fault_rate=0.0, churn_rate=0.0,
+                 stderr_bytes=DEFAULT_STDERR_BYTES, seed=None):
+        self.path = path
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.churn_rate = churn_rate
+        self.stderr_bytes = stderr_bytes
+        self.rng = random.Random(seed)
+
+        if processes is None:
+            processes = [{'name': 'proc%d' % i,
+                          'state': ProcessStates.RUNNING}
+                         for i in xrange(count)]
+        self.processes = [_process_info(proc) for proc in processes]
+        self.script = [[_process_info(proc) for proc in table]
+                       for table in script or ()]
+
+        self.shutting_down = False
+        self.call_count = 0
+        self.fault_count = 0
+
+        self._lock = threading.Lock()
+        self._logs = {}
+        self.server = None
+        self._thread = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = UnixXMLRPCServer(self.path)
+        server.register_function(self.getAllProcessInfo,
+                                 'supervisor.getAllProcessInfo')
+        server.register_function(self.shutdown, 'supervisor.shutdown')
+        server.register_function(self.tailProcessStderrLog,
+                                 'supervisor.tailProcessStderrLog')
+        server.register_function(self.tailProcessStdoutLog,
+                                 'supervisor.tailProcessStdoutLog')
+        server.register_function(self.readProcessStderrLog,
+                                 'supervisor.readProcessStderrLog')
+        server.register_multicall_functions()
+        self.server = server
+
+        self._thread = threading.Thread(target=server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.server.close_requests()
+        self.server = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    @property
+    def url(self):
+        return "unix://%s" % self.path
+
+    def set_processes(self, processes):
+        with self._lock:
+            self.processes = [_process_info(proc) for proc in processes]
+
+    # XML-RPC methods
+
+    def getAllProcessInfo(self):
+        self._called()
+        if self.fault_rate and self.rng.random() < self.fault_rate:
+            self.fault_count += 1
+            raise xmlrpclib.Fault(FAILED, "FAILED: injected fault")
+
+        with self._lock:
+            if self.script:
+                self.processes = self.script.pop(0)
+            if self.churn_rate:
+                self._churn()
+            now = int(time.time())
+            infos = []
+            for proc in self.processes:
+                info = dict(proc)
+                info['now'] = now
+                infos.append(info)
+            return infos
+
+    def shutdown(self):
+        self._called()
+        with self._lock:
+            self.shutting_down = True
+            for proc in self.processes:
+                _set_state(proc, ProcessStates.STOPPED)
+                proc['pid'] = 0
+        return True
+
+    def tailProcessStderrLog(self, name, offset, length):
+        self._called()
+        data = self._log(name)
+        overflow = len(data) > length
+        return [data[-length:] if length else '', len(data), overflow]
+
+    def tailProcessStdoutLog(self, name, offset, length):
+        self._called()
+        self._find(name)
+        return ['', 0, False]
+
+    def readProcessStderrLog(self, name, offset, length):
+        self._called()
+        data = self._log(name)
+        if offset < 0:
+            return data[offset:]
+        return data[offset:offset + length]
+
+    def _called(self):
+        self.call_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.shutting_down:
+            raise xmlrpclib.Fault(SHUTDOWN_STATE, "SHUTDOWN_STATE")
+
+    def _find(self, spec):
+        group, name = split_namespec(spec)
+        if name is not None:
+            for proc in self.processes:
+                if proc['group'] == group and proc['name'] == name:
+                    return proc
+        raise xmlrpclib.Fault(BAD_NAME, "BAD_NAME: %s" % spec)
+
+    def _log(self, spec):
+        proc = self._find(spec)
+        if not proc['stderr_logfile']:
+            raise xmlrpclib.Fault(NO_FILE, "NO_FILE: %s" % spec)
+        key = proc['group'], proc['name']
+        data = self._logs.get(key)
+        if data is None:
+            line = ("Traceback (most recent call last): %s failed\n" %
+                    proc['name'])
+            data = (line * (self.stderr_bytes // len(line) + 1))
+            data = data[:self.stderr_bytes]
+            self._logs[key] = data
+        return data
+
+    def _churn(self):
+        rand = self.rng.random
+        now = int(time.time())
+        for proc in self.processes:
+            if rand() >= self.churn_rate:
+                continue
+            if proc['state'] == ProcessStates.RUNNING:
+                _set_state(proc, ProcessStates.FATAL)
+                proc.update(exitstatus=1, stop=now, pid=0)
+            else:
+                _set_state(proc, ProcessStates.RUNNING)
+                proc.update(exitstatus=0, start=now, pid=1000)
+
+
+def split_namespec(spec):
+    """Returns (group, name) for a process name as supervisord resolves
+    it: "group:name", or a bare name for a group of the same name.
+    name is None for "group:" or "group:*".
+    """
+    group, sep, name = spec.partition(':')
+    if not sep:
+        return spec, spec
+    if not name or name == '*':
+        name = None
+    return group, name
+
+def _process_info(proc):
+    """Fills in a process dict the way supervisord reports it
+    """
+    name = proc['name']
+    state = proc.get('state', ProcessStates.RUNNING)
+    running = state == ProcessStates.RUNNING
+    info = {'name': name, 'group': proc.get('group', name),
+            'description': '', 'start': 0, 'stop': 0, 'now': 0,
+            'state': state, 'statename': _STATENAMES.get(state, 'UNKNOWN'),
+            'spawnerr': '', 'exitstatus': 0 if running else 1,
+            'logfile': '/var/log/%s.log' % name,
+            'stdout_logfile': '/var/log/%s.log' % name,
+            'stderr_logfile': '/var/log/%s-err.log' % name,
+            'pid': 1000 if running else 0}
+    info.update(proc)
+    return info
+
+def _set_state(proc, state):
+    proc['state'] = state
+    proc['statename'] = _STATENAMES.get(state, 'UNKNOWN')
@@ -0,0 +1,124 @@
+# Copyright 2013 University of Chicago
+
+"""supervisord event listener that forwards process state changes to
+the EPU Agent
+
+Run this under the supervisord being monitored, for example:
+
+    [eventlistener:epuagent]
+    command=epu-agent-listener
+    events=PROCESS_STATE
+
+Each event is sent to the agent's process_event operation, so the agent
+can report failures without waiting for its next poll.
+
+When the agent monitors several supervisord instances, each event says
+which one it came from: the name given with --supervisor, or else the
+SUPERVISOR_SERVER_URL supervisord sets for its listeners, which matches
+the socket URL in the agent's supervisor_sockets.
+"""
+
+import os
+import sys
+import uuid
+import logging
+import optparse
+
+from epuagent.util import get_config_paths
+
+log = logging.getLogger(__name__)
+
+
+def read_event(stdin):
+    """Reads one event from supervisord
+
+    Returns a (headers, payload) tuple of token dicts, or None at EOF.
+    """
+    line = stdin.readline()
+    if not line:
+        return None
+    headers = parse_tokens(line)
+    body = stdin.read(int(headers['len']))
+
+    # PROCESS_COMMUNICATION and log events have data after the tokens
+    payload_line = body.split('\n', 1)[0]
+    return headers, parse_tokens(payload_line)
+
+def parse_tokens(line):
+    tokens = {}
+    for token in line.split():
+        key, sep, value = token.partition(':')
+        if sep:
+            tokens[key] = value
+    return tokens
+
+def write_ready(stdout):
+    stdout.write('READY\n')
+    stdout.flush()
+
+def write_result(stdout, ok=True):
+    result = 'OK' if ok else 'FAIL'
+    stdout.write('RESULT %d\n%s' % (len(result), result))
+    stdout.flush()
+
+
+class EventListener(object):
+    """Speaks the supervisord event listener protocol over stdin/stdout
+    and hands PROCESS_STATE events to a callback
+    """
+
+    def __init__(self, callback, stdin=None, stdout=None):
+        self.callback = callback
+        self.stdin = stdin or sys.stdin
+        self.stdout = stdout or sys.stdout
+
+    def run(self):
+        while True:
+            write_ready(self.stdout)
+            event = read_event(self.stdin)
+            if event is None:
+                return
+            headers, payload = event
+            self.handle(headers['eventname'], payload)
+
+    def handle(self, eventname, payload):
+        ok = True
+        if eventname.startswith('PROCESS_STATE_'):
+            try:
+                self.callback(eventname, payload)
+            except Exception, e:
+                # supervisord will resend the event after a FAIL
+                log.error("Error forwarding %s event: %s", eventname, e,
+                          exc_info=True)
+                ok = False
+        write_result(self.stdout, ok)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [--supervisor NAME]")
+    parser.add_option("--supervisor", help="name of this supervisord in "
+                      "the agent's supervisor_sockets")
+    options, args = parser.parse_args(argv)
+    supervisor = (options.supervisor or
+                  os.environ.get('SUPERVISOR_SERVER_URL'))
+
+    import dashi.bootstrap as bootstrap
+
+    # stdout belongs to the event listener protocol
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    CFG = bootstrap.configure(get_config_paths(["epuagent"]))
+    agent_topic = CFG.epuagent.service_name
+    topic = "epu_agent_listener_%s" % uuid.uuid4()
+    dashi = bootstrap.dashi_connect(topic, CFG)
+
+    def forward(eventname, payload):
+        if supervisor:
+            payload = dict(payload, supervisor=supervisor)
+        dashi.fire(agent_topic, 'process_event', eventname=eventname,
+                   payload=payload)
+
+    EventListener(forward).run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# Copyright 2013 University of Chicago
+
+"""Bounded, coalescing hand-off between heartbeat sampling and publishing
+"""
+
+import logging
+from collections import deque
+
+import gevent.event
+
+log = logging.getLogger(__name__)
+
+DEFAULT_OUTBOX_SIZE = 1
+
+
+class Outbox(object):
+    """Holds at most maxsize states waiting to be published
+
+    When the publisher falls behind, the oldest waiting state is replaced
+    by the newest one, so a slow or blocked broker never holds up sampling
+    and memory stays bounded. If merge is given, merge(dropped, item)
+    returns what to keep of the next item to publish, so that anything
+    only sent once can be carried over from the dropped one.
+    """
+
+    def __init__(self, maxsize=DEFAULT_OUTBOX_SIZE, merge=None):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.maxsize = maxsize
+        self.merge = merge
+        self._items = deque(maxlen=maxsize)
+        self._ready = gevent.event.Event()
+
+        self.put_count = 0
+        self.coalesced = 0
+        self.published = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        if len(self._items) == self.maxsize:
+            self.coalesced += 1
+            dropped = self._items.popleft()
+            if self.merge is not None:
+                if self._items:
+                    self._items[0] = self.merge(dropped, self._items[0])
+                else:
+                    item = self.merge(dropped, item)
+        self._items.append(item)
+        self.put_count += 1
+        self._ready.set()
+
+    def get(self, timeout=None):
+        """Waits for and returns the oldest waiting item, or None on timeout
+        """
+        while not self._items:
+            self._ready.clear()
+            self._ready.wait(timeout)
+            if timeout is not None and not self._items:
+                return None
+        return self._items.popleft()
+
+    def run(self, publish):
+        """Publishes items as they arrive, forever
+
+        Items that fail to publish are dropped.
+        """
+        while True:
+            item = self.get()
+            try:
+                publish(item)
+                self.published += 1
+            except Exception, e:
+                self.dropped += 1
+                log.error('Error publishing heartbeat: %s', e, exc_info=True)
+
+    def get_stats(self):
+        return {'pending': len(self._items), 'put_count': self.put_count,
+                'coalesced': self.coalesced, 'published': self.published,
+                'dropped': self.dropped}
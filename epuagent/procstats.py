@@ -0,0 +1,231 @@
+# Copyright 2013 University of Chicago
+
+"""Resource usage sampling of supervised processes from /proc
+
+Sampling a process reads one file, /proc/<pid>/stat. Listing
+/proc/<pid>/fd to count open files costs about as much again, so it is
+only done every fd_interval ticks. In between, the last count is
+reported.
+
+A read costs some 10-20us, so sampling is also held to a time budget
+per tick. With many processes, each is sampled every few ticks and its
+last stats are reported in between.
+"""
+
+import os
+import time
+import logging
+from array import array
+from timeit import default_timer as timer
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WINDOW = 10
+DEFAULT_FD_INTERVAL = 10
+# seconds of /proc reading per tick; 0 or None samples every process
+DEFAULT_BUDGET = 0.0008
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# layout of one sample in a ring buffer
+CPU, RSS, FDS, THREADS = range(4)
+_NFIELDS = 4
+
+# offsets into /proc/<pid>/stat after the ")" closing the command name
+_STAT_UTIME = 11
+_STAT_STIME = 12
+_STAT_THREADS = 17
+_STAT_STARTTIME = 19
+_STAT_RSS = 21
+
+_READ_SIZE = 4096
+
+
+class ProcessSampler(object):
+    """Samples CPU, memory, open files and threads of processes
+
+    sample() is given the process list from supervisord on every tick. The
+    last window samples of each process are kept in a fixed-size ring
+    buffer, and the latest values and window averages are returned.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, proc_root='/proc',
+                 fd_interval=DEFAULT_FD_INTERVAL, budget=DEFAULT_BUDGET):
+        self.window = window
+        self.proc_root = proc_root
+        self.fd_interval = fd_interval
+        self.budget = budget
+        self._rings = {}
+        self._stats = {}
+        self._cursor = 0
+        self._tail = 0.0
+
+    def sample(self, procs):
+        """Samples processes that have a pid, for up to budget seconds
+
+        Processes are visited round-robin from where the last tick stopped,
+        and the last stats of those not reached are reported again. Returns
+        a dict of stats by process name.
+        """
+        deadline = None
+        if self.budget:
+            # leave time for the work after the reads, as last tick took
+            deadline = timer() + self.budget - self._tail
+        now = time.time()
+        live = [proc for proc in procs if proc.get('pid')]
+        count = len(live)
+        start = self._cursor % count if count else 0
+
+        sampled = 0
+        last = timer()
+        while sampled < count:
+            if deadline is not None and sampled:
+                # stop if another read like the last would overrun
+                current = timer()
+                if 2 * current - last > deadline:
+                    break
+                last = current
+            self._sample_one(live[(start + sampled) % count], now)
+            sampled += 1
+        self._cursor = start + sampled
+
+        tail_start = timer()
+        rings = self._rings
+        if len(rings) > count:
+            names = set(proc['name'] for proc in live)
+            for name in rings.keys():
+                if name not in names:
+                    del rings[name]
+                    self._stats.pop(name, None)
+        stats = dict(self._stats)
+        self._tail = timer() - tail_start
+        return stats
+
+    def _sample_one(self, proc, now):
+        pid = proc['pid']
+        name = proc['name']
+        rings = self._rings
+
+        base = "%s/%d" % (self.proc_root, pid)
+        raw = self._read(base)
+        if raw is None:
+            self._forget(name)
+            return
+        ticks, starttime, rss, threads = raw
+
+        ring = rings.get(name)
+        new = (ring is None or ring.pid != pid or
+               ring.starttime != starttime)
+        if new or ring.fd_ticks >= self.fd_interval:
+            fds = self._count_fds(base)
+            if fds is None:
+                self._forget(name)
+                return
+            fd_ticks = 1
+        else:
+            fds = ring.fds
+            fd_ticks = ring.fd_ticks + 1
+
+        if new:
+            ring = rings[name] = _Ring(pid, starttime, self.window)
+            cpu = None
+        else:
+            elapsed = now - ring.time
+            cpu = 0.0
+            if elapsed > 0:
+                cpu = 100.0 * (ticks - ring.ticks) / CLOCK_TICKS / elapsed
+            ring.push(cpu, rss, fds, threads)
+        ring.ticks = ticks
+        ring.time = now
+        ring.fds = fds
+        ring.fd_ticks = fd_ticks
+
+        proc_stats = {'pid': pid, 'cpu': cpu, 'rss': rss, 'fds': fds,
+                      'threads': threads}
+        if ring.count:
+            proc_stats['cpu_avg'] = ring.average(CPU)
+            proc_stats['rss_avg'] = ring.average(RSS)
+        self._stats[name] = proc_stats
+
+    def _forget(self, name):
+        self._rings.pop(name, None)
+        self._stats.pop(name, None)
+
+    def _read(self, base):
+        try:
+            stat = _read_small(base + "/stat")
+        except EnvironmentError, e:
+            # process exited
+            log.debug("Can't sample process %s: %s", base, e)
+            return None
+
+        fields = stat[stat.rindex(')') + 2:].split(None, _STAT_RSS + 1)
+        ticks = int(fields[_STAT_UTIME]) + int(fields[_STAT_STIME])
+        rss = int(fields[_STAT_RSS]) * PAGE_SIZE
+        return (ticks, int(fields[_STAT_STARTTIME]), rss,
+                int(fields[_STAT_THREADS]))
+
+    def _count_fds(self, base):
+        try:
+            return len(os.listdir(base + "/fd"))
+        except EnvironmentError, e:
+            # process exited or isn't ours to look at
+            log.debug("Can't sample process %s: %s", base, e)
+            return None
+
+
+class _Ring(object):
+    """Last samples of one process, stored in a flat array of doubles
+
+    Running sums of each field make averages cheap. They are recomputed
+    whenever the ring wraps around, so float error can't build up.
+    """
+    __slots__ = ('pid', 'starttime', 'ticks', 'time', 'fds', 'fd_ticks',
+                 'samples', 'sums', 'size', 'index', 'count')
+
+    def __init__(self, pid, starttime, size):
+        self.pid = pid
+        self.starttime = starttime
+        self.ticks = 0
+        self.time = 0.0
+        self.fds = 0
+        self.fd_ticks = 0
+        self.samples = array('d', [0.0]) * (size * _NFIELDS)
+        self.sums = array('d', [0.0]) * _NFIELDS
+        self.size = size
+        self.index = 0
+        self.count = 0
+
+    def push(self, cpu, rss, fds, threads):
+        offset = self.index * _NFIELDS
+        samples = self.samples
+        sums = self.sums
+        # unused slots hold zeros, so there's nothing to subtract
+        sums[CPU] += cpu - samples[offset + CPU]
+        sums[RSS] += rss - samples[offset + RSS]
+        sums[FDS] += fds - samples[offset + FDS]
+        sums[THREADS] += threads - samples[offset + THREADS]
+        samples[offset + CPU] = cpu
+        samples[offset + RSS] = rss
+        samples[offset + FDS] = fds
+        samples[offset + THREADS] = threads
+        self.index = (self.index + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+        if not self.index:
+            for field in xrange(_NFIELDS):
+                sums[field] = sum(samples[field::_NFIELDS])
+
+    def average(self, field):
+        if not self.count:
+            return None
+        return self.sums[field] / self.count
+
+
+def _read_small(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, _READ_SIZE)
+    finally:
+        os.close(fd)
@@ -0,0 +1,249 @@
+# Copyright 2013 University of Chicago
+
+"""Heartbeat scheduling
+"""
+
+import os
+import math
+import time
+import random
+import hashlib
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BACKOFF = 2.0
+
+# a tick is counted as late when it runs this fraction of the interval
+# after its deadline
+DEFAULT_LATE_FRACTION = 0.1
+
+# out-of-band heartbeats on process transitions are at least this many
+# seconds apart; well under the usual period, so they still come first
+DEFAULT_MIN_SPACING = 0.1
+
+
+def _monotonic_clock():
+    monotonic = getattr(time, 'monotonic', None)
+    if monotonic is not None:
+        return monotonic
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long),
+                        ('tv_nsec', ctypes.c_long)]
+
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or
+                            ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC = 1
+
+        def monotonic():
+            t = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return t.tv_sec + t.tv_nsec * 1e-9
+        monotonic()
+        return monotonic
+    except (AttributeError, OSError, TypeError):
+        log.debug("No monotonic clock available, using time.time")
+        return time.time
+
+monotonic = _monotonic_clock()
+
+
+class AdaptivePeriod(object):
+    """Heartbeat interval that stretches while node state is stable
+
+    Each call to update() with an unchanged state multiplies the interval
+    by backoff, up to max_period. Any change drops it back to min_period.
+    With no max_period the interval stays fixed at min_period.
+    """
+
+    def __init__(self, min_period, max_period=None, backoff=DEFAULT_BACKOFF):
+        if max_period is None or max_period < min_period:
+            max_period = min_period
+        self.min_period = min_period
+        self.max_period = max_period
+        self.backoff = backoff
+
+        self.interval = min_period
+        self._last_signature = None
+
+    def update(self, state):
+        """Returns the interval until the next heartbeat after this state
+        """
+        signature = state_signature(state)
+        if signature != self._last_signature:
+            self.interval = self.min_period
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_period)
+        self._last_signature = signature
+        return self.interval
+
+
+def state_signature(state):
+    """Returns the parts of a state that matter for change detection
+
+    Timestamps, measurements and one-time error details are left out.
+    """
+    failed = state.get('failed_processes')
+    if failed:
+        failed = sorted((proc.get('name'), proc.get('state'),
+                         proc.get('exitcode'), proc.get('stop_timestamp'))
+                        for proc in failed)
+
+    supervisors = state.get('supervisors')
+    if supervisors:
+        supervisors = sorted((name, status.get('state'))
+                             for name, status in supervisors.iteritems())
+
+    return (state.get('state'), state.get('error'), failed, supervisors)
+
+
+class FixedRateScheduler(object):
+    """Heartbeat deadlines at a fixed rate on the monotonic clock
+
+    Deadlines fall on a grid of the interval, so time spent heartbeating
+    doesn't push later beats back. Each node's grid is shifted by a phase
+    offset derived from its node_id, against the wall clock at startup,
+    so agents started together spread their beats across the interval
+    instead of firing in lockstep. Up to jitter seconds of random
+    variation are added to each deadline, without moving the grid.
+
+    Call next() for the next deadline, and fired() when it is acted on.
+    A tick run more than a tenth of the interval past its deadline is
+    counted as late; grid points that passed entirely while a beat was
+    running are skipped and counted as missed.
+    """
+
+    def __init__(self, node_id=None, jitter=0.0, clock=monotonic,
+                 wall_clock=time.time, rng=None,
+                 late_fraction=DEFAULT_LATE_FRACTION):
+        self.phase = phase_offset(node_id)
+        self.jitter = jitter
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self.late_fraction = late_fraction
+
+        now = clock()
+        self._wall_offset = wall_clock() - now
+        self._last = now
+        self._next = None
+        self._interval = None
+        self._deadline = None
+
+        self.ticks = 0
+        self.late = 0
+        self.missed = 0
+        self.max_late_seconds = 0.0
+
+    def next(self, interval):
+        """Returns the deadline for the tick after the last one fired
+        """
+        tick = self._grid_after(self._last, interval)
+        now = self.clock()
+        if tick < now:
+            # we fell behind; run the latest overdue tick and skip the rest
+            overdue = int((now - tick) / interval)
+            self.missed += overdue
+            tick += overdue * interval
+
+        deadline = tick
+        if self.jitter:
+            deadline += self.rng.uniform(-self.jitter, self.jitter)
+        self._next = tick
+        self._interval = interval
+        self._deadline = deadline
+        return deadline
+
+    def remaining(self, deadline):
+        return deadline - self.clock()
+
+    def fired(self):
+        """Records that the pending deadline was acted on
+        """
+        lateness = self.clock() - self._deadline
+        if lateness > self.late_fraction * self._interval:
+            self.late += 1
+        if lateness > self.max_late_seconds:
+            self.max_late_seconds = lateness
+        self.ticks += 1
+        self._last = self._next
+
+    def _grid_after(self, after, interval):
+        # grid points are where the wall clock, as of startup, is at
+        # phase of the way through an interval
+        shift = self.phase * interval - self._wall_offset
+        # the small bias keeps float rounding from returning after itself
+        k = math.floor((after - shift) / interval + 1e-9) + 1
+        return k * interval + shift
+
+    def get_stats(self):
+        return {'ticks': self.ticks, 'late': self.late,
+                'missed': self.missed,
+                'max_late_seconds': self.max_late_seconds,
+                'phase': self.phase}
+
+
+class BeatSpacing(object):
+    """Keeps out-of-band heartbeats min_spacing seconds apart
+
+    Regular beats don't count against the spacing; only those recorded
+    with beat() do. Also holds the state sampled by the last heartbeat of
+    any kind, so a heartbeat request can be answered from it while it is
+    at most max_age seconds old and no process transition has been seen
+    since.
+    """
+
+    def __init__(self, min_spacing=DEFAULT_MIN_SPACING, max_age=0.0,
+                 clock=monotonic):
+        self.min_spacing = min_spacing
+        self.max_age = max_age
+        self.clock = clock
+
+        self._last_beat = None
+        self._state_time = None
+        self._last_state = None
+        self._last_transitions = None
+
+    def beat(self):
+        """Records an out-of-band heartbeat
+        """
+        self._last_beat = self.clock()
+
+    def sampled(self, state, transitions=None):
+        """Records the state sampled by a heartbeat
+        """
+        self._state_time = self.clock()
+        self._last_state = state
+        self._last_transitions = transitions
+
+    def wait_time(self):
+        """Returns how long until another out-of-band heartbeat is allowed
+        """
+        if self._last_beat is None:
+            return 0.0
+        return max(0.0, self._last_beat + self.min_spacing - self.clock())
+
+    def recent_state(self, transitions=None):
+        """Returns the last sampled state if it is still fresh, else None
+        """
+        if self._last_state is None or transitions != self._last_transitions:
+            return None
+        if self.clock() - self._state_time > self.max_age:
+            return None
+        return self._last_state
+
+
+def phase_offset(node_id):
+    """Returns a fraction in [0, 1) that is stable for a node_id
+    """
+    if node_id is None:
+        return random.random()
+    digest = hashlib.md5(str(node_id)).hexdigest()
+    return int(digest[:8], 16) / float(1 << 32)
@@ -0,0 +1,274 @@
+# Copyright 2013 University of Chicago
+
+"""Fleet simulator: many virtual EPU Agents in one process
+
+Runs N EPUAgentCore instances against synthetic supervisors and
+publishes their heartbeats over one shared dashi connection, by default
+on dashi's memory:// transport so no broker is needed:
+
+    epu-agent-simulator --agents 1000 --processes 20 --duration 30
+
+A subscriber in the same process receives the heartbeats and reports
+the achieved message rate and end-to-end latency (from the heartbeat
+timestamp to receipt).
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import optparse
+import tempfile
+
+import gevent
+import gevent.event
+
+from epuagent.core import EPUAgentCore
+from epuagent.delta import DeltaEncoder
+from epuagent.codec import get_codec, decode
+from epuagent.stats import Histogram
+from epuagent.supervisor import ProcessStates
+
+log = logging.getLogger(__name__)
+
+DEFAULT_AMQP_URI = "memory://epuagent-simulator"
+
+
+class SyntheticSupervisor(object):
+    """Supervisor stand-in with a churning process table
+
+    On every query, each running process fails with probability
+    failure_rate and each failed process comes back with probability
+    flap_rate. Failed processes point at a shared stderr log.
+    """
+
+    def __init__(self, nprocs, failure_rate=0.0, flap_rate=0.0,
+                 stderr_logfile=None, rng=None):
+        self.failure_rate = failure_rate
+        self.flap_rate = flap_rate
+        self.stderr_logfile = stderr_logfile
+        self.rng = rng or random.Random()
+
+        self.processes = []
+        for i in xrange(nprocs):
+            self.processes.append({'name': 'proc%d' % i,
+                                   'group': 'proc%d' % i,
+                                   'pid': 1000 + i,
+                                   'state': ProcessStates.RUNNING,
+                                   'statename': 'RUNNING',
+                                   'exitstatus': 0, 'stop': 0,
+                                   'spawnerr': '',
+                                   'stderr_logfile': stderr_logfile})
+
+    def query(self):
+        now = int(time.time())
+        rand = self.rng.random
+        for proc in self.processes:
+            if proc['state'] == ProcessStates.RUNNING:
+                if self.failure_rate and rand() < self.failure_rate:
+                    proc.update(state=ProcessStates.FATAL, statename='FATAL',
+                                exitstatus=1, stop=now, pid=0)
+            elif self.flap_rate and rand() < self.flap_rate:
+                proc.update(state=ProcessStates.RUNNING, statename='RUNNING',
+                            exitstatus=0, pid=1000)
+        return [dict(proc) for proc in self.processes]
+
+
+class VirtualAgent(object):
+    """The sampling and encoding half of an EPUAgent
+    """
+
+    def __init__(self, node_id, supervisor, keyframe_interval=1,
+                 codec_name=None):
+        self.node_id = node_id
+        self.core = EPUAgentCore(node_id, supervisor=supervisor)
+        self.encoder = DeltaEncoder(keyframe_interval)
+        self.codec = get_codec(codec_name)
+
+    def beat(self):
+        return self.codec.encode(self.encoder.encode(self.core.get_state()))
+
+
+class SimSubscriber(object):
+    """Receives heartbeats and records counts and latency
+    """
+
+    def __init__(self, amqp_uri, op="heartbeat"):
+        import dashi.bootstrap as bootstrap
+        self.id = "simulator-subscriber-%s" % uuid.uuid4()
+        self.op = op
+        self.count = 0
+        self.latency = Histogram()
+        self.started = gevent.event.Event()
+        self.dashi = bootstrap.dashi_connect(self.id, amqp_uri=amqp_uri)
+
+    def start(self):
+        self.dashi.handle(self.heartbeat, self.op)
+        self.started.set()
+        try:
+            self.dashi.consume()
+        except gevent.GreenletExit:
+            pass
+
+    def heartbeat(self, heartbeat=None):
+        state = decode(heartbeat)
+        self.count += 1
+        self.latency.add(max(0.0, time.time() - state['timestamp']))
+
+
+class Fleet(object):
+    """N virtual agents beating every period seconds, plus or minus
+    jitter, over one shared dashi connection
+    """
+
+    def __init__(self, agents, dest, period, jitter=0.0,
+                 amqp_uri=DEFAULT_AMQP_URI, op="heartbeat", rng=None):
+        import dashi.bootstrap as bootstrap
+        self.agents = agents
+        self.dest = dest
+        self.op = op
+        self.period = period
+        self.jitter = jitter
+        self.rng = rng or random.Random()
+        self.sent = 0
+        self.errors = 0
+        self.dashi = bootstrap.dashi_connect(
+                "epu_agent_simulator_%s" % uuid.uuid4(), amqp_uri=amqp_uri)
+        self._greenlets = []
+
+    def start(self):
+        for agent in self.agents:
+            # spread the first beats across the period
+            delay = self.rng.uniform(0, self.period)
+            self._greenlets.append(gevent.spawn_later(delay, self._run,
+                                                      agent))
+
+    def stop(self):
+        gevent.killall(self._greenlets)
+        self._greenlets = []
+
+    def _run(self, agent):
+        while True:
+            try:
+                self.dashi.fire(self.dest, self.op, heartbeat=agent.beat())
+                self.sent += 1
+            except Exception, e:
+                self.errors += 1
+                log.error("Error heartbeating %s: %s", agent.node_id, e)
+            interval = self.period
+            if self.jitter:
+                interval += self.rng.uniform(-self.jitter, self.jitter)
+            gevent.sleep(max(0.0, interval))
+
+
+def simulate(nagents=100, nprocs=10, failure_rate=0.0, flap_rate=0.0,
+             stderr_bytes=0, period=1.0, jitter=0.0, duration=10.0,
+             keyframe_interval=1, codec_name=None,
+             amqp_uri=DEFAULT_AMQP_URI, seed=None):
+    """Runs a fleet for duration seconds and returns a report dict
+    """
+    rng = random.Random(seed)
+
+    stderr_path = None
+    if stderr_bytes:
+        fd, stderr_path = tempfile.mkstemp()
+        f = os.fdopen(fd, 'w')
+        try:
+            f.write("x" * stderr_bytes)
+        finally:
+            f.close()
+
+    subscriber = SimSubscriber(amqp_uri)
+    subscriber_glet = gevent.spawn(subscriber.start)
+    subscriber.started.wait()
+
+    agents = []
+    for i in xrange(nagents):
+        sup = SyntheticSupervisor(nprocs, failure_rate, flap_rate,
+                                  stderr_logfile=stderr_path,
+                                  rng=random.Random(rng.random()))
+        agents.append(VirtualAgent("sim-node-%d" % i, sup,
+                                   keyframe_interval=keyframe_interval,
+                                   codec_name=codec_name))
+    fleet = Fleet(agents, subscriber.id, period, jitter, amqp_uri=amqp_uri,
+                  rng=rng)
+
+    try:
+        start = time.time()
+        fleet.start()
+        gevent.sleep(duration)
+        fleet.stop()
+        # let in-flight heartbeats arrive
+        gevent.sleep(min(period, 1.0))
+        elapsed = time.time() - start
+    finally:
+        subscriber_glet.kill()
+        if stderr_path:
+            os.unlink(stderr_path)
+
+    latency = subscriber.latency.snapshot()
+    return {'agents': nagents, 'processes': nprocs,
+            'duration': elapsed, 'sent': fleet.sent,
+            'received': subscriber.count, 'errors': fleet.errors,
+            'sent_per_sec': fleet.sent / elapsed,
+            'received_per_sec': subscriber.count / elapsed,
+            'latency': latency}
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--agents", type="int", default=100)
+    parser.add_option("--processes", type="int", default=10,
+                      help="processes per agent")
+    parser.add_option("--failure-rate", type="float", default=0.0,
+                      help="chance a running process fails, per beat")
+    parser.add_option("--flap-rate", type="float", default=0.0,
+                      help="chance a failed process recovers, per beat")
+    parser.add_option("--stderr-bytes", type="int", default=0,
+                      help="size of failed processes' stderr logs")
+    parser.add_option("--period", type="float", default=1.0)
+    parser.add_option("--jitter", type="float", default=0.0)
+    parser.add_option("--duration", type="float", default=10.0)
+    parser.add_option("--keyframe-interval", type="int", default=1,
+                      help="send deltas between keyframes if above 1")
+    parser.add_option("--codec", default=None)
+    parser.add_option("--amqp-uri", default=DEFAULT_AMQP_URI)
+    parser.add_option("--seed", type="int", default=None)
+    parser.add_option("--json", action="store_true", default=False,
+                      help="print the report as JSON")
+    options, args = parser.parse_args(argv)
+
+    import gevent.monkey ; gevent.monkey.patch_all()
+    logging.basicConfig(level=logging.WARN)
+
+    report = simulate(nagents=options.agents, nprocs=options.processes,
+                      failure_rate=options.failure_rate,
+                      flap_rate=options.flap_rate,
+                      stderr_bytes=options.stderr_bytes,
+                      period=options.period, jitter=options.jitter,
+                      duration=options.duration,
+                      keyframe_interval=options.keyframe_interval,
+                      codec_name=options.codec, amqp_uri=options.amqp_uri,
+                      seed=options.seed)
+
+    if options.json:
+        json.dump(report, sys.stdout, indent=2)
+        print
+        return
+
+    latency = report['latency']
+    print "%d agents x %d processes for %.1fs" % (report['agents'],
+            report['processes'], report['duration'])
+    print "sent %d (%.1f msgs/s), received %d (%.1f msgs/s), %d errors" % (
+            report['sent'], report['sent_per_sec'], report['received'],
+            report['received_per_sec'], report['errors'])
+    if latency['count']:
+        print "latency p50 %.1fms p95 %.1fms p99 %.1fms max %.1fms" % (
+                latency['p50'] * 1e3, latency['p95'] * 1e3,
+                latency['p99'] * 1e3, latency['max'] * 1e3)
+
+if __name__ == "__main__":
+    main()
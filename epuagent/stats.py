@@ -0,0 +1,143 @@
+# Copyright 2013 University of Chicago
+
+"""Lightweight timing histograms and counters for the heartbeat loop
+"""
+
+import math
+import time
+from array import array
+
+# histogram buckets are spaced by a factor of 2**(1/4), roughly 19%,
+# from 1 microsecond up to about 2 minutes
+_BUCKET_BASE = 1e-6
+_BUCKETS_PER_DOUBLING = 4
+_NBUCKETS = 27 * _BUCKETS_PER_DOUBLING
+_LOG_SCALE = _BUCKETS_PER_DOUBLING / math.log(2)
+
+
+class Histogram(object):
+    """Fixed-size log-scale histogram of durations in seconds
+    """
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = array('l', [0]) * _NBUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds <= _BUCKET_BASE:
+            index = 0
+        else:
+            index = int(math.log(seconds / _BUCKET_BASE) * _LOG_SCALE) + 1
+            if index >= _NBUCKETS:
+                index = _NBUCKETS - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, pct):
+        """Returns the upper bound of the bucket holding the percentile
+        """
+        if not self.count:
+            return None
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                if index == _NBUCKETS - 1:
+                    # overflow bucket
+                    return self.max
+                bound = _BUCKET_BASE * 2 ** (float(index) /
+                                             _BUCKETS_PER_DOUBLING)
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.total, 'max': self.max,
+                'p50': self.percentile(50), 'p95': self.percentile(95),
+                'p99': self.percentile(99)}
+
+
+class Stats(object):
+    """Named timers and counters
+
+    Use timer() around a phase:
+
+        with stats.timer('publish'):
+            ...
+    """
+    enabled = True
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def timer(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        return _Timer(histogram)
+
+    def add(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(seconds)
+
+    def incr(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        return {'timers': dict((name, histogram.snapshot()) for name, histogram
+                               in self.histograms.iteritems()),
+                'counters': dict(self.counters)}
+
+
+class NullStats(object):
+    """Stats that records nothing, used when instrumentation is disabled
+    """
+    enabled = False
+
+    def timer(self, name):
+        return _NULL_TIMER
+
+    def add(self, name, seconds):
+        pass
+
+    def incr(self, name, n=1):
+        pass
+
+    def snapshot(self):
+        return None
+
+
+class _Timer(object):
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.histogram.add(time.time() - self.start)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+_NULL_TIMER = _NullTimer()
+NO_STATS = NullStats()
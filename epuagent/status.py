@@ -0,0 +1,202 @@
+# Copyright 2013 University of Chicago
+
+"""Local status endpoint
+
+Serves the agent's latest sampled state to local tools over HTTP, on a
+unix socket or a loopback port, so they don't each have to query
+supervisord:
+
+    GET /state   the latest get_state() result, as JSON
+    GET /stats   heartbeat loop timings, as JSON
+
+/state carries a weak ETag and an X-State-Sequence header. The sequence
+only advances when the state changes in a way that matters (see
+schedule.state_signature), so a reader sending If-None-Match gets a 304
+until something actually changes, even though timestamps and
+measurements in the body move on with every sample.
+"""
+
+import os
+import json
+import socket
+import logging
+
+from epuagent.schedule import state_signature
+
+log = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_BACKLOG = 16
+
+# the state includes stderr text, so only the agent's user may connect
+# to the unix socket by default
+DEFAULT_SOCKET_MODE = 0600
+
+
+class StatusSnapshot(object):
+    """The latest state, serialized on first request after each update
+    """
+
+    def __init__(self):
+        self.sequence = 0
+        self._state = None
+        self._signature = None
+        self._body = None
+
+    def update(self, state):
+        # a shallow copy, as the publisher adds to the state afterwards
+        self._state = dict(state)
+        self._body = None
+        signature = state_signature(state)
+        if self.sequence == 0 or signature != self._signature:
+            self.sequence += 1
+            self._signature = signature
+
+    @property
+    def etag(self):
+        return 'W/"%d"' % self.sequence
+
+    def body(self):
+        if self._state is None:
+            return None
+        if self._body is None:
+            self._body = _to_json(self._state)
+        return self._body
+
+
+class StatusServer(object):
+    """HTTP server for the status endpoint
+
+    address is either a filesystem path, for a unix socket created with
+    socket_mode permissions, or a (host, port) tuple with a loopback host.
+    get_stats is called for each /stats request.
+    """
+
+    def __init__(self, address, get_stats=None,
+                 socket_mode=DEFAULT_SOCKET_MODE):
+        if not isinstance(address, basestring):
+            _check_loopback(address[0])
+        self.address = address
+        self.socket_mode = socket_mode
+        self.get_stats = get_stats
+        self.snapshot = StatusSnapshot()
+        self.server = None
+
+        self.request_count = 0
+        self.not_modified = 0
+
+    def update(self, state):
+        self.snapshot.update(state)
+
+    def start(self):
+        from gevent.pywsgi import WSGIServer
+        if isinstance(self.address, basestring):
+            listener = _unix_listener(self.address, self.socket_mode)
+        else:
+            listener = self.address
+        self.server = WSGIServer(listener, self.application, log=None)
+        self.server.start()
+        log.debug("serving local status at %s", self.address)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+        if isinstance(self.address, basestring):
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+    def get_server_stats(self):
+        return {'sequence': self.snapshot.sequence,
+                'request_count': self.request_count,
+                'not_modified': self.not_modified}
+
+    def application(self, environ, start_response):
+        self.request_count += 1
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return _respond(start_response, '405 Method Not Allowed')
+
+        path = environ.get('PATH_INFO', '/')
+        if path in ('/', '/state'):
+            return self._state(environ, start_response)
+        if path == '/stats':
+            stats = self.get_stats() if self.get_stats else None
+            return _respond(start_response, '200 OK', _to_json(stats))
+        return _respond(start_response, '404 Not Found')
+
+    def _state(self, environ, start_response):
+        snapshot = self.snapshot
+        body = snapshot.body()
+        if body is None:
+            return _respond(start_response, '503 Service Unavailable')
+
+        headers = [('ETag', snapshot.etag),
+                   ('X-State-Sequence', str(snapshot.sequence))]
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and _etag_matches(if_none_match, snapshot.etag):
+            self.not_modified += 1
+            return _respond(start_response, '304 Not Modified',
+                            headers=headers)
+        return _respond(start_response, '200 OK', body, headers)
+
+
+def parse_address(value):
+    """Returns a unix socket path or a (host, port) tuple
+
+    Accepts "/path/to/socket", "host:port" or a bare port. The host must
+    be a loopback address, since the state is not meant for the network;
+    others raise ValueError.
+    """
+    value = str(value)
+    if value.startswith('/'):
+        return value
+    host, sep, port = value.rpartition(':')
+    if host.startswith('[') and host.endswith(']'):
+        host = host[1:-1]
+    host = host or DEFAULT_HOST
+    _check_loopback(host)
+    return (host, int(port))
+
+def _check_loopback(host):
+    if host == 'localhost' or host == '::1':
+        return
+    try:
+        if socket.inet_aton(host)[0] == '\x7f':
+            return
+    except socket.error:
+        pass
+    raise ValueError("status address %r is not a loopback address" % host)
+
+def _unix_listener(path, mode):
+    from gevent import socket as gsocket
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = gsocket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    # before listen(), so nobody can connect before the mode is set
+    os.chmod(path, mode)
+    sock.listen(DEFAULT_BACKLOG)
+    return sock
+
+def _etag_matches(header, etag):
+    tags = [tag.strip() for tag in header.split(',')]
+    # weak comparison: W/"1" matches "1"
+    bare = etag[2:]
+    return '*' in tags or etag in tags or bare in tags
+
+def _respond(start_response, status, body='', headers=None):
+    headers = list(headers or [])
+    if body:
+        headers.append(('Content-Type', 'application/json'))
+    headers.append(('Content-Length', str(len(body))))
+    start_response(status, headers)
+    return [body]
+
+def _to_json(value):
+    try:
+        return json.dumps(value)
+    except UnicodeDecodeError:
+        # stderr tails are raw bytes and may not be utf-8
+        return json.dumps(value, encoding='latin-1')
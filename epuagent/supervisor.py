@@ -1,12 +1,30 @@
 # Copyright 2013 University of Chicago
 
 from __future__ import absolute_import
+import time
+import socket
+import httplib
 import logging
 import xmlrpclib
-import supervisor.xmlrpc
+
+import gevent
+import gevent.pool
+from gevent.lock import Semaphore
 
 log = logging.getLogger(__name__)
 
+DEFAULT_POOL_SIZE = 8
+DEFAULT_ENDPOINT_TIMEOUT = 5.0
+
+DEFAULT_CALL_TIMEOUT = 5.0
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_RESET_SECONDS = 30.0
+
+# circuit breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
 # this state information is copied from supervisord source, to avoid
 # otherwise needless dependency
 class ProcessStates:
@@ -38,41 +56,504 @@ class Supervisor(object):
     directly from the service.
     """
 
-    def __init__(self, url, username=None, password=None):
+    def __init__(self, url, username=None, password=None,
+                 timeout=DEFAULT_CALL_TIMEOUT,
+                 failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_seconds=DEFAULT_RESET_SECONDS):
         self.url = url
         self.username = username
         self.password = password
 
+        # a single transport is kept for the life of this object so the
+        # underlying HTTP connection to supervisord is reused across calls
+        self._transport = None
+        self._server = None
+        self._lock = Semaphore()
+
+        self.connect_count = 0
+        self.call_count = 0
+        self.last_connect_seconds = None
+        self.last_call_seconds = None
+
+        # Each call must finish within timeout seconds. After
+        # failure_threshold calls in a row fail, the circuit opens and
+        # calls fail immediately for reset_seconds. Then a single probe
+        # call is let through; if it succeeds the circuit closes again.
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.breaker = CLOSED
+        self.failures = 0
+        self.last_error = None
+        self._opened_at = None
+
+        # result of the last successful query()
+        self.last_processes = None
+        self.last_query_time = None
+
     def _proxy(self):
-        transport = supervisor.xmlrpc.SupervisorTransport(self.username,
-                self.password, self.url)
-        return xmlrpclib.ServerProxy('http://127.0.0.1',
-                transport=transport)
+        if self._server is None:
+            self._transport = _TimedTransport(self.username, self.password,
+                    self.url, on_connect=self._connected,
+                    timeout=self.timeout)
+            self._server = xmlrpclib.ServerProxy('http://127.0.0.1',
+                    transport=self._transport)
+        return self._server
+
+    def _connected(self, seconds):
+        self.connect_count += 1
+        self.last_connect_seconds = seconds
+
+    def close(self):
+        """Drops the persistent connection to supervisord, if any
+        """
+        if self._transport is not None:
+            self._transport.close()
+        self._transport = None
+        self._server = None
+
+    def get_stats(self):
+        """Returns connection and call counters and latencies
+        """
+        return {'connect_count': self.connect_count,
+                'call_count': self.call_count,
+                'last_connect_seconds': self.last_connect_seconds,
+                'last_call_seconds': self.last_call_seconds,
+                'breaker': self.breaker,
+                'failures': self.failures}
 
     def query(self):
         """Checks supervisord for process information
         """
-        return self._safe_call(self._proxy().supervisor.getAllProcessInfo)
+        procs = self._safe_call('getAllProcessInfo')
+        self.last_processes = procs
+        self.last_query_time = time.time()
+        return procs
+
+    def query_with_tails(self, names, length):
+        """Checks supervisord for process information and gets the ends
+        of the named processes' stderr logs, all in one request
+
+        names are namespecs, as returned by namespec(). Returns (procs,
+        tails) where tails is as for tail_stderr().
+        """
+        calls = [_multicall_entry('getAllProcessInfo')]
+        calls.extend(_multicall_entry('tailProcessStderrLog', name, 0, length)
+                     for name in names)
+        results = self._safe_call('system.multicall', calls)
+
+        # each result is a fault dict or a one-item list holding the value
+        if isinstance(results[0], dict):
+            raise SupervisorError("Remote fault: %s" %
+                                  results[0].get('faultString'))
+        procs = results[0][0]
+        self.last_processes = procs
+        self.last_query_time = time.time()
+        return procs, _tails(names, results[1:])
+
+    def tail_stderr(self, names, length):
+        """Gets the ends of the named processes' stderr logs through
+        supervisord, in one request
+
+        names are namespecs, as returned by namespec(). Returns a dict
+        mapping each one to a (data, size, truncated) tuple, or to None if
+        supervisord couldn't tail that log.
+        """
+        calls = [_multicall_entry('tailProcessStderrLog', name, 0, length)
+                 for name in names]
+        return _tails(names, self._safe_call('system.multicall', calls))
 
     def shutdown(self):
         """Gracefully terminates all processes and the supervisor itself
         """
-        return self._safe_call(self._proxy().supervisor.shutdown)
+        return self._safe_call('shutdown')
+
+    def _safe_call(self, method_name, *args):
+        self._check_breaker()
+        try:
+            try:
+                result = self._call(method_name, *args)
 
-    def _safe_call(self, method, *args, **kwargs):
+            except xmlrpclib.Fault, e:
+                # supervisord answered, so it isn't counted as a failure
+                self._answered()
+                raise SupervisorError("Remote fault: %s" % e)
+
+            except SupervisorError, e:
+                raise self._failed(e)
+
+            except xmlrpclib.Error, e:
+                self.close()
+                raise self._failed(SupervisorError("XMLRPC error: %s" % e))
+
+            except Exception, e:
+                self.close()
+                raise self._failed(SupervisorError(
+                        "UNIX socket (%s) connection error: %s" %
+                        (self.url, e)))
+
+            self._answered()
+            return result
+
+        finally:
+            if self.breaker == HALF_OPEN:
+                # the probe was cut short, by an outer timeout or the
+                # greenlet being killed; probe again after reset_seconds
+                self.breaker = OPEN
+                self._opened_at = time.time()
+
+    def _answered(self):
+        if self.breaker != CLOSED:
+            log.info("supervisord at %s is answering again", self.url)
+        self.breaker = CLOSED
+        self.failures = 0
+
+    def _check_breaker(self):
+        if self.breaker == CLOSED:
+            return
+        if (self.breaker == OPEN and
+                time.time() - self._opened_at >= self.reset_seconds):
+            # let this call through as a probe
+            self.breaker = HALF_OPEN
+            return
+        raise SupervisorError("not calling supervisord at %s after %d "
+                              "failures; last error: %s" %
+                              (self.url, self.failures, self.last_error))
+
+    def _failed(self, error):
+        self.failures += 1
+        self.last_error = str(error)
+        if (self.breaker == HALF_OPEN or
+                self.failures >= self.failure_threshold):
+            if self.breaker != OPEN:
+                log.warn("Opening circuit to supervisord at %s: %s",
+                         self.url, error)
+            self.breaker = OPEN
+            self._opened_at = time.time()
+        return error
+
+    def _call(self, method_name, *args):
+        timeout = gevent.Timeout(self.timeout)
+        timeout.start()
+        try:
+            self._lock.acquire()
+            try:
+                try:
+                    return self._locked_call(method_name, *args)
+                except gevent.Timeout:
+                    # the connection may be left mid-request
+                    self.close()
+                    raise
+            finally:
+                self._lock.release()
+        except gevent.Timeout, t:
+            if t is not timeout:
+                raise
+            raise SupervisorError("no response in %s seconds" % self.timeout)
+        finally:
+            timeout.cancel()
+
+    def _locked_call(self, method_name, *args):
+        proxy = self._proxy()
+        reused = self._transport.connection is not None
+
+        try:
+            return self._timed_call(proxy, method_name, *args)
+        except (socket.error, httplib.HTTPException), e:
+            if not reused:
+                raise
+            # supervisord may have restarted since the connection was
+            # opened. Reconnect and retry once.
+            log.debug("Stale connection to supervisord (%s), reconnecting",
+                      e)
+            self.close()
+            return self._timed_call(self._proxy(), method_name, *args)
+
+    def _timed_call(self, proxy, method_name, *args):
+        if '.' not in method_name:
+            method_name = 'supervisor.' + method_name
+        method = getattr(proxy, method_name)
+        start = time.time()
         try:
-            return method(*args, **kwargs)
+            return method(*args)
+        finally:
+            self.call_count += 1
+            self.last_call_seconds = time.time() - start
+
+
+def namespec(proc):
+    """Returns the name supervisord knows a process info dict by
+
+    Processes are looked up as group:name, and a bare name only finds a
+    process in a group of the same name, which numprocs programs are not.
+    """
+    group = proc.get('group')
+    if group:
+        return "%s:%s" % (group, proc['name'])
+    return proc['name']
+
+def _prefixed(name, procs):
+    """Copies of a group member's process dicts, named after it
+    """
+    return [dict(proc, name="%s/%s" % (name, proc['name']), supervisor=name)
+            for proc in procs]
+
+def _merge_tails(tails, pairs, sup_tails):
+    for inner, outer in pairs:
+        tails[outer] = sup_tails.get(inner)
+
+def _multicall_entry(method_name, *args):
+    return {'methodName': 'supervisor.' + method_name, 'params': list(args)}
 
+def _tails(names, results):
+    tails = {}
+    for name, result in zip(names, results):
+        if isinstance(result, dict):
+            # a fault, such as NO_FILE for a process without a stderr log
+            log.debug("Can't tail stderr of %s: %s", name,
+                      result.get('faultString'))
+            tails[name] = None
+            continue
+        data, offset, overflow = result[0]
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        # offset is where the log ends, which is its size
+        tails[name] = (data, offset, bool(overflow))
+    return tails
 
-        except xmlrpclib.Fault, e:
-            raise SupervisorError("Remote fault: %s" % e)
 
-        except xmlrpclib.Error, e:
-            raise SupervisorError("XMLRPC error: %s" % e)
+class _TimedTransport(object):
+    """Wraps a SupervisorTransport to report how long each new connection
+    takes, set a socket timeout on it, and drop it on errors so the next
+    request reconnects
+
+    supervisor.xmlrpc is only imported once a transport is needed.
+    """
+
+    def __init__(self, username, password, serverurl, on_connect=None,
+                 timeout=None):
+        import supervisor.xmlrpc
+        self.transport = supervisor.xmlrpc.SupervisorTransport(username,
+                password, serverurl)
+
+        get_connection = self.transport._get_connection
+        def timed_get_connection():
+            connection = get_connection()
+            start = time.time()
+            try:
+                connection.connect()
+                # bounds each socket operation even without monkey patching
+                connection.sock.settimeout(timeout)
+            except:
+                connection.close()
+                raise
+            if on_connect:
+                on_connect(time.time() - start)
+            return connection
+        self.transport._get_connection = timed_get_connection
+
+    @property
+    def connection(self):
+        return self.transport.connection
+
+    def request(self, host, handler, request_body, verbose=0):
+        try:
+            return self.transport.request(host, handler, request_body,
+                                          verbose)
+        except xmlrpclib.Fault:
+            # a fault is a complete response; the connection is still good
+            raise
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        if self.transport.connection is not None:
+            try:
+                self.transport.connection.close()
+            except Exception:
+                pass
+        self.transport.connection = None
+
+
+class SupervisorGroup(object):
+    """Several supervisord instances queried in parallel as one
+
+    Each supervisor is given a name, which is prefixed to the names of its
+    processes ("name/process"). A supervisor that fails or doesn't answer
+    within timeout seconds is reported in errors and status, so it doesn't
+    hold up the others. Its processes are reported from the last table it
+    did return, if any, so their failures aren't forgotten and reported
+    afresh when it comes back.
+    """
+
+    def __init__(self, supervisors, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_ENDPOINT_TIMEOUT):
+        self.supervisors = list(supervisors)
+        self.timeout = timeout
+        self.pool = gevent.pool.Pool(pool_size)
+
+        # results of the last query, by supervisor name
+        self.errors = {}
+        self.status = {}
+
+        # result of the last query() that reached any supervisor
+        self.last_processes = None
+        self.last_query_time = None
+
+    def query(self):
+        """Checks all supervisord instances for process information
+
+        Raises SupervisorError only if none of them could be queried.
+        """
+        return self._query_all({}, None)[0]
+
+    def query_with_tails(self, names, length):
+        """Checks all supervisord instances for process information and
+        gets the ends of the named processes' stderr logs, with one request
+        to each
+
+        names are namespecs of processes as query() names them. Returns
+        (procs, tails) as for Supervisor.query_with_tails().
+        """
+        return self._query_all(self._by_supervisor(names), length)
+
+    def tail_stderr(self, names, length):
+        """Gets the ends of the named processes' stderr logs, with one
+        request to each supervisord involved
+
+        Logs that couldn't be tailed, including those of supervisors that
+        failed to answer, map to None.
+        """
+        specs = self._by_supervisor(names)
+        tails = dict((name, None) for name in names)
+        greenlets = [(self.pool.spawn(self._call_one, sup, 'tail_stderr',
+                                      [inner for inner, outer in pairs],
+                                      length), pairs)
+                     for (name, sup), pairs in specs.iteritems()]
+        for greenlet, pairs in greenlets:
+            greenlet.join()
+            if greenlet.successful() and greenlet.value[1] is None:
+                _merge_tails(tails, pairs, greenlet.value[0])
+        return tails
+
+    def event_process_name(self, payload):
+        """Returns the name query() gives the process a forwarded state
+        event is about, or None if the event doesn't say which
+        supervisord sent it
+
+        epu-agent-listener puts the supervisor's name or socket URL in
+        the payload's 'supervisor' token.
+        """
+        supervisor = payload.get('supervisor')
+        if supervisor is None:
+            return None
+        for name, sup in self.supervisors:
+            if supervisor == name or supervisor == getattr(sup, 'url', None):
+                return "%s/%s" % (name, payload.get('processname'))
+        return None
+
+    def _query_all(self, specs, length):
+        greenlets = []
+        for name, sup in self.supervisors:
+            pairs = specs.get((name, sup))
+            if pairs and hasattr(sup, 'query_with_tails'):
+                greenlets.append(self.pool.spawn(self._call_one, sup,
+                        'query_with_tails', [inner for inner, outer in pairs],
+                        length))
+            else:
+                greenlets.append(self.pool.spawn(self._call_one, sup,
+                                                 'query'))
+        gevent.joinall(greenlets)
+
+        procs = []
+        tails = {}
+        errors = {}
+        status = {}
+        for (name, sup), greenlet in zip(self.supervisors, greenlets):
+            if greenlet.successful():
+                result, error = greenlet.value
+            else:
+                result, error = None, str(greenlet.exception)
+
+            if error is None:
+                if isinstance(result, tuple):
+                    sup_procs, sup_tails = result
+                    _merge_tails(tails, specs[name, sup], sup_tails)
+                else:
+                    sup_procs = result
+                procs.extend(_prefixed(name, sup_procs))
+                status[name] = {'state': 'OK',
+                                'process_count': len(sup_procs)}
+                continue
+
+            errors[name] = error
+            status[name] = {'state': 'MONITOR_ERROR', 'error': error}
+            last_procs = getattr(sup, 'last_processes', None)
+            if last_procs is not None:
+                procs.extend(_prefixed(name, last_procs))
+                status[name]['stale_since'] = sup.last_query_time
+
+        self.errors = errors
+        self.status = status
+
+        if errors and len(errors) == len(self.supervisors):
+            raise SupervisorError("; ".join("%s: %s" % (name, errors[name])
+                                            for name, sup in self.supervisors))
+        self.last_processes = procs
+        self.last_query_time = time.time()
+
+        # logs of supervisors that didn't answer can't be tailed
+        for pairs in specs.itervalues():
+            for inner, outer in pairs:
+                tails.setdefault(outer, None)
+        return procs, tails
+
+    def _by_supervisor(self, names):
+        """Groups namespecs by the supervisor they belong to, as lists of
+        (spec at that supervisor, spec as given) pairs
+        """
+        specs = {}
+        for spec in names:
+            group, sep, rest = spec.partition(':')
+            for name, sup in self.supervisors:
+                prefix = name + '/'
+                if sep and rest.startswith(prefix):
+                    inner = "%s:%s" % (group, rest[len(prefix):])
+                elif spec.startswith(prefix):
+                    inner = spec[len(prefix):]
+                else:
+                    continue
+                specs.setdefault((name, sup), []).append((inner, spec))
+                break
+        return specs
+
+    def _call_one(self, sup, method_name, *args):
+        timeout = gevent.Timeout(self.timeout)
+        timeout.start()
+        try:
+            return getattr(sup, method_name)(*args), None
+        except gevent.Timeout, t:
+            if t is not timeout:
+                raise
+            # the connection may be left mid-request
+            sup.close()
+            return None, "no response in %s seconds" % self.timeout
+        except SupervisorError, e:
+            return None, str(e)
+        finally:
+            timeout.cancel()
+
+    def shutdown(self):
+        """Gracefully terminates all supervisord instances
+        """
+        for name, sup in self.supervisors:
+            sup.shutdown()
+
+    def close(self):
+        for name, sup in self.supervisors:
+            sup.close()
 
-        except Exception, e:
-            raise SupervisorError("UNIX socket (%s) connection error: %s"
-                                  % (self.url, e))
 
 class SupervisorError(Exception):
     def __str__(self):
@@ -83,4 +564,4 @@ class SupervisorError(Exception):
 
 
 __all__ = ['ProcessStates', 'STOPPED_STATES', 'RUNNING_STATES', 'Supervisor',
-           'SupervisorError']
+           'SupervisorGroup', 'SupervisorError']
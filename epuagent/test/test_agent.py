@@ -10,6 +10,7 @@ import tempfile
 import unittest
 import threading
 import subprocess
+import time
 import os
 
 from time import sleep
@@ -25,6 +26,9 @@ log = logging.getLogger(__name__)
 
 NODE_ID = "the_node_id"
 
+# agents start during VM boot, so the first heartbeat has to be quick
+TIME_TO_FIRST_HEARTBEAT = 2.0
+
 
 SUPERVISORD_CONF = """
 [program:proc1]
@@ -119,6 +123,20 @@ class EPUAgentIntegrationTests(unittest.TestCase):
         self.assertBasics(self.subscriber.last_beat, "MONITOR_ERROR")
         log.debug(self.subscriber.last_beat)
 
+    def test_time_to_first_heartbeat(self):
+        start = time.time()
+
+        sock = os.path.join(tempfile.gettempdir(), str(uuid.uuid4()))
+        sock = "unix://%s" % sock
+        self.subscriber.started.wait()
+        self._setup_agent(sock, start_heartbeat=True)
+
+        self.subscriber.did_beat.wait(TIME_TO_FIRST_HEARTBEAT)
+        elapsed = time.time() - start
+        self.assertTrue(self.subscriber.did_beat.is_set(),
+                        "no heartbeat in %s seconds" % TIME_TO_FIRST_HEARTBEAT)
+        log.debug("time to first heartbeat: %.3fs", elapsed)
+
     def test_send_error(self):
         # just ensure exception doesn't bubble up where it would
         # terminate the LoopingCall
@@ -133,6 +151,23 @@ class EPUAgentIntegrationTests(unittest.TestCase):
 
         agent.heartbeat()
     
+    def test_event_beats_before_schedule(self):
+        sock = os.path.join(tempfile.gettempdir(), str(uuid.uuid4()))
+        sock = "unix://%s" % sock
+        agent = self._setup_agent(sock, start_heartbeat=True)
+        self.assertTrue(self.subscriber.did_beat.wait(TIME_TO_FIRST_HEARTBEAT))
+        self.subscriber.did_beat.clear()
+        count = self.subscriber.beat_count
+
+        # the regular beat just ran; the event's beat doesn't wait for
+        # the 2 second period
+        start = time.time()
+        agent.process_event('PROCESS_STATE_FATAL',
+                            {'processname': 'proc1', 'from_state': 'RUNNING'})
+        self.assertTrue(self.subscriber.did_beat.wait(1.0))
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertEqual(count + 1, self.subscriber.beat_count)
+
     def test_everything(self):
 
         self._setup_supervisord()
@@ -214,13 +249,13 @@ class EPUAgentIntegrationTests(unittest.TestCase):
         rc = subprocess.call([supd_exe, '-c', conf])
         self.assertEqual(0, rc, "supervisord didn't start ok!")
 
-    def _setup_agent(self, socket_path):
+    def _setup_agent(self, socket_path, start_heartbeat=False):
         spawnargs = {
             'heartbeat_dest': self.subscriber.id,
             'heartbeat_op': 'beat',
             'node_id': NODE_ID,
             'period_seconds': 2.0,
-            'start_heartbeat': False,
+            'start_heartbeat': start_heartbeat,
             'supervisor_socket': socket_path,
             'amqp_uri': self.amqp_uri}
         agent = EPUAgent(**spawnargs)
@@ -0,0 +1,49 @@
+# Copyright 2013 University of Chicago
+
+import unittest
+
+from epuagent.bench import BenchSupervisor, measure, bench_get_state, \
+        bench_one_process_failure, bench_get_file
+from epuagent.supervisor import RUNNING_STATES
+
+class BenchTests(unittest.TestCase):
+    def test_supervisor(self):
+        procs = BenchSupervisor(10, 0.3).query()
+        self.assertEqual(10, len(procs))
+        self.assertEqual(7, len([p for p in procs
+                                 if p['state'] in RUNNING_STATES]))
+
+    def test_measure(self):
+        calls = []
+        result = measure("x", lambda: calls.append(1), min_seconds=0,
+                         max_iterations=5)
+        self.assertTrue(1 <= result.iterations <= 5)
+        self.assertEqual(result.iterations + 1, len(calls))
+        self.assertEqual(set(['name', 'iterations', 'ops_per_sec', 'p50',
+                              'p90', 'p99', 'max', 'retained_objects',
+                              'budget', 'over_budget']),
+                         set(result.to_dict()))
+
+    def test_budget(self):
+        result = measure("x", lambda: None, min_seconds=0, max_iterations=5)
+        self.assertFalse(result.over_budget)
+        result = measure("x", lambda: None, min_seconds=0, max_iterations=5,
+                         budget=0)
+        self.assertTrue(result.over_budget)
+
+    def test_retained_objects(self):
+        garbage = []
+        result = measure("x", lambda: garbage.append(None), min_seconds=0,
+                         max_iterations=1000)
+        self.assertTrue(abs(result.retained_objects) < 0.1)
+
+        kept = []
+        result = measure("x", lambda: kept.append([]), min_seconds=0,
+                         max_iterations=1000)
+        self.assertTrue(abs(result.retained_objects - 1) < 0.1)
+
+    def test_smoke(self):
+        results = list(bench_get_state(0, counts=(10,), ratios=(0.5,)))
+        results.extend(bench_one_process_failure(0))
+        results.extend(bench_get_file(0, size=1024))
+        self.assertEqual(5, len(results))
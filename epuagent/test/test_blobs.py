@@ -0,0 +1,86 @@
+# Copyright 2013 University of Chicago
+
+import unittest
+
+from epuagent.blobs import BlobDeduper, blob_digest, restore_blobs
+from epuagent.delta import DeltaEncoder, DeltaDecoder
+from epuagent.codec import pack, unpack
+
+TRACEBACK = "Traceback (most recent call last):\n  ImportError: no\n"
+
+def _state(nprocs, stderr=TRACEBACK):
+    procs = [{'name': 'worker_%d' % i, 'state': 200, 'stderr': stderr,
+              'stderr_size': len(stderr or ''), 'stderr_truncated': False}
+             for i in range(nprocs)]
+    return {'node_id': 'node1', 'timestamp': 1.0, 'state': 'PROCESS_ERROR',
+            'failed_processes': procs}
+
+class BlobDeduperTests(unittest.TestCase):
+    def test_mass_failure(self):
+        deduper = BlobDeduper()
+        state = _state(64, TRACEBACK * 50)
+        deduped = deduper.dedupe(state)
+
+        digest = blob_digest(TRACEBACK * 50)
+        self.assertEqual({digest: TRACEBACK * 50}, deduped['blobs'])
+        for proc in deduped['failed_processes']:
+            self.assertNotIn('stderr', proc)
+            self.assertEqual(digest, proc['stderr_digest'])
+        self.assertEqual(63, deduper.get_stats()['blobs_deduped'])
+
+        # the original state is left alone
+        self.assertEqual(TRACEBACK * 50,
+                         state['failed_processes'][0]['stderr'])
+
+        # heartbeat size scales with distinct errors
+        self.assertTrue(len(pack(deduped)) * 10 < len(pack(state)))
+
+    def test_acked_not_resent(self):
+        deduper = BlobDeduper()
+        deduper.ack([blob_digest(TRACEBACK)])
+        deduped = deduper.dedupe(_state(2))
+        self.assertNotIn('blobs', deduped)
+        self.assertEqual(blob_digest(TRACEBACK),
+                         deduped['failed_processes'][0]['stderr_digest'])
+
+    def test_known_bounded(self):
+        deduper = BlobDeduper(max_known=2)
+        deduper.ack(['a', 'b', 'c'])
+        self.assertEqual(2, deduper.get_stats()['known'])
+
+    def test_no_stderr(self):
+        deduper = BlobDeduper()
+        state = _state(2, stderr=None)
+        self.assertTrue(deduper.dedupe(state) is state)
+
+    def test_restore(self):
+        deduper = BlobDeduper()
+        store = {}
+        state = deduper.dedupe(_state(3))
+        added = restore_blobs(state, store)
+        self.assertEqual([blob_digest(TRACEBACK)], added)
+        self.assertNotIn('blobs', state)
+        for proc in state['failed_processes']:
+            self.assertEqual(TRACEBACK, proc['stderr'])
+
+        # once acked, later failures resolve from the receiver's store
+        deduper.ack(added)
+        state = deduper.dedupe(_state(1))
+        self.assertEqual([], restore_blobs(state, store))
+        self.assertEqual(TRACEBACK, state['failed_processes'][0]['stderr'])
+
+        self.assertEqual([], restore_blobs(deduper.dedupe(_state(1)), {}))
+
+    def test_through_delta_and_codec(self):
+        deduper = BlobDeduper()
+        encoder = DeltaEncoder(keyframe_interval=10)
+        decoder = DeltaDecoder()
+        decoder.apply(unpack(pack(encoder.encode(deduper.dedupe(_state(0))))))
+        decoder.apply(unpack(pack(encoder.encode(deduper.dedupe(_state(0))))))
+
+        msg = unpack(pack(encoder.encode(deduper.dedupe(_state(4)))))
+        self.assertFalse(msg['keyframe'])
+        state = decoder.apply(msg)
+        restore_blobs(state, {})
+        self.assertEqual([TRACEBACK] * 4,
+                         [proc['stderr'] for proc in state['failed_processes']])
@@ -0,0 +1,82 @@
+# Copyright 2013 University of Chicago
+
+import time
+import unittest
+
+import gevent
+
+from epuagent.blockio import ThreadedIO, InlineIO, HubMonitor, IOTimeout, \
+        make_io
+from epuagent.core import EPUAgentCore
+from epuagent.schedule import monotonic
+from epuagent.stats import Stats
+from epuagent.supervisor import ProcessStates
+
+class ThreadedIOTests(unittest.TestCase):
+    def test_call(self):
+        io = ThreadedIO(2, timeout=5)
+        self.assertEqual(3, io.call(lambda a, b=0: a + b, 1, b=2))
+        self.assertRaises(ZeroDivisionError, io.call, lambda: 1 / 0)
+        self.assertEqual(2, io.get_stats()['call_count'])
+
+    def test_timeout(self):
+        io = ThreadedIO(1, timeout=0.1)
+        start = time.time()
+        self.assertRaises(IOTimeout, io.call, time.sleep, 0.5)
+        self.assertTrue(time.time() - start < 0.4)
+        self.assertEqual(1, io.timeouts)
+
+        # the pool's one thread is still stuck, so this times out waiting
+        self.assertRaises(IOTimeout, io.call, lambda: None)
+
+    def test_hub_not_blocked(self):
+        io = ThreadedIO(1, timeout=5)
+        ticks = []
+        def tick():
+            for i in range(5):
+                ticks.append(time.time())
+                gevent.sleep(0.02)
+        ticker = gevent.spawn(tick)
+        io.call(time.sleep, 0.2)
+        ticker.join()
+        self.assertEqual(5, len(ticks))
+        self.assertTrue(ticks[-1] - ticks[0] < 0.15)
+
+    def test_make_io(self):
+        self.assertTrue(isinstance(make_io(0), InlineIO))
+        self.assertTrue(isinstance(make_io(2), ThreadedIO))
+
+    def test_core_read_timeout(self):
+        io = ThreadedIO(1, timeout=0.1)
+        proc = {'name': 'p1', 'state': ProcessStates.FATAL,
+                'exitstatus': 1, 'stderr_logfile': '/some/slow/nfs/log'}
+        class Supervisor(object):
+            def query(self):
+                return [dict(proc)]
+        import epuagent.core
+        real_get_file = epuagent.core._get_file
+        epuagent.core._get_file = lambda *args, **kwargs: time.sleep(0.5)
+        try:
+            core = EPUAgentCore("node", Supervisor(), io=io)
+            state = core.get_state()
+        finally:
+            epuagent.core._get_file = real_get_file
+        self.assertEqual(None, state['failed_processes'][0]['stderr'])
+
+class HubMonitorTests(unittest.TestCase):
+    def test_blocked(self):
+        stats = Stats()
+        monitor = HubMonitor(stats, interval=0.01)
+        monitor.start()
+        try:
+            gevent.sleep(0.03)
+            # spin rather than sleep, which monkey patching would make
+            # yield to the hub
+            end = monotonic() + 0.1
+            while monotonic() < end:
+                pass
+            gevent.sleep(0.03)
+        finally:
+            monitor.stop()
+        self.assertTrue(monitor.max_blocked_seconds >= 0.05)
+        self.assertTrue(stats.snapshot()['timers']['hub_blocked']['count'])
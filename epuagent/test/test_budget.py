@@ -0,0 +1,91 @@
+# Copyright 2013 University of Chicago
+
+import json
+import unittest
+
+from epuagent.blobs import BlobDeduper
+from epuagent.budget import PayloadBudget, estimate_size
+
+def _failure(i, stderr_bytes=1000):
+    return {'name': 'proc%d' % i, 'state': 200, 'statename': 'FATAL',
+            'exitcode': 1, 'stop_timestamp': 1000 + i, 'error': '',
+            'error_time': 2000.0 + i,
+            'stderr': ('error %d\n' % i) * (stderr_bytes // 8),
+            'stderr_size': stderr_bytes, 'stderr_truncated': False}
+
+def _state(nprocs, stderr_bytes=1000):
+    return {'node_id': 'node1', 'timestamp': 1.0, 'state': 'PROCESS_ERROR',
+            'period': 1.0,
+            'process_stats': dict(('proc%d' % i, {'cpu': 1.0, 'rss': 100})
+                                  for i in range(nprocs)),
+            'failed_processes': [_failure(i, stderr_bytes)
+                                 for i in range(nprocs)]}
+
+class PayloadBudgetTests(unittest.TestCase):
+    def assertFits(self, budget, state):
+        self.assertTrue(len(json.dumps(state)) <= budget.max_bytes,
+                        "%d > %d" % (len(json.dumps(state)),
+                                     budget.max_bytes))
+
+    def test_under_budget(self):
+        state = _state(2)
+        budget = PayloadBudget(100000)
+        self.assertTrue(budget.apply(state) is state)
+        self.assertEqual(0, budget.trimmed)
+
+    def test_estimate(self):
+        state = _state(10)
+        actual = len(json.dumps(state))
+        self.assertTrue(actual <= estimate_size(state) < actual * 1.2)
+
+    def test_measurements_first(self):
+        state = _state(10)
+        budget = PayloadBudget(estimate_size(state) - 10)
+        trimmed = budget.apply(state)
+        self.assertNotIn('process_stats', trimmed)
+        self.assertEqual(['process_stats'], trimmed['omitted']['fields'])
+        self.assertEqual(10, len([p for p in trimmed['failed_processes']
+                                  if p['stderr']]))
+        # the original is untouched
+        self.assertIn('process_stats', state)
+
+    def test_oldest_errors_first(self):
+        state = _state(10)
+        budget = PayloadBudget(6000)
+        trimmed = budget.apply(state)
+        self.assertFits(budget, trimmed)
+
+        procs = trimmed['failed_processes']
+        self.assertEqual(10, len(procs))
+        omitted = [p['name'] for p in procs if p.get('stderr_omitted')]
+        kept = [p['name'] for p in procs if p['stderr']]
+        self.assertTrue(omitted)
+        self.assertTrue('proc9' in kept)
+        self.assertTrue('proc0' in omitted)
+        self.assertEqual(len(omitted), trimmed['omitted']['stderr'] -
+                         len([p for p in procs if p['stderr'] and
+                              p['stderr_truncated']]))
+        self.assertEqual(_failure(9)['stderr'], procs[9]['stderr'])
+
+    def test_processes_last(self):
+        state = _state(100)
+        budget = PayloadBudget(5000)
+        trimmed = budget.apply(state)
+        self.assertFits(budget, trimmed)
+        self.assertEqual('PROCESS_ERROR', trimmed['state'])
+        remaining = [p['name'] for p in trimmed['failed_processes']]
+        self.assertEqual(100, len(remaining) +
+                         trimmed['omitted']['failed_processes'])
+        self.assertTrue('proc99' in remaining)
+        self.assertFalse('proc0' in remaining)
+
+    def test_blobs(self):
+        state = _state(10)
+        deduped = BlobDeduper().dedupe(state)
+        self.assertEqual(10, len(deduped['blobs']))
+        budget = PayloadBudget(6000)
+        trimmed = budget.apply(deduped)
+        self.assertFits(budget, trimmed)
+        self.assertTrue(len(trimmed['blobs']) < 10)
+        self.assertTrue(trimmed['failed_processes'][0]['stderr_omitted'])
+        self.assertEqual(10, len(deduped['blobs']))
@@ -0,0 +1,119 @@
+# Copyright 2013 University of Chicago
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from epuagent.checkpoint import Checkpoint
+from epuagent.core import EPUAgentCore, FailureCache, FailureRecord
+from epuagent.supervisor import ProcessStates
+
+class CheckpointTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "checkpoint.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _record(self, name):
+        return FailureRecord(name, ProcessStates.FATAL, 'FATAL', 1,
+                             1360000000, '', 12345.0)
+
+    def test_missing(self):
+        self.assertEqual(([], 0), Checkpoint(self.path).load())
+
+    def test_corrupt(self):
+        f = open(self.path, 'w')
+        f.write('{"version": 1, "seq')
+        f.close()
+        self.assertEqual(([], 0), Checkpoint(self.path).load())
+
+    def test_round_trip(self):
+        cache = FailureCache()
+        cache.put(self._record('a'))
+        cache.put(self._record('b'))
+        Checkpoint(self.path, sequence_block=100).save(cache, 42)
+        self.assertEqual([], [name for name in os.listdir(self.tmpdir)
+                              if name != "checkpoint.json"])
+
+        records, sequence = Checkpoint(self.path).load()
+        self.assertEqual(142, sequence)
+        self.assertEqual(['a', 'b'], [record.name for record in records])
+        self.assertEqual(self._record('a').to_dict(), records[0].to_dict())
+
+    def test_update_only_on_change(self):
+        cache = FailureCache()
+        checkpoint = Checkpoint(self.path, sequence_block=10, min_interval=0)
+        self.assertTrue(checkpoint.update(cache, 1))
+        self.assertFalse(checkpoint.update(cache, 2))
+
+        cache.put(self._record('a'))
+        self.assertTrue(checkpoint.update(cache, 3))
+        self.assertFalse(checkpoint.update(cache, 4))
+
+        # the reserved sequence block ran out
+        self.assertTrue(checkpoint.update(cache, 13))
+        self.assertEqual(3, checkpoint.save_count)
+
+    def test_rate_limited(self):
+        cache = FailureCache()
+        clock = _Clock()
+        checkpoint = Checkpoint(self.path, sequence_block=10,
+                                min_interval=30, clock=clock)
+        self.assertTrue(checkpoint.update(cache, 1))
+
+        # changes wait for min_interval
+        cache.put(self._record('a'))
+        self.assertFalse(checkpoint.update(cache, 2))
+        clock.now += 10
+        cache.put(self._record('b'))
+        self.assertFalse(checkpoint.update(cache, 3))
+        clock.now += 20
+        self.assertTrue(checkpoint.update(cache, 4))
+        self.assertEqual(2, len(Checkpoint(self.path).load()[0]))
+
+        # but not when the sequence block runs out
+        clock.now += 1
+        self.assertTrue(checkpoint.update(cache, 14))
+
+        # flush saves pending changes right away
+        cache.put(self._record('c'))
+        self.assertFalse(checkpoint.update(cache, 15))
+        self.assertTrue(checkpoint.flush(cache, 15))
+        self.assertFalse(checkpoint.flush(cache, 15))
+        self.assertEqual(3, len(Checkpoint(self.path).load()[0]))
+
+    def test_write_error(self):
+        checkpoint = Checkpoint(os.path.join(self.tmpdir, "nope", "x"))
+        self.assertFalse(checkpoint.update(FailureCache(), 1))
+
+    def test_restart_not_rereported(self):
+        proc = {'name': 'p1', 'state': ProcessStates.FATAL,
+                'statename': 'FATAL', 'exitstatus': 1, 'stop': 1360000000,
+                'spawnerr': '', 'stderr_logfile': self.path}
+        core = EPUAgentCore("node", supervisor=_Supervisor([proc]))
+        core.get_state()
+        Checkpoint(self.path).save(core.fail_cache, 1)
+
+        core = EPUAgentCore("node", supervisor=_Supervisor([proc]))
+        records, sequence = Checkpoint(self.path).load()
+        core.fail_cache.load(records)
+        failed = core.get_state()['failed_processes'][0]
+        self.assertEqual('p1', failed['name'])
+        self.assertNotIn('stderr', failed)
+
+class _Supervisor(object):
+    def __init__(self, processes):
+        self.processes = processes
+
+    def query(self):
+        return [dict(proc) for proc in self.processes]
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
@@ -0,0 +1,64 @@
+# Copyright 2013 University of Chicago
+
+import unittest
+
+from epuagent.codec import BinaryCodec, DictCodec, CodecError, get_codec, \
+        decode, pack, unpack
+
+STATE = {'node_id': 'the_node_id', 'timestamp': 1360000000.25,
+         'state': 'PROCESS_ERROR', 'sequence': 12345, 'keyframe': True,
+         'failed_processes': [
+             {'name': u'proc\xe91', 'state': 200, 'statename': 'FATAL',
+              'exitcode': -1, 'stop_timestamp': None, 'error': '',
+              'error_time': 1360000000.5, 'stderr': 'x' * 5000,
+              'stderr_size': 2 ** 40, 'stderr_truncated': True}],
+         'process_stats': {'proc2': {'cpu': None, 'rss': 1024}},
+         'unknown_field': [1, 'two', (3,)]}
+
+class CodecTests(unittest.TestCase):
+    def test_roundtrip(self):
+        value = unpack(pack(STATE))
+        self.assertEqual(STATE['failed_processes'], value['failed_processes'])
+        self.assertEqual([1, 'two', [3]], value['unknown_field'])
+        self.assertEqual(STATE['process_stats'], value['process_stats'])
+        self.assertEqual(STATE['timestamp'], value['timestamp'])
+
+    def test_ints(self):
+        for n in (0, 1, -1, 127, 128, -129, 2 ** 63, -(2 ** 70)):
+            self.assertEqual(n, unpack(pack(n)))
+
+    def test_compression(self):
+        small = BinaryCodec(compress_threshold=100000)
+        compressed = BinaryCodec(compress_threshold=100)
+        a = small.encode(STATE)
+        b = compressed.encode(STATE)
+        self.assertTrue(compressed.last_size < small.last_size)
+        self.assertEqual(decode(a), decode(b))
+        self.assertTrue(small.get_stats()['last_encode_seconds'] is not None)
+
+    def test_smaller_than_dict(self):
+        codec = BinaryCodec()
+        codec.encode(STATE)
+        dict_codec = DictCodec()
+        dict_codec.encode(STATE)
+        self.assertTrue(codec.last_size < dict_codec.last_size)
+
+    def test_decode_plain(self):
+        self.assertTrue(decode(get_codec(None).encode(STATE)) is STATE)
+
+    def test_unknown_tags_kept(self):
+        # a newer agent with a field appended to FIELDS
+        import epuagent.codec as codec
+        tag = len(codec.FIELDS) + 3
+        codec._TAGS['from_the_future'] = tag
+        try:
+            data = pack({'state': 'OK', 'from_the_future': [1]})
+        finally:
+            del codec._TAGS['from_the_future']
+        self.assertEqual({'state': 'OK', tag: [1]}, unpack(data))
+
+    def test_errors(self):
+        self.assertRaises(CodecError, get_codec, "nope")
+        self.assertRaises(CodecError, pack, object())
+        self.assertRaises(CodecError, unpack, "\x02\x00\x00")
+        self.assertRaises(CodecError, unpack, pack(STATE)[:50])
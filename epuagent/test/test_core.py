@@ -1,6 +1,7 @@
 # Copyright 2013 University of Chicago
 
 import os
+import mmap
 import uuid
 import logging
 import tempfile
@@ -8,8 +9,11 @@ import unittest
 
 #from ion.core import ioninit
 
-from epuagent.core import EPUAgentCore
-from epuagent.supervisor import SupervisorError, ProcessStates
+from epuagent.core import EPUAgentCore, FailureCache, FailureRecord, \
+        _get_file
+from epuagent.stats import Stats
+from epuagent.supervisor import SupervisorError, SupervisorGroup, \
+        ProcessStates
 
 #CONF = ioninit.config(__name__)
 
@@ -33,6 +37,19 @@ class EPUAgentCoreTests(unittest.TestCase):
         self.assertBasics(state, "MONITOR_ERROR")
         self.assertTrue('faaaaaaaail' in state['error'])
 
+    def test_supervisor_error_last_known(self):
+        self.sup.processes = [_one_process(ProcessStates.RUNNING),
+                              _one_process(ProcessStates.FATAL)]
+        self.core.get_state()
+        self.sup.last_processes = self.sup.processes
+        self.sup.last_query_time = 12345
+
+        self.sup.error = SupervisorError('faaaaaaaail')
+        state = self.core.get_state()
+        self.assertBasics(state, "MONITOR_ERROR")
+        self.assertEqual(12345, state['stale_since'])
+        self.assertEqual(1, len(state['failed_processes']))
+
     def test_series(self):
         self.sup.processes = [_one_process(ProcessStates.RUNNING),
                               _one_process(ProcessStates.RUNNING)]
@@ -59,6 +76,8 @@ class EPUAgentCoreTests(unittest.TestCase):
         self.assertEqual(1, len(failed_processes))
         failed = failed_processes[0]
         self.assertEqual(stderr, failed['stderr'])
+        self.assertEqual(len(stderr), failed['stderr_size'])
+        self.assertFalse(failed['stderr_truncated'])
 
         # next time around process should still be failed but no stderr
         state = self.core.get_state()
@@ -73,6 +92,329 @@ class EPUAgentCoreTests(unittest.TestCase):
         state = self.core.get_state()
         self.assertBasics(state)
 
+    def test_supervisor_group_errors(self):
+        self.sup.processes = [_one_process(ProcessStates.FATAL)]
+        self.sup.errors = {'other': 'faaaaaaaail'}
+        self.sup.status = {'other': {'state': 'MONITOR_ERROR'}}
+        state = self.core.get_state()
+        self.assertBasics(state, "MONITOR_ERROR")
+        self.assertTrue('faaaaaaaail' in state['error'])
+        self.assertEqual(1, len(state['failed_processes']))
+        self.assertEqual(self.sup.status, state['supervisors'])
+
+    def test_process_stats(self):
+        sampler = FakeSampler()
+        self.core.process_sampler = sampler
+        self.sup.processes = [_one_process(ProcessStates.RUNNING)]
+        state = self.core.get_state()
+        self.assertBasics(state)
+        self.assertEqual(self.sup.processes, sampler.sampled)
+        self.assertEqual({'x': {}}, state['process_stats'])
+
+        self.sup.error = SupervisorError('faaaaaaaail')
+        state = self.core.get_state()
+        self.assertFalse('process_stats' in state)
+
+    def test_stats(self):
+        self.core.stats = Stats()
+        fail = _one_process(ProcessStates.FATAL)
+        self.sup.processes = [fail]
+        err_path = _write_tempfile("boom")
+        fail['stderr_logfile'] = err_path
+        try:
+            self.core.get_state()
+        finally:
+            os.unlink(err_path)
+        self.sup.error = SupervisorError('faaaaaaaail')
+        self.core.get_state()
+
+        snapshot = self.core.stats.snapshot()
+        self.assertEqual(2, snapshot['timers']['supervisor_query']['count'])
+        self.assertEqual(1, snapshot['timers']['failure_diff']['count'])
+        self.assertEqual(1, snapshot['timers']['stderr_read']['count'])
+        self.assertEqual(1, snapshot['counters']['supervisor_errors'])
+
+    def test_fail_cache_pruned(self):
+        procs = [_one_process(ProcessStates.FATAL) for i in range(3)]
+        self.sup.processes = list(procs)
+        self.core.get_state()
+        self.assertEqual(3, len(self.core.fail_cache))
+
+        # one process is removed from supervisord config
+        self.sup.processes = procs[1:]
+        self.core.get_state()
+        self.assertEqual(2, len(self.core.fail_cache))
+        self.assertFalse(procs[0]['name'] in self.core.fail_cache)
+
+    def test_fail_cache_stop_zero(self):
+        # processes that never ran have a stop time of 0
+        fail = _one_process(ProcessStates.FATAL)
+        fail['stop'] = 0
+        self.sup.processes = [fail]
+        stderr = "this is the errros!"
+        err_path = _write_tempfile(stderr)
+        fail['stderr_logfile'] = err_path
+        try:
+            state = self.core.get_state()
+            self.assertEqual(stderr, state['failed_processes'][0]['stderr'])
+            state = self.core.get_state()
+            self.assertFalse(state['failed_processes'][0].get('stderr'))
+        finally:
+            os.unlink(err_path)
+
+    def test_stderr_truncated(self):
+        self.core.stderr_max_bytes = 10
+        fail = _one_process(ProcessStates.FATAL)
+        self.sup.processes = [fail]
+
+        stderr = "x" * 100 + "the end"
+        err_path = _write_tempfile(stderr)
+        fail['stderr_logfile'] = err_path
+        try:
+            state = self.core.get_state()
+        finally:
+            os.unlink(err_path)
+
+        failed = state['failed_processes'][0]
+        self.assertEqual("xxxthe end", failed['stderr'])
+        self.assertEqual(len(stderr), failed['stderr_size'])
+        self.assertTrue(failed['stderr_truncated'])
+
+
+class EPUAgentCoreEventTests(unittest.TestCase):
+    def setUp(self):
+        self.sup = FakeSupervisor()
+        self.sup.processes = [_one_process(ProcessStates.RUNNING),
+                              _one_process(ProcessStates.RUNNING)]
+        self.core = EPUAgentCore(NODE_ID, supervisor=self.sup,
+                                 reconcile_seconds=60)
+
+    def test_no_poll_between_reconciles(self):
+        self.assertEqual("OK", self.core.get_state()['state'])
+        self.assertEqual(1, self.sup.query_count)
+        self.core.get_state()
+        self.assertEqual(1, self.sup.query_count)
+
+    def test_events(self):
+        self.core.get_state()
+        proc = self.sup.processes[0]
+
+        # RUNNING -> BACKOFF isn't a failure
+        self.assertFalse(self.core.apply_event('PROCESS_STATE_BACKOFF',
+                {'processname': proc['name'], 'from_state': 'RUNNING'}))
+        self.assertEqual("OK", self.core.get_state()['state'])
+        self.assertEqual(1, self.sup.query_count)
+
+        # failure is a transition and makes the next state query
+        # supervisord for exit details
+        self.assertTrue(self.core.apply_event('PROCESS_STATE_FATAL',
+                {'processname': proc['name'], 'from_state': 'BACKOFF'}))
+        proc['state'] = ProcessStates.FATAL
+        state = self.core.get_state()
+        self.assertEqual(2, self.sup.query_count)
+        self.assertEqual("PROCESS_ERROR", state['state'])
+
+        # unknown process forces a query
+        self.assertTrue(self.core.apply_event('PROCESS_STATE_RUNNING',
+                {'processname': 'new', 'from_state': 'STARTING'}))
+        self.core.get_state()
+        self.assertEqual(3, self.sup.query_count)
+
+    def test_other_events(self):
+        self.core.get_state()
+        self.assertFalse(self.core.apply_event('TICK_5', {}))
+        self.assertFalse(self.core.apply_event('PROCESS_STATE_NONSENSE', {}))
+
+    def test_group_events(self):
+        sup = FakeSupervisor()
+        sup.url = "unix:///tmp/two.sock"
+        sup.processes = [_one_process(ProcessStates.RUNNING)]
+        name = sup.processes[0]['name']
+        group = SupervisorGroup([("one", FakeSupervisor()), ("two", sup)])
+        group.supervisors[0][1].processes = []
+        core = EPUAgentCore(NODE_ID, supervisor=group, reconcile_seconds=60)
+        core.get_state()
+
+        # events name their supervisord, by name or socket URL
+        for supervisor in ("two", sup.url):
+            self.assertFalse(core.apply_event('PROCESS_STATE_BACKOFF',
+                    {'processname': name, 'supervisor': supervisor}))
+        self.assertEqual(1, sup.query_count)
+
+        # an event that doesn't is treated as an unknown process
+        self.assertTrue(core.apply_event('PROCESS_STATE_BACKOFF',
+                {'processname': name}))
+        core.get_state()
+        self.assertEqual(2, sup.query_count)
+
+    def test_transitions(self):
+        self.core.get_state()
+        self.assertEqual(0, self.core.transitions)
+        proc = self.sup.processes[0]
+
+        # an event is counted once, not again by the query that follows
+        self.core.apply_event('PROCESS_STATE_FATAL',
+                {'processname': proc['name'], 'from_state': 'BACKOFF'})
+        self.assertEqual(1, self.core.transitions)
+        self.assertTrue(self.core.last_transition_time)
+        proc['state'] = ProcessStates.FATAL
+        self.core.get_state()
+        self.assertEqual(1, self.core.transitions)
+
+        # changes only seen by polling are counted too
+        proc['state'] = ProcessStates.RUNNING
+        self.sup.processes[1]['state'] = ProcessStates.FATAL
+        self.core.reconcile_seconds = 0
+        self.core.get_state()
+        self.assertEqual(3, self.core.transitions)
+
+
+class StderrRPCTests(unittest.TestCase):
+    def setUp(self):
+        self.sup = FakeTailingSupervisor()
+        self.core = EPUAgentCore(NODE_ID, supervisor=self.sup,
+                                 stderr_rpc=True, stderr_max_lines=1)
+
+    def test_new_failure_tailed_after_query(self):
+        running = _one_process(ProcessStates.RUNNING)
+        self.sup.processes = [running]
+        self.core.get_state()
+        self.assertEqual([], self.sup.tailed)
+
+        running['state'] = ProcessStates.FATAL
+        failed = self.core.get_state()['failed_processes'][0]
+        self.assertEqual("line2\n", failed['stderr'])
+        self.assertEqual(1000, failed['stderr_size'])
+        self.assertTrue(failed['stderr_truncated'])
+        self.assertEqual([[running['name']]], self.sup.tailed)
+
+        # already reported, so not tailed again
+        self.assertNotIn('stderr', self.core.get_state()['failed_processes'][0])
+        self.assertEqual(1, len(self.sup.tailed))
+
+    def test_known_failure_tailed_with_query(self):
+        procs = [_one_process(ProcessStates.RUNNING)]
+        self.sup.processes = procs
+        self.core = EPUAgentCore(NODE_ID, supervisor=self.sup,
+                                 stderr_rpc=True, reconcile_seconds=60)
+        self.core.get_state()
+
+        # an event marks the process failed and forces a query
+        self.core.apply_event('PROCESS_STATE_FATAL',
+                              {'processname': procs[0]['name']})
+        calls = []
+        query_with_tails = self.sup.query_with_tails
+        def counting(names, length):
+            calls.append(names)
+            return query_with_tails(names, length)
+        self.sup.query_with_tails = counting
+
+        self.sup.processes = [dict(procs[0], state=ProcessStates.FATAL)]
+        state = self.core.get_state()
+        self.assertEqual([[procs[0]['name']]], calls)
+        self.assertEqual(1, len(self.sup.tailed))
+        self.assertEqual("line1\nline2\n",
+                         state['failed_processes'][0]['stderr'])
+
+    def test_tail_error(self):
+        self.sup.processes = [_one_process(ProcessStates.FATAL)]
+        def fail(names, length):
+            raise SupervisorError("faaaaaaaail")
+        self.sup.tail_stderr = fail
+        state = self.core.get_state()
+        self.assertEqual("PROCESS_ERROR", state['state'])
+        self.assertEqual(None, state['failed_processes'][0]['stderr'])
+
+
+class FailureCacheTests(unittest.TestCase):
+    def _record(self, name):
+        return FailureRecord(name, ProcessStates.FATAL, 'FATAL', 1, None,
+                             '', 0)
+
+    def test_lru(self):
+        cache = FailureCache(max_size=2)
+        cache.put(self._record('a'))
+        cache.put(self._record('b'))
+        self.assertEqual('a', cache.get('a').name)
+        cache.put(self._record('c'))
+
+        self.assertEqual(2, len(cache))
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual({'size': 2, 'max_size': 2, 'evictions': 1},
+                         cache.get_stats())
+
+    def test_prune(self):
+        cache = FailureCache()
+        for name in 'abc':
+            cache.put(self._record(name))
+        cache.prune(set(['b']))
+        self.assertEqual(1, len(cache))
+        self.assertTrue('b' in cache)
+        self.assertEqual(None, cache.pop('a'))
+
+    def test_record(self):
+        record = self._record('a')
+        self.assertEqual('a', record.to_dict()['name'])
+        self.assertRaises(AttributeError, setattr, record, 'stderr', 'x')
+
+
+class GetFileTests(unittest.TestCase):
+    def setUp(self):
+        self.text = "".join("line %d\n" % i for i in range(1000))
+        self.path = _write_tempfile(self.text)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_whole_file(self):
+        data, size, truncated = _get_file(self.path, len(self.text))
+        self.assertEqual(self.text, data)
+        self.assertEqual(len(self.text), size)
+        self.assertFalse(truncated)
+
+    def test_max_bytes(self):
+        for use_mmap in (False, True):
+            data, size, truncated = _get_file(self.path, 9,
+                                              use_mmap=use_mmap)
+            self.assertEqual("line 999\n", data)
+            self.assertEqual(len(self.text), size)
+            self.assertTrue(truncated)
+
+    def test_mmap_maps_tail(self):
+        granularity = mmap.ALLOCATIONGRANULARITY
+        text = "".join(chr(ord('a') + i % 26) for i in range(granularity))
+        path = _write_tempfile(text * 3 + "the end\n")
+        mapped = []
+        real_mmap = mmap.mmap
+        def recording_mmap(fileno, length, **kwargs):
+            mapped.append(length)
+            return real_mmap(fileno, length, **kwargs)
+        mmap.mmap = recording_mmap
+        try:
+            data, size, truncated = _get_file(path, 100, use_mmap=True)
+        finally:
+            mmap.mmap = real_mmap
+            os.unlink(path)
+        self.assertEqual((text * 3 + "the end\n")[-100:], data)
+        self.assertTrue(truncated)
+        self.assertTrue(mapped[0] <= 100 + granularity)
+
+    def test_max_lines(self):
+        data, size, truncated = _get_file(self.path, 1024, max_lines=2)
+        self.assertEqual("line 998\nline 999\n", data)
+        self.assertTrue(truncated)
+
+    def test_empty(self):
+        path = _write_tempfile("")
+        try:
+            self.assertEqual(("", 0, False), _get_file(path, use_mmap=True))
+        finally:
+            os.unlink(path)
+
+    def test_missing(self):
+        self.assertEqual(None, _get_file(self.path + ".nope"))
+
 def _one_process(state, exitstatus=0, spawnerr=''):
     return {'name' : str(uuid.uuid4()), 'state' : state,
             'exitstatus' :exitstatus, 'spawnerr' : spawnerr}
@@ -92,8 +434,30 @@ class FakeSupervisor(object):
     def __init__(self):
         self.error = None
         self.processes = None
+        self.query_count = 0
 
     def query(self):
+        self.query_count += 1
         if self.error:
             raise self.error
         return self.processes
+
+class FakeTailingSupervisor(FakeSupervisor):
+    def __init__(self):
+        FakeSupervisor.__init__(self)
+        self.tailed = []
+
+    def query_with_tails(self, names, length):
+        return self.query(), self.tail_stderr(names, length)
+
+    def tail_stderr(self, names, length):
+        self.tailed.append(list(names))
+        return dict((name, ("line1\nline2\n", 1000, True)) for name in names)
+
+class FakeSampler(object):
+    def __init__(self):
+        self.sampled = None
+
+    def sample(self, procs):
+        self.sampled = procs
+        return {'x': {}}
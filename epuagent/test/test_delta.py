@@ -0,0 +1,88 @@
+# Copyright 2013 University of Chicago
+
+import unittest
+
+from epuagent.delta import DeltaEncoder, DeltaDecoder
+
+NODE_ID = "the_node_id"
+
+class DeltaTests(unittest.TestCase):
+    def setUp(self):
+        self.encoder = DeltaEncoder(keyframe_interval=5)
+        self.decoder = DeltaDecoder()
+        self.now = 0
+
+    def _state(self, state="OK", failed=None):
+        self.now += 1
+        s = {'node_id': NODE_ID, 'timestamp': self.now, 'state': state}
+        if failed:
+            s['failed_processes'] = failed
+        return s
+
+    def _roundtrip(self, state):
+        msg = self.encoder.encode(state)
+        return msg, self.decoder.apply(msg)
+
+    def test_keyframe_interval(self):
+        kinds = []
+        for i in range(11):
+            msg, state = self._roundtrip(self._state())
+            self.assertEqual(i + 1, msg['sequence'])
+            kinds.append(msg['keyframe'])
+        self.assertEqual([True, False, False, False, False] * 2 + [True],
+                         kinds)
+
+    def test_unchanged_delta(self):
+        self._roundtrip(self._state())
+        state = self._state()
+        msg, decoded = self._roundtrip(state)
+        self.assertFalse(msg['keyframe'])
+        self.assertEqual(set(['node_id', 'timestamp', 'sequence',
+                              'keyframe']), set(msg))
+        self.assertEqual(state, decoded)
+
+    def test_process_changes(self):
+        proc1 = {'name': 'proc1', 'state': 200, 'stderr': 'boom'}
+        proc2 = {'name': 'proc2', 'state': 100}
+        self._roundtrip(self._state())
+
+        state = self._state("PROCESS_ERROR", [proc1])
+        msg, decoded = self._roundtrip(state)
+        self.assertEqual({'state': "PROCESS_ERROR"}, msg['changed'])
+        self.assertEqual([proc1], msg['processes_changed'])
+        self.assertEqual(state, decoded)
+
+        # stderr is only sent the first time and isn't a change
+        state = self._state("PROCESS_ERROR",
+                            [{'name': 'proc1', 'state': 200}, proc2])
+        msg, decoded = self._roundtrip(state)
+        self.assertFalse('changed' in msg)
+        self.assertEqual([proc2], msg['processes_changed'])
+
+        state = self._state()
+        msg, decoded = self._roundtrip(state)
+        self.assertEqual({'state': "OK"}, msg['changed'])
+        self.assertEqual(set(['proc1', 'proc2']),
+                         set(msg['processes_removed']))
+        self.assertEqual(state, decoded)
+
+    def test_missed_message(self):
+        self._roundtrip(self._state())
+        self.encoder.encode(self._state("PROCESS_ERROR"))
+        msg, decoded = self._roundtrip(self._state())
+        self.assertEqual(None, decoded)
+
+        self.encoder.request_keyframe()
+        state = self._state()
+        msg, decoded = self._roundtrip(state)
+        self.assertTrue(msg['keyframe'])
+        self.assertEqual(state, decoded)
+
+    def test_disabled(self):
+        encoder = DeltaEncoder()
+        for i in range(3):
+            state = self._state()
+            msg = encoder.encode(state)
+            self.assertTrue(msg['keyframe'])
+            self.assertEqual(state['timestamp'], msg['timestamp'])
+            self.assertEqual(state['state'], msg['state'])
@@ -0,0 +1,171 @@
+# Copyright 2013 University of Chicago
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from epuagent.core import EPUAgentCore
+from epuagent.fakesupervisord import FakeSupervisord
+from epuagent.supervisor import Supervisor, SupervisorGroup, \
+        SupervisorError, ProcessStates, RUNNING_STATES
+
+class FakeSupervisordTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "supervisor.sock")
+        self.server = None
+        self.sup = None
+
+    def tearDown(self):
+        if self.sup:
+            self.sup.close()
+        if self.server:
+            self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def _start(self, **kwargs):
+        self.server = FakeSupervisord(self.path, seed=1, **kwargs)
+        self.server.start()
+        self.sup = Supervisor(self.server.url, failure_threshold=100)
+        return self.sup
+
+    def test_query(self):
+        procs = self._start(count=500).query()
+        self.assertEqual(500, len(procs))
+        self.assertEqual('RUNNING', procs[0]['statename'])
+        self.assertTrue(procs[0]['now'])
+
+    def test_script(self):
+        sup = self._start(script=[
+                [{'name': 'a'}],
+                [{'name': 'a', 'state': ProcessStates.FATAL}]])
+        self.assertEqual('RUNNING', sup.query()[0]['statename'])
+        self.assertEqual('FATAL', sup.query()[0]['statename'])
+        self.assertEqual('FATAL', sup.query()[0]['statename'])
+
+    def test_latency(self):
+        sup = self._start(count=1, latency=0.1)
+        start = time.time()
+        sup.query()
+        self.assertTrue(time.time() - start >= 0.1)
+
+    def test_faults(self):
+        sup = self._start(count=1, fault_rate=1.0)
+        self.assertRaises(SupervisorError, sup.query)
+        self.assertEqual(1, self.server.fault_count)
+        # faults aren't connection failures
+        self.assertEqual(0, sup.failures)
+
+    def test_churn(self):
+        sup = self._start(count=100, churn_rate=0.5)
+        procs = sup.query()
+        running = len([p for p in procs if p['state'] in RUNNING_STATES])
+        self.assertTrue(0 < running < 100)
+
+    def test_tails_and_shutdown(self):
+        sup = self._start(processes=[{'name': 'a'},
+                                     {'name': 'b', 'stderr_logfile': ''}],
+                          stderr_bytes=100)
+        procs, tails = sup.query_with_tails(['a', 'b', 'c'], 10)
+        self.assertEqual(2, len(procs))
+        data, size, truncated = tails['a']
+        self.assertEqual(10, len(data))
+        self.assertEqual(100, size)
+        self.assertTrue(truncated)
+        self.assertEqual(None, tails['b'])
+        self.assertEqual(None, tails['c'])
+
+        sup.shutdown()
+        self.assertRaises(SupervisorError, sup.query)
+
+    def test_numprocs_tails(self):
+        # a numprocs program: processes w_00 and w_01 in group w
+        sup = self._start(processes=[
+                {'name': 'w_%02d' % i, 'group': 'w',
+                 'state': ProcessStates.FATAL} for i in range(2)])
+        tails = sup.tail_stderr(['w:w_00', 'w_00', 'w:'], 10)
+        self.assertTrue(tails['w:w_00'])
+        self.assertEqual(None, tails['w_00'])
+        self.assertEqual(None, tails['w:'])
+
+        core = EPUAgentCore("node", sup, stderr_rpc=True)
+        for i in range(2):
+            # first by a separate tail, then with the query
+            if i:
+                core.fail_cache.prune(set())
+            state = core.get_state()
+            for failed in state['failed_processes']:
+                self.assertTrue("w_0" in failed['stderr'])
+
+    def test_core_end_to_end(self):
+        sup = self._start(count=50, churn_rate=0.2, stderr_bytes=64)
+        core = EPUAgentCore("node", sup, stderr_rpc=True)
+        for i in range(5):
+            state = core.get_state()
+            for failed in state.get('failed_processes') or ():
+                if 'stderr' in failed:
+                    self.assertEqual(64, failed['stderr_size'])
+        # one multicall per beat, plus one for failures first seen in it
+        self.assertTrue(sup.call_count <= 10)
+
+
+class SupervisorGroupTailTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.servers = []
+        members = []
+        for name, group in (("one", "a"), ("two", "w")):
+            path = os.path.join(self.tmpdir, "%s.sock" % name)
+            server = FakeSupervisord(path, processes=[
+                    {'name': '%s_%02d' % (group, i), 'group': group,
+                     'state': ProcessStates.FATAL} for i in range(2)],
+                    stderr_bytes=64)
+            server.start()
+            self.servers.append(server)
+            members.append((name, Supervisor(server.url,
+                                             failure_threshold=100)))
+        self.group = SupervisorGroup(members, timeout=5)
+
+    def tearDown(self):
+        self.group.close()
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_tails(self):
+        procs, tails = self.group.query_with_tails(
+                ['a:one/a_00', 'w:two/w_01', 'w:two/nope'], 10)
+        self.assertEqual(4, len(procs))
+        self.assertEqual(10, len(tails['a:one/a_00'][0]))
+        self.assertEqual(64, tails['w:two/w_01'][1])
+        self.assertEqual(None, tails['w:two/nope'])
+        # one request to each supervisord
+        calls = lambda: [sup.call_count for name, sup
+                         in self.group.supervisors]
+        self.assertEqual([1, 1], calls())
+
+        tails = self.group.tail_stderr(['w:two/w_00'], 1024)
+        self.assertTrue("w_00" in tails['w:two/w_00'][0])
+        self.assertEqual([1, 2], calls())
+
+    def test_core_end_to_end(self):
+        core = EPUAgentCore("node", self.group, stderr_rpc=True)
+        state = core.get_state()
+        self.assertEqual(4, len(state['failed_processes']))
+        for failed in state['failed_processes']:
+            self.assertTrue(failed['stderr'])
+
+        # while one supervisord is down, its failures are still known
+        # and aren't reported afresh when it is back
+        self.servers[1].stop()
+        state = core.get_state()
+        self.assertEqual("MONITOR_ERROR", state['state'])
+        self.assertEqual(4, len(state['failed_processes']))
+        self.assertTrue(self.group.status['two']['stale_since'])
+        self.servers[1].start()
+        state = core.get_state()
+        self.assertEqual(4, len(state['failed_processes']))
+        for failed in state['failed_processes']:
+            self.assertFalse('stderr' in failed)
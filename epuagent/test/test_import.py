@@ -0,0 +1,52 @@
+# Copyright 2013 University of Chicago
+
+import sys
+import json
+import unittest
+import subprocess
+
+# generous next to the ~0.1s measured on a development VM, so that
+# it only trips on real regressions like eager heavy imports
+IMPORT_BUDGET_SECONDS = 1.0
+
+HEAVY_MODULES = ('dashi', 'kombu', 'supervisor.xmlrpc')
+
+SCRIPT = """
+import sys, json, time, logging
+start = time.time()
+import %s
+elapsed = time.time() - start
+import socket
+print json.dumps({'elapsed': elapsed,
+                  'modules': [m for m in %r if m in sys.modules],
+                  'socket_module': socket.socket.__module__,
+                  'log_handlers': len(logging.getLogger().handlers)})
+"""
+
+class ImportTests(unittest.TestCase):
+    """Importing epuagent modules must be quick and free of side effects
+    """
+
+    def _import(self, module):
+        script = SCRIPT % (module, HEAVY_MODULES)
+        output = subprocess.check_output([sys.executable, "-c", script])
+        return json.loads(output)
+
+    def _check(self, module):
+        result = self._import(module)
+        self.assertEqual([], result['modules'])
+        self.assertFalse(result['socket_module'].startswith('gevent'),
+                         "importing %s monkey patched socket" % module)
+        self.assertEqual(0, result['log_handlers'])
+        self.assertTrue(result['elapsed'] < IMPORT_BUDGET_SECONDS,
+                        "importing %s took %.3fs" % (module,
+                                                     result['elapsed']))
+
+    def test_core(self):
+        self._check("epuagent.core")
+
+    def test_agent(self):
+        self._check("epuagent.agent")
+
+    def test_listener(self):
+        self._check("epuagent.listener")
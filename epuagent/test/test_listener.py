@@ -0,0 +1,43 @@
+# Copyright 2013 University of Chicago
+
+import unittest
+from StringIO import StringIO
+
+from epuagent.listener import EventListener, read_event
+
+HEADER = ("ver:3.0 server:supervisor serial:21 pool:listener poolserial:10 "
+          "eventname:%s len:%d\n")
+
+def _event(eventname, payload):
+    return HEADER % (eventname, len(payload)) + payload
+
+class EventListenerTests(unittest.TestCase):
+    def test_read_event(self):
+        payload = "processname:cat groupname:cat from_state:RUNNING expected:0 pid:2766"
+        headers, tokens = read_event(StringIO(
+            _event("PROCESS_STATE_EXITED", payload)))
+        self.assertEqual("PROCESS_STATE_EXITED", headers['eventname'])
+        self.assertEqual({'processname': 'cat', 'groupname': 'cat',
+                          'from_state': 'RUNNING', 'expected': '0',
+                          'pid': '2766'}, tokens)
+
+    def test_read_event_eof(self):
+        self.assertEqual(None, read_event(StringIO("")))
+
+    def test_run(self):
+        events = []
+        def callback(eventname, payload):
+            if payload['processname'] == 'bad':
+                raise Exception("world exploded")
+            events.append((eventname, payload['processname']))
+
+        stdin = StringIO(
+            _event("PROCESS_STATE_FATAL", "processname:a groupname:a from_state:BACKOFF") +
+            _event("TICK_5", "when:1234") +
+            _event("PROCESS_STATE_RUNNING", "processname:bad groupname:bad from_state:STARTING"))
+        stdout = StringIO()
+        EventListener(callback, stdin=stdin, stdout=stdout).run()
+
+        self.assertEqual([("PROCESS_STATE_FATAL", "a")], events)
+        self.assertEqual("READY\nRESULT 2\nOK" * 2 + "READY\nRESULT 4\nFAIL" +
+                         "READY\n", stdout.getvalue())
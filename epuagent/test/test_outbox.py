@@ -0,0 +1,93 @@
+# Copyright 2013 University of Chicago
+
+import os
+import unittest
+
+import gevent
+import gevent.event
+
+from epuagent.outbox import Outbox
+from epuagent.core import EPUAgentCore
+from epuagent.delta import carry_once_fields
+from epuagent.supervisor import ProcessStates
+from epuagent.test.test_core import FakeSupervisor, _one_process, \
+        _write_tempfile
+
+class OutboxTests(unittest.TestCase):
+    def test_coalesce(self):
+        outbox = Outbox(2)
+        for i in range(5):
+            outbox.put(i)
+        self.assertEqual(2, len(outbox))
+        self.assertEqual(3, outbox.coalesced)
+        self.assertEqual(3, outbox.get())
+        self.assertEqual(4, outbox.get())
+        self.assertEqual(None, outbox.get(timeout=0.01))
+
+    def test_run(self):
+        outbox = Outbox()
+        published = []
+        release = gevent.event.Event()
+
+        def publish(item):
+            release.wait()
+            if item == "bad":
+                raise Exception("world exploded")
+            published.append(item)
+
+        glet = gevent.spawn(outbox.run, publish)
+        try:
+            outbox.put(1)
+            gevent.sleep(0)
+
+            # publisher is blocked on 1; only the newest of these is kept
+            for item in (2, 3, "bad"):
+                outbox.put(item)
+            outbox.put(4)
+            release.set()
+            gevent.sleep(0.01)
+
+            self.assertEqual([1, 4], published)
+            stats = outbox.get_stats()
+            self.assertEqual(3, stats['coalesced'])
+            self.assertEqual(2, stats['published'])
+            self.assertEqual(0, stats['pending'])
+
+            outbox.put("bad")
+            gevent.sleep(0.01)
+            self.assertEqual(1, outbox.get_stats()['dropped'])
+        finally:
+            glet.kill()
+
+    def test_merge(self):
+        outbox = Outbox(2, merge=lambda dropped, item: item + dropped)
+        for i in (1, 10, 100):
+            outbox.put(i)
+        # 1 is dropped into the next one to publish, not the newest
+        self.assertEqual(11, outbox.get())
+        self.assertEqual(100, outbox.get())
+
+    def test_coalesced_stderr_kept(self):
+        sup = FakeSupervisor()
+        proc = _one_process(ProcessStates.FATAL, exitstatus=1)
+        proc['stderr_logfile'] = _write_tempfile("the error\n")
+        self.addCleanup(os.unlink, proc['stderr_logfile'])
+        sup.processes = [proc]
+        core = EPUAgentCore("node", supervisor=sup)
+        outbox = Outbox(merge=carry_once_fields)
+
+        # the publisher is blocked while two states are sampled; stderr
+        # is only read for the first
+        outbox.put(core.get_state())
+        outbox.put(core.get_state())
+        self.assertEqual(1, outbox.coalesced)
+        state = outbox.get()
+        failed = state['failed_processes'][0]
+        self.assertEqual("the error\n", failed['stderr'])
+
+        # a new failure of the same process isn't given the old stderr
+        dropped = {'failed_processes': [dict(failed)]}
+        newer = dict(failed, error_time=failed['error_time'] + 1)
+        del newer['stderr']
+        state = carry_once_fields(dropped, {'failed_processes': [newer]})
+        self.assertFalse('stderr' in state['failed_processes'][0])
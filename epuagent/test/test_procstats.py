@@ -0,0 +1,89 @@
+# Copyright 2013 University of Chicago
+
+import os
+import unittest
+
+from epuagent.procstats import ProcessSampler, _Ring, CPU, RSS
+
+class ProcessSamplerTests(unittest.TestCase):
+    def setUp(self):
+        if not os.path.exists("/proc/%d/stat" % os.getpid()):
+            raise unittest.SkipTest("Skipping: no /proc filesystem")
+        self.sampler = ProcessSampler(window=3)
+
+    def test_sample(self):
+        procs = [{'name': 'me', 'pid': os.getpid()},
+                 {'name': 'stopped', 'pid': 0}]
+
+        stats = self.sampler.sample(procs)
+        self.assertEqual(['me'], stats.keys())
+        me = stats['me']
+        self.assertEqual(None, me['cpu'])
+        self.assertTrue(me['rss'] > 0)
+        self.assertTrue(me['fds'] > 0)
+        self.assertTrue(me['threads'] >= 1)
+
+        for i in range(5):
+            me = self.sampler.sample(procs)['me']
+        self.assertTrue(me['cpu'] >= 0)
+        self.assertTrue(me['cpu_avg'] >= 0)
+        self.assertTrue(me['rss_avg'] > 0)
+
+    def test_fd_interval(self):
+        sampler = ProcessSampler(fd_interval=3)
+        counted = []
+        count_fds = sampler._count_fds
+        def counting(base):
+            counted.append(base)
+            return count_fds(base)
+        sampler._count_fds = counting
+
+        procs = [{'name': 'me', 'pid': os.getpid()}]
+        for i in range(7):
+            me = sampler.sample(procs)['me']
+            self.assertTrue(me['fds'] > 0)
+        # on the first tick, then every third
+        self.assertEqual(3, len(counted))
+
+    def test_budget(self):
+        # an exhausted budget still samples one process per tick
+        sampler = ProcessSampler(budget=1e-9)
+        procs = [{'name': name, 'pid': os.getpid()}
+                 for name in ('a', 'b', 'c')]
+        self.assertEqual(['a'], sampler.sample(procs).keys())
+        self.assertEqual(['a', 'b'], sorted(sampler.sample(procs)))
+        first = sampler.sample(procs)
+        self.assertEqual(['a', 'b', 'c'], sorted(first))
+        self.assertEqual(None, first['a']['cpu'])
+
+        # round-robin: 'a' again, the others report their last stats
+        stats = sampler.sample(procs)
+        self.assertTrue(stats['a']['cpu'] >= 0)
+        self.assertTrue(stats['b'] is first['b'])
+        self.assertTrue(stats['c'] is first['c'])
+
+    def test_forget_processes(self):
+        self.sampler.sample([{'name': 'me', 'pid': os.getpid()}])
+        self.sampler.sample([])
+        self.assertEqual({}, self.sampler._rings)
+
+    def test_missing_process(self):
+        self.sampler.proc_root = "/nonexistent"
+        self.assertEqual({}, self.sampler.sample([{'name': 'me', 'pid': 1}]))
+
+
+class RingTests(unittest.TestCase):
+    def test_average(self):
+        ring = _Ring(1, 1, 3)
+        self.assertEqual(None, ring.average(CPU))
+        ring.push(1.0, 10, 0, 0)
+        ring.push(2.0, 20, 0, 0)
+        self.assertEqual(1.5, ring.average(CPU))
+        ring.push(3.0, 30, 0, 0)
+        ring.push(4.0, 40, 0, 0)
+        self.assertEqual(3.0, ring.average(CPU))
+        self.assertEqual(30.0, ring.average(RSS))
+        for i in range(5, 12):
+            ring.push(float(i), 10 * i, 0, 0)
+        self.assertEqual(10.0, ring.average(CPU))
+        self.assertEqual(100.0, ring.average(RSS))
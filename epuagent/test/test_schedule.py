@@ -0,0 +1,152 @@
+# Copyright 2013 University of Chicago
+
+import unittest
+
+import random
+
+from epuagent.schedule import AdaptivePeriod, FixedRateScheduler, \
+        BeatSpacing, phase_offset, state_signature, monotonic
+
+class AdaptivePeriodTests(unittest.TestCase):
+    def test_stretch_and_reset(self):
+        schedule = AdaptivePeriod(1.0, 5.0)
+        ok = {'state': 'OK', 'timestamp': 1}
+        self.assertEqual(1.0, schedule.update(ok))
+        self.assertEqual(2.0, schedule.update(dict(ok, timestamp=2)))
+        self.assertEqual(4.0, schedule.update(ok))
+        self.assertEqual(5.0, schedule.update(ok))
+        self.assertEqual(5.0, schedule.update(ok))
+
+        failed = {'state': 'PROCESS_ERROR',
+                  'failed_processes': [{'name': 'a', 'state': 200}]}
+        self.assertEqual(1.0, schedule.update(failed))
+        self.assertEqual(2.0, schedule.update(failed))
+        self.assertEqual(1.0, schedule.update(ok))
+
+    def test_fixed(self):
+        schedule = AdaptivePeriod(0.5)
+        for i in range(3):
+            self.assertEqual(0.5, schedule.update({'state': 'OK'}))
+
+    def test_signature_ignores_details(self):
+        a = {'state': 'PROCESS_ERROR', 'timestamp': 1, 'vitals': {'cpu': 1},
+             'failed_processes': [{'name': 'a', 'state': 200,
+                                   'stderr': 'boom', 'error_time': 1}]}
+        b = {'state': 'PROCESS_ERROR', 'timestamp': 2, 'vitals': {'cpu': 2},
+             'failed_processes': [{'name': 'a', 'state': 200,
+                                   'error_time': 1}]}
+        self.assertEqual(state_signature(a), state_signature(b))
+        b['failed_processes'][0]['exitcode'] = 1
+        self.assertNotEqual(state_signature(a), state_signature(b))
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+class FixedRateSchedulerTests(unittest.TestCase):
+    def _scheduler(self, node_id="node1", wall=5000.0, **kwargs):
+        self.clock = FakeClock()
+        return FixedRateScheduler(node_id, clock=self.clock,
+                                  wall_clock=lambda: wall, **kwargs)
+
+    def test_no_drift(self):
+        scheduler = self._scheduler()
+        deadline = scheduler.next(1.0)
+        ticks = []
+        for i in range(100):
+            # each beat takes a while
+            self.clock.now = deadline + 0.05
+            ticks.append(deadline)
+            scheduler.fired()
+            deadline = scheduler.next(1.0)
+        for a, b in zip(ticks, ticks[1:]):
+            self.assertAlmostEqual(1.0, b - a)
+        self.assertEqual(0, scheduler.late)
+        self.assertEqual(0, scheduler.missed)
+
+    def test_phase(self):
+        a = self._scheduler("node-a")
+        b = self._scheduler("node-b")
+        self.assertEqual(a.phase, phase_offset("node-a"))
+        self.assertNotEqual(a.phase, b.phase)
+        self.assertTrue(0 <= a.phase < 1)
+
+        # in wall clock terms the deadline is at phase of the period
+        deadline = a.next(10.0)
+        wall = deadline + (5000.0 - 1000.0)
+        self.assertAlmostEqual(a.phase * 10.0, wall % 10.0)
+        self.assertTrue(1000.0 < deadline <= 1010.0)
+
+    def test_missed_and_late(self):
+        scheduler = self._scheduler()
+        deadline = scheduler.next(1.0)
+        self.clock.now = deadline + 3.5
+        scheduler.fired()
+        self.assertEqual(1, scheduler.late)
+
+        # three grid points passed while that beat ran; the latest is
+        # run right away and the other two are skipped
+        deadline = scheduler.next(1.0)
+        self.assertEqual(2, scheduler.missed)
+        self.assertTrue(deadline <= self.clock.now)
+        self.assertTrue(self.clock.now - deadline < 1.0)
+
+    def test_jitter(self):
+        scheduler = self._scheduler(jitter=0.2, rng=random.Random(1))
+        deadline = scheduler.next(1.0)
+        nominal = scheduler._next
+        self.assertTrue(abs(deadline - nominal) <= 0.2)
+        self.clock.now = deadline
+        scheduler.fired()
+
+        # jitter doesn't move the grid
+        deadline = scheduler.next(1.0)
+        self.assertAlmostEqual(1.0, scheduler._next - nominal)
+        self.assertTrue(abs(deadline - scheduler._next) <= 0.2)
+
+    def test_interval_change(self):
+        scheduler = self._scheduler()
+        long_deadline = scheduler.next(8.0)
+        short_deadline = scheduler.next(1.0)
+        self.assertTrue(short_deadline <= long_deadline)
+        self.assertTrue(short_deadline - self.clock.now <= 1.0)
+
+    def test_monotonic(self):
+        a = monotonic()
+        self.assertTrue(monotonic() >= a)
+
+
+class BeatSpacingTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.spacing = BeatSpacing(1.0, max_age=5.0, clock=self.clock)
+
+    def test_spacing(self):
+        self.assertEqual(0.0, self.spacing.wait_time())
+        self.spacing.beat()
+        self.assertEqual(1.0, self.spacing.wait_time())
+        self.clock.now += 0.25
+        self.assertEqual(0.75, self.spacing.wait_time())
+        self.clock.now += 2
+        self.assertEqual(0.0, self.spacing.wait_time())
+
+        # regular beats don't hold up out-of-band ones
+        self.spacing.sampled({'state': 'OK'}, 0)
+        self.assertEqual(0.0, self.spacing.wait_time())
+
+    def test_recent_state(self):
+        self.assertEqual(None, self.spacing.recent_state(0))
+        state = {'state': 'OK'}
+        self.spacing.sampled(state, 0)
+        self.clock.now += 5
+        self.assertEqual(state, self.spacing.recent_state(0))
+
+        # a transition since the beat makes it stale
+        self.assertEqual(None, self.spacing.recent_state(1))
+
+        self.clock.now += 0.5
+        self.assertEqual(None, self.spacing.recent_state(0))
@@ -0,0 +1,49 @@
+# Copyright 2013 University of Chicago
+
+import random
+import unittest
+
+from epuagent.simulator import SyntheticSupervisor, VirtualAgent, simulate
+from epuagent.supervisor import RUNNING_STATES
+from epuagent.codec import decode
+
+try:
+    import dashi
+except ImportError:
+    dashi = None
+
+class SimulatorTests(unittest.TestCase):
+    def test_supervisor_churn(self):
+        sup = SyntheticSupervisor(10, failure_rate=1.0)
+        procs = sup.query()
+        self.assertEqual(10, len(procs))
+        self.assertFalse([p for p in procs if p['state'] in RUNNING_STATES])
+
+        sup.failure_rate = 0.0
+        sup.flap_rate = 1.0
+        procs = sup.query()
+        self.assertEqual(10, len([p for p in procs
+                                  if p['state'] in RUNNING_STATES]))
+
+    def test_supervisor_steady(self):
+        sup = SyntheticSupervisor(5, rng=random.Random(1))
+        for i in range(3):
+            self.assertEqual(5, len([p for p in sup.query()
+                                     if p['state'] in RUNNING_STATES]))
+
+    def test_virtual_agent(self):
+        sup = SyntheticSupervisor(3, failure_rate=1.0)
+        agent = VirtualAgent("node1", sup, codec_name="binary")
+        state = decode(agent.beat())
+        self.assertEqual("node1", state['node_id'])
+        self.assertEqual(3, len(state['failed_processes']))
+        self.assertIn('timestamp', state)
+
+    def test_simulate(self):
+        if dashi is None:
+            raise unittest.SkipTest("dashi not available")
+        report = simulate(nagents=5, nprocs=3, failure_rate=0.1,
+                          period=0.1, duration=0.5, seed=1)
+        self.assertTrue(report['sent'] > 0)
+        self.assertEqual(report['sent'], report['received'])
+        self.assertEqual(report['received'], report['latency']['count'])
@@ -0,0 +1,54 @@
+# Copyright 2013 University of Chicago
+
+import unittest
+
+from epuagent.stats import Histogram, Stats, NO_STATS
+
+class HistogramTests(unittest.TestCase):
+    def test_percentiles(self):
+        histogram = Histogram()
+        self.assertEqual(None, histogram.percentile(50))
+        for i in range(1, 101):
+            histogram.add(i / 1000.0)
+        snapshot = histogram.snapshot()
+        self.assertEqual(100, snapshot['count'])
+        self.assertEqual(0.1, snapshot['max'])
+        # buckets are about 19% wide
+        self.assertTrue(0.05 <= snapshot['p50'] <= 0.05 * 1.2)
+        self.assertTrue(0.095 <= snapshot['p95'] <= 0.1)
+        self.assertTrue(snapshot['p99'] <= 0.1)
+
+    def test_extremes(self):
+        histogram = Histogram()
+        histogram.add(0)
+        histogram.add(10000)
+        self.assertEqual(2, histogram.count)
+        self.assertEqual(10000, histogram.percentile(100))
+
+
+class StatsTests(unittest.TestCase):
+    def test_stats(self):
+        stats = Stats()
+        with stats.timer('phase'):
+            pass
+        stats.add('phase', 0.5)
+        stats.incr('beats')
+        stats.incr('beats')
+        snapshot = stats.snapshot()
+        self.assertEqual(2, snapshot['timers']['phase']['count'])
+        self.assertEqual(0.5, snapshot['timers']['phase']['max'])
+        self.assertEqual({'beats': 2}, snapshot['counters'])
+
+    def test_timer_exception(self):
+        stats = Stats()
+        try:
+            with stats.timer('phase'):
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(1, stats.snapshot()['timers']['phase']['count'])
+
+    def test_disabled(self):
+        with NO_STATS.timer('phase'):
+            NO_STATS.incr('beats')
+        self.assertEqual(None, NO_STATS.snapshot())
@@ -0,0 +1,125 @@
+# Copyright 2013 University of Chicago
+
+import os
+import stat
+import json
+import shutil
+import socket
+import httplib
+import tempfile
+import unittest
+
+import gevent
+
+from epuagent.status import StatusServer, StatusSnapshot, parse_address
+
+class _UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        self.sock = sock
+
+def _state(state="MONITOR_OK", timestamp=1.0, failed=None):
+    state = {'node_id': 'node1', 'timestamp': timestamp, 'state': state}
+    if failed is not None:
+        state['failed_processes'] = failed
+    return state
+
+class StatusSnapshotTests(unittest.TestCase):
+    def test_sequence_follows_changes(self):
+        snapshot = StatusSnapshot()
+        self.assertEqual(None, snapshot.body())
+
+        snapshot.update(_state(timestamp=1.0))
+        self.assertEqual(1, snapshot.sequence)
+        snapshot.update(_state(timestamp=2.0))
+        self.assertEqual(1, snapshot.sequence)
+        self.assertEqual(2.0, json.loads(snapshot.body())['timestamp'])
+
+        snapshot.update(_state("PROCESS_ERROR", 3.0,
+                               [{'name': 'p1', 'state': 200}]))
+        self.assertEqual(2, snapshot.sequence)
+        self.assertEqual('W/"2"', snapshot.etag)
+
+    def test_snapshot_is_copied(self):
+        snapshot = StatusSnapshot()
+        state = _state()
+        snapshot.update(state)
+        state['agent_stats'] = {}
+        self.assertNotIn('agent_stats', json.loads(snapshot.body()))
+
+    def test_binary_stderr(self):
+        snapshot = StatusSnapshot()
+        snapshot.update(_state(failed=[{'name': 'p1', 'stderr': '\xff\xfe'}]))
+        self.assertTrue(snapshot.body())
+
+    def test_parse_address(self):
+        self.assertEqual("/tmp/x.sock", parse_address("/tmp/x.sock"))
+        self.assertEqual(("127.0.0.1", 8011), parse_address(8011))
+        self.assertEqual(("localhost", 8011), parse_address("localhost:8011"))
+        self.assertEqual(("127.0.1.1", 80), parse_address("127.0.1.1:80"))
+        self.assertEqual(("::1", 8011), parse_address("[::1]:8011"))
+        for value in ("0.0.0.0:8011", "10.0.0.1:8011", "example.com:80",
+                      ":::8011"):
+            self.assertRaises(ValueError, parse_address, value)
+        self.assertRaises(ValueError, StatusServer, ("0.0.0.0", 8011))
+
+class StatusServerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "status.sock")
+        self.server = StatusServer(self.path,
+                                   get_stats=lambda: {'counters': {'x': 1}})
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def _get(self, path, headers=None):
+        def get():
+            conn = _UnixHTTPConnection(self.path)
+            try:
+                conn.request('GET', path, headers=headers or {})
+                resp = conn.getresponse()
+                return resp.status, dict(resp.getheaders()), resp.read()
+            finally:
+                conn.close()
+        # the client blocks, so run it off the hub
+        return gevent.get_hub().threadpool.apply(get)
+
+    def test_socket_mode(self):
+        self.assertEqual(0600, stat.S_IMODE(os.stat(self.path).st_mode))
+
+    def test_state(self):
+        status, headers, body = self._get('/state')
+        self.assertEqual(503, status)
+
+        self.server.update(_state())
+        status, headers, body = self._get('/state')
+        self.assertEqual(200, status)
+        self.assertEqual('node1', json.loads(body)['node_id'])
+        self.assertEqual('1', headers['x-state-sequence'])
+        etag = headers['etag']
+
+        self.server.update(_state(timestamp=2.0))
+        status, headers, body = self._get('/state', {'If-None-Match': etag})
+        self.assertEqual(304, status)
+        self.assertEqual(1, self.server.not_modified)
+
+        self.server.update(_state("MONITOR_ERROR"))
+        status, headers, body = self._get('/state', {'If-None-Match': etag})
+        self.assertEqual(200, status)
+        self.assertEqual('MONITOR_ERROR', json.loads(body)['state'])
+
+    def test_stats(self):
+        status, headers, body = self._get('/stats')
+        self.assertEqual(200, status)
+        self.assertEqual({'counters': {'x': 1}}, json.loads(body))
+
+        status, headers, body = self._get('/nope')
+        self.assertEqual(404, status)
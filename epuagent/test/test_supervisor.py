@@ -1,11 +1,18 @@
 # Copyright 2013 University of Chicago
 
 import os
+import time
 import uuid
+import shutil
 import tempfile
 import unittest
+import xmlrpclib
+import threading
 
-from epuagent.supervisor import Supervisor, SupervisorError
+import gevent
+
+from epuagent.supervisor import Supervisor, SupervisorGroup, SupervisorError
+from epuagent.fakesupervisord import UnixXMLRPCServer
 
 class SupervisorTests(unittest.TestCase):
     def test_error_nofile(self):
@@ -13,3 +20,229 @@ class SupervisorTests(unittest.TestCase):
         noexist = "unix://%s" % noexist
         soup = Supervisor(noexist)
         self.assertRaises(SupervisorError, soup.query)
+
+
+class SupervisorConnectionTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sock = os.path.join(self.tmpdir, "supervisor.sock")
+        self.server = None
+        self.soup = Supervisor("unix://%s" % self.sock)
+
+    def tearDown(self):
+        self.soup.close()
+        self._stop_server()
+        shutil.rmtree(self.tmpdir)
+
+    def _start_server(self, delay=None, processes=None):
+        def query():
+            if delay:
+                time.sleep(delay)
+            return processes or []
+        def tail(name, offset, length):
+            if name == 'nolog':
+                raise xmlrpclib.Fault(70, 'NO_FILE')
+            data = "error from %s\n" % name
+            return [data[-length:], 1000, length < len(data)]
+        self.server = UnixXMLRPCServer(self.sock)
+        self.server.register_function(query, 'supervisor.getAllProcessInfo')
+        self.server.register_function(tail, 'supervisor.tailProcessStderrLog')
+        self.server.register_multicall_functions()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def _stop_server(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server.close_requests()
+            self.server = None
+            os.unlink(self.sock)
+
+    def test_connection_reused(self):
+        self._start_server()
+        for i in range(5):
+            self.assertEqual([], self.soup.query())
+
+        stats = self.soup.get_stats()
+        self.assertEqual(1, stats['connect_count'])
+        self.assertEqual(5, stats['call_count'])
+        self.assertTrue(stats['last_connect_seconds'] is not None)
+        self.assertTrue(stats['last_call_seconds'] is not None)
+
+    def test_reconnect_after_restart(self):
+        self._start_server()
+        self.assertEqual([], self.soup.query())
+
+        # the next call finds the old connection dead and reconnects
+        self._stop_server()
+        self._start_server()
+        self.assertEqual([], self.soup.query())
+        self.assertEqual(2, self.soup.get_stats()['connect_count'])
+
+
+    def test_timeout(self):
+        self._start_server(delay=1)
+        self.soup.timeout = 0.1
+        start = time.time()
+        self.assertRaises(SupervisorError, self.soup.query)
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(1, self.soup.failures)
+
+    def test_query_with_tails(self):
+        self._start_server(processes=[{'name': 'a'}, {'name': 'nolog'}])
+        procs, tails = self.soup.query_with_tails(['a', 'nolog'], 5)
+        self.assertEqual(['a', 'nolog'], [proc['name'] for proc in procs])
+        self.assertEqual(("om a\n", 1000, True), tails['a'])
+        self.assertEqual(None, tails['nolog'])
+        self.assertEqual(1, self.soup.get_stats()['call_count'])
+        self.assertEqual(procs, self.soup.last_processes)
+
+        tails = self.soup.tail_stderr(['b'], 1024)
+        self.assertEqual(("error from b\n", 1000, False), tails['b'])
+
+    def test_last_processes(self):
+        self._start_server()
+        self.assertEqual(None, self.soup.last_processes)
+        self.soup.query()
+        self.assertEqual([], self.soup.last_processes)
+        self.assertTrue(self.soup.last_query_time)
+
+
+class SupervisorBreakerTests(unittest.TestCase):
+    def setUp(self):
+        noexist = os.path.join(tempfile.gettempdir(), str(uuid.uuid4()))
+        self.soup = Supervisor("unix://%s" % noexist, failure_threshold=2,
+                               reset_seconds=60)
+        self.calls = 0
+        real_call = self.soup._call
+        def counting_call(*args):
+            self.calls += 1
+            return real_call(*args)
+        self.soup._call = counting_call
+
+    def test_opens(self):
+        for i in range(5):
+            self.assertRaises(SupervisorError, self.soup.query)
+        self.assertEqual(2, self.calls)
+        self.assertEqual('open', self.soup.get_stats()['breaker'])
+
+    def test_half_open(self):
+        for i in range(2):
+            self.assertRaises(SupervisorError, self.soup.query)
+        self.soup.reset_seconds = 0
+
+        # the probe fails, so the circuit opens again right away
+        self.assertRaises(SupervisorError, self.soup.query)
+        self.assertEqual(3, self.calls)
+        self.assertEqual('open', self.soup.breaker)
+
+        # a good probe closes it
+        self.soup._call = lambda *args: []
+        self.assertEqual([], self.soup.query())
+        self.assertEqual('closed', self.soup.breaker)
+        self.assertEqual(0, self.soup.failures)
+
+    def _open_for_probe(self):
+        for i in range(2):
+            self.assertRaises(SupervisorError, self.soup.query)
+        self.soup.reset_seconds = 0
+
+    def test_fault_probe_closes(self):
+        self._open_for_probe()
+
+        # supervisord answering with a fault, as while it shuts down,
+        # shows it is reachable
+        def fault(*args):
+            raise xmlrpclib.Fault(6, "SHUTDOWN_STATE")
+        self.soup._call = fault
+        self.assertRaises(SupervisorError, self.soup.query)
+        self.assertEqual('closed', self.soup.breaker)
+
+        self.soup._call = lambda *args: []
+        for i in range(3):
+            self.assertEqual([], self.soup.query())
+
+    def test_interrupted_probe_reopens(self):
+        self._open_for_probe()
+
+        def hang(*args):
+            gevent.sleep(10)
+        self.soup._call = hang
+        self.assertRaises(gevent.Timeout, gevent.with_timeout, 0.01,
+                          self.soup.query)
+        self.assertEqual('open', self.soup.breaker)
+
+        # and the next call after reset_seconds is probed again
+        self.soup._call = lambda *args: []
+        self.assertEqual([], self.soup.query())
+        self.assertEqual('closed', self.soup.breaker)
+
+
+class SupervisorGroupTests(unittest.TestCase):
+    def setUp(self):
+        self.sups = [FakeSupervisor([{'name': 'a'}]),
+                     FakeSupervisor([{'name': 'b'}, {'name': 'c'}])]
+        self.group = SupervisorGroup([("one", self.sups[0]),
+                                      ("two", self.sups[1])], timeout=0.2)
+
+    def test_query(self):
+        procs = self.group.query()
+        self.assertEqual(["one/a", "two/b", "two/c"],
+                         [proc['name'] for proc in procs])
+        self.assertEqual("two", procs[1]['supervisor'])
+        self.assertEqual({}, self.group.errors)
+        self.assertEqual({'state': 'OK', 'process_count': 2},
+                         self.group.status['two'])
+
+    def test_event_process_name(self):
+        self.sups[1].url = "unix:///tmp/two.sock"
+        name = self.group.event_process_name
+        self.assertEqual("one/a", name({'processname': 'a',
+                                        'supervisor': 'one'}))
+        self.assertEqual("two/b", name({'processname': 'b',
+                                        'supervisor': self.sups[1].url}))
+        self.assertEqual(None, name({'processname': 'a'}))
+        self.assertEqual(None, name({'processname': 'a',
+                                     'supervisor': 'three'}))
+
+    def test_partial_failure(self):
+        self.sups[0].error = SupervisorError("faaaaaaaail")
+        procs = self.group.query()
+        self.assertEqual(["two/b", "two/c"], [proc['name'] for proc in procs])
+        self.assertTrue("faaaaaaaail" in self.group.errors['one'])
+        self.assertEqual("MONITOR_ERROR", self.group.status['one']['state'])
+
+    def test_timeout(self):
+        self.sups[1].delay = 10
+        start = time.time()
+        procs = self.group.query()
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(["one/a"], [proc['name'] for proc in procs])
+        self.assertTrue('two' in self.group.errors)
+        self.assertTrue(self.sups[1].closed)
+
+    def test_total_failure(self):
+        for sup in self.sups:
+            sup.error = SupervisorError("faaaaaaaail")
+        self.assertRaises(SupervisorError, self.group.query)
+        self.assertEqual(2, len(self.group.errors))
+
+
+class FakeSupervisor(object):
+    def __init__(self, processes):
+        self.processes = processes
+        self.error = None
+        self.delay = None
+        self.closed = False
+
+    def query(self):
+        if self.delay:
+            gevent.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return [dict(proc) for proc in self.processes]
+
+    def close(self):
+        self.closed = True
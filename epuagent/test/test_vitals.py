@@ -0,0 +1,66 @@
+# Copyright 2013 University of Chicago
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from epuagent.vitals import NodeVitals
+
+MEMINFO = """MemTotal:        2048 kB
+MemFree:          512 kB
+MemAvailable:    1024 kB
+SwapTotal:        100 kB
+SwapFree:          60 kB
+"""
+
+NET_DEV = """Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo: %(lo)d 1 0 0 0 0 0 0 %(lo)d 1 0 0 0 0 0 0
+  eth0: %(rx)d 1 0 0 0 0 0 0 %(tx)d 1 0 0 0 0 0 0
+"""
+
+STAT = "cpu  %(busy)d 0 0 %(idle)d 0 0 0 0 0 0\ncpu0 0 0 0 0 0 0 0 0 0 0\n"
+
+class NodeVitalsTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, "net"))
+        self._write("loadavg", "0.50 0.25 0.10 1/100 1234\n")
+        self._write("meminfo", MEMINFO)
+        self._counters(busy=100, idle=100, rx=1000, tx=2000)
+        self.vitals = NodeVitals(mounts=[self.root], proc_root=self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, name, text):
+        f = open(os.path.join(self.root, name), 'w')
+        try:
+            f.write(text)
+        finally:
+            f.close()
+
+    def _counters(self, busy, idle, rx, tx):
+        self._write("stat", STAT % {'busy': busy, 'idle': idle})
+        self._write("net/dev", NET_DEV % {'lo': 99999, 'rx': rx, 'tx': tx})
+
+    def test_collect(self):
+        vitals = self.vitals.collect()
+        self.assertEqual([0.5, 0.25, 0.1], vitals['load'])
+        self.assertEqual(2048 * 1024, vitals['mem_total'])
+        self.assertEqual(1024 * 1024, vitals['mem_available'])
+        self.assertEqual(40 * 1024, vitals['swap_used'])
+        self.assertEqual(None, vitals['cpu'])
+        self.assertEqual(None, vitals['net_rx_rate'])
+        self.assertTrue(vitals['disks'][self.root]['total'] > 0)
+
+        self._counters(busy=175, idle=125, rx=3000, tx=2000)
+        vitals = self.vitals.collect()
+        self.assertEqual(75.0, vitals['cpu'])
+        self.assertTrue(vitals['net_rx_rate'] > 0)
+        self.assertEqual(0, vitals['net_tx_rate'])
+
+    def test_unreadable(self):
+        self.vitals.proc_root = os.path.join(self.root, "nope")
+        self.assertEqual({}, self.vitals.collect())
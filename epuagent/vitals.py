@@ -0,0 +1,124 @@
+# Copyright 2013 University of Chicago
+
+"""Node-level vitals: load, memory, CPU, network and disk usage
+"""
+
+import os
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MOUNTS = ('/',)
+
+
+class NodeVitals(object):
+    """Collects a compact summary of node health from /proc and statvfs
+
+    CPU and network figures are rates between consecutive calls to
+    collect(), so they are None the first time.
+    """
+
+    def __init__(self, mounts=DEFAULT_MOUNTS, proc_root='/proc'):
+        self.mounts = list(mounts)
+        self.proc_root = proc_root
+
+        self._last_time = None
+        self._last_cpu = None
+        self._last_net = None
+
+    def collect(self):
+        now = time.time()
+        vitals = {}
+
+        try:
+            vitals['load'] = self._loadavg()
+            vitals.update(self._meminfo())
+            cpu = self._cpu()
+            net = self._net()
+        except EnvironmentError, e:
+            log.warn("Failed to read node vitals: %s", e)
+            return vitals
+
+        elapsed = None
+        if self._last_time is not None:
+            elapsed = now - self._last_time
+
+        vitals['cpu'] = None
+        if self._last_cpu is not None:
+            busy = cpu[0] - self._last_cpu[0]
+            total = cpu[1] - self._last_cpu[1]
+            if total > 0:
+                vitals['cpu'] = 100.0 * busy / total
+
+        vitals['net_rx_rate'] = vitals['net_tx_rate'] = None
+        if elapsed:
+            vitals['net_rx_rate'] = (net[0] - self._last_net[0]) / elapsed
+            vitals['net_tx_rate'] = (net[1] - self._last_net[1]) / elapsed
+
+        self._last_time = now
+        self._last_cpu = cpu
+        self._last_net = net
+
+        disks = {}
+        for mount in self.mounts:
+            try:
+                st = os.statvfs(mount)
+            except OSError, e:
+                log.warn("Failed to stat filesystem %s: %s", mount, e)
+                continue
+            disks[mount] = {'total': st.f_blocks * st.f_frsize,
+                            'free': st.f_bavail * st.f_frsize}
+        vitals['disks'] = disks
+        return vitals
+
+    def _read(self, name):
+        f = open(os.path.join(self.proc_root, name))
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def _loadavg(self):
+        return [float(x) for x in self._read('loadavg').split()[:3]]
+
+    def _meminfo(self):
+        info = {}
+        for line in self._read('meminfo').splitlines():
+            key, sep, value = line.partition(':')
+            if sep:
+                info[key] = int(value.split()[0]) * 1024
+
+        available = info.get('MemAvailable')
+        if available is None:
+            # kernels before 3.14
+            available = (info.get('MemFree', 0) + info.get('Buffers', 0) +
+                         info.get('Cached', 0))
+        return {'mem_total': info.get('MemTotal'),
+                'mem_available': available,
+                'swap_used': info.get('SwapTotal', 0) - info.get('SwapFree', 0)}
+
+    def _cpu(self):
+        """Returns (busy, total) jiffies summed over all CPUs
+        """
+        for line in self._read('stat').splitlines():
+            if line.startswith('cpu '):
+                jiffies = [int(x) for x in line.split()[1:]]
+                total = sum(jiffies[:8])
+                # idle and iowait
+                idle = sum(jiffies[3:5])
+                return total - idle, total
+        return 0, 0
+
+    def _net(self):
+        """Returns (rx, tx) bytes summed over all interfaces but loopback
+        """
+        rx = tx = 0
+        for line in self._read('net/dev').splitlines()[2:]:
+            iface, sep, counters = line.partition(':')
+            if not sep or iface.strip() == 'lo':
+                continue
+            counters = counters.split()
+            rx += int(counters[0])
+            tx += int(counters[8])
+        return rx, tx
@@ -36,7 +36,7 @@ setupdict['test_suite'] = 'epuagent'
 #setupdict['include_package_data'] = True
 #setupdict['package_data'] = {
 #    'epu': ['data/*.sqlt', 'data/install.sh']
-setupdict['install_requires'] = ['gevent==0.13.7',
+setupdict['install_requires'] = ['gevent>=1.0',
                                  'dashi==0.1',
                                  'supervisor==3.0a10',
                                 ]
@@ -45,6 +45,8 @@ setupdict['tests_require'] = ['nose']
 setupdict['entry_points'] = {
         'console_scripts': [
             'epu-agent=epuagent.agent:main',
+            'epu-agent-listener=epuagent.listener:main',
+            'epu-agent-simulator=epuagent.simulator:main',
             ]
         }
 setupdict['package_data'] = {'epuagent': ['config/*.yml']}